@@ -0,0 +1,235 @@
+#e.g. python brick_cost.py --name_for_run dr9m_test --rs rs0 --nobj 200
+#Orders ./NAME_FOR_RUN/UnfinishedBricks.txt (see brickstat.py) longest first and
+#writes ./NAME_FOR_RUN/ScheduledBricks.txt: brick threads mem_kb vsz_kb predicted_seconds timed,
+#which example1.py dispatches in that order. mem_kb (RSS summed over the
+#processes of a brick) packs the bricks on a node, vsz_kb (largest virtual
+#size of one process) is the ulimit -Sv of each of them. timed is 1 if
+#predicted_seconds comes from a fitted model or the brick's own history, 0
+#if it is only the number of CCDs (good for ordering, not for a deadline)
+import os
+import numpy as np
+from glob import glob
+topdir = os.environ['CSCRATCH']
+obiwan_out_dir = topdir+'/Obiwan/dr9m/obiwan_out/NAME4RUN/output/'
+CAMERAS = ['decam','90prime','mosaic']
+# half diagonal of a CCD [deg], for matching CCD centers to bricks
+CCD_RADIUS = {'decam':0.17, '90prime':0.37, 'mosaic':0.21}
+BRICK_RADIUS = 0.25*np.sqrt(2)/2
+FEATURES = ['n_decam','n_90prime','n_mosaic','nsims','nref']
+
+def brick_features(bricknames, survey_dir, nobj=None, randoms_fn=None, refs=True):
+    """Per brick features of the cost model
+
+    Args:
+        bricknames: array of brick names
+        survey_dir: LEGACY_SURVEY_DIR with survey-bricks and the annotated CCDs
+        nobj: number of sims per brick, unless randoms_fn is given
+        randoms_fn: pattern of the per brick randoms files, e.g.
+            .../divided_randoms/brick_%s.fits, sims = number of rows;
+            or the directory of the randoms store (py/randoms_store.py)
+        refs: count the Gaia stars in each brick (reference star density)
+
+    Returns:
+        fits_table with brickname and the FEATURES columns
+    """
+    from astrometry.util.fits import fits_table
+    from astrometry.libkd.spherematch import match_radec
+    from legacypipe.survey import LegacySurveyData
+    import fitsio
+    survey = LegacySurveyData(survey_dir=survey_dir)
+    B = survey.get_bricks_readonly()
+    index = dict([(b,i) for i,b in enumerate(B.brickname)])
+    B = B[np.array([index[b] for b in bricknames])]
+    A = survey.get_annotated_ccds()
+    T = fits_table()
+    T.brickname = np.array(bricknames)
+    for camera in CAMERAS:
+        n = np.zeros(len(B), np.int32)
+        Ac = A[np.array([c.strip() == camera for c in A.camera])]
+        if len(Ac):
+            I,_,_ = match_radec(B.ra, B.dec, Ac.ra, Ac.dec,
+                                BRICK_RADIUS + CCD_RADIUS[camera],
+                                nearest=False)
+            n += np.bincount(I, minlength=len(B)).astype(np.int32)
+        T.set('n_%s' % camera, n)
+    if randoms_fn is not None and os.path.isdir(randoms_fn):
+        from randoms_store import get_index
+        index = get_index(randoms_fn)
+        T.nsims = np.array([index[b][2] if b in index else 0 for b in bricknames])
+    elif randoms_fn is not None:
+        nsims = []
+        for b in bricknames:
+            fn = randoms_fn % b
+            nsims.append(fitsio.read_header(fn, ext=1)['NAXIS2'] if os.path.exists(fn) else 0)
+        T.nsims = np.array(nsims)
+    else:
+        T.nsims = np.zeros(len(B), np.int32) + (nobj or 0)
+    T.nref = np.zeros(len(B), np.int32)
+    if refs:
+        from legacypipe.gaiacat import GaiaCatalog
+        gaia = GaiaCatalog()
+        for i,b in enumerate(B):
+            G = gaia.get_catalog_radec_box(b.ra1, b.ra2, b.dec1, b.dec2)
+            T.nref[i] = 0 if G is None else len(G)
+    return T
+
+def read_ps(fn):
+    """Wall time [s], peak memory [kB], peak virtual size [kB], threads,
+    end time and success of a run from its --ps file
+
+    The memory is the RSS summed over the brick's processes (main and pool
+    workers), what it takes of the node; the virtual size is that of the
+    largest single process, what ulimit -v applies to. The threads are the
+    most pool workers (forked, so with the command line of the main
+    process) seen at once; the run succeeded if it got to the end of
+    stage_writecat.
+    """
+    from astrometry.util.fits import fits_table
+    import fitsio
+    P = fits_table(fn)
+    P.cut(P.mine)
+    if len(P) == 0:
+        return None
+    steps = np.unique(P.step)
+    rss = [P.rss[P.step == s].astype(float).sum() for s in steps]
+    command = np.array([str(c).strip() for c in P.command])
+    worker = np.logical_not(P.main) & np.isin(command, command[P.main])
+    threads = max([1] + [np.sum(worker[P.step == s]) for s in steps])
+    finished = False
+    if len(fitsio.FITS(fn)) > 2:
+        E = fits_table(fn, ext=2)
+        finished = 'stage_writecat: done' in [str(e).strip() for e in E.event]
+    return (P.unixtime.max() - P.unixtime.min(), max(rss), P.vsz.astype(float).max(),
+            int(threads), P.unixtime.max(), finished)
+
+def read_history(name_for_run, rs):
+    """brickname -> (wall time, peak memory, peak vsz, threads) of the last
+    successful run of each brick, from their --ps files
+
+    Killed or failed runs are left out: their time is only a lower bound
+    """
+    outdir = obiwan_out_dir.replace('NAME4RUN', name_for_run)
+    runs = {}
+    for fn in glob(os.path.join(outdir, 'metrics', '*', '*', rs, 'ps-*.fits')):
+        brick = os.path.basename(os.path.dirname(os.path.dirname(fn)))
+        r = read_ps(fn)
+        if r is None or not r[5]:
+            continue
+        if brick not in runs or r[4] > runs[brick][4]:
+            runs[brick] = r
+    return dict([(b, r[:4]) for b,r in runs.items()])
+
+def per_thread(history):
+    """brickname -> (work [s x threads], peak memory per process [kB], peak vsz [kB])
+
+    The quantities of the history that do not depend on the threads of
+    the run, assuming the wall time scales as 1/threads and the summed
+    RSS with the number of processes (threads pool workers and the main)
+    """
+    return dict([(b, (t * n, m / (n + 1.), v)) for b,(t,m,v,n) in history.items()])
+
+def fit_cost_model(T, history):
+    """Least squares coefficients of work, peak memory per process and peak
+    vsz (see per_thread) vs FEATURES
+
+    Returns:
+        tuple: time,mem,vsz coefficients (constant first), None if there
+            are too few bricks with history for the fit
+    """
+    I = np.array([i for i,b in enumerate(T.brickname) if b in history], int)
+    if len(I) < 2*(len(FEATURES)+1):
+        return None, None, None
+    history = per_thread(history)
+    X = np.hstack([np.ones((len(I),1)),
+                   np.array([T.get(f)[I] for f in FEATURES]).T.astype(float)])
+    return tuple(np.linalg.lstsq(X, np.array([history[b][k] for b in T.brickname[I]]),
+                                 rcond=None)[0]
+                 for k in range(3))
+
+def predict(T, history, coeffs, default_mem, default_vsz):
+    """Predicted work [s x threads], peak memory per process [kB] and peak
+    vsz [kB] of each brick (see per_thread), and whether the work is in seconds
+
+    Bricks with history use it; without a fitted model the work is the
+    number of CCDs (only good for ordering, timed is False), the memory
+    default_mem and the vsz default_vsz
+
+    Returns:
+        tuple: work, mem, vsz, timed arrays
+    """
+    ct, cm, cv = coeffs
+    history = per_thread(history)
+    X = np.hstack([np.ones((len(T),1)),
+                   np.array([T.get(f) for f in FEATURES]).T.astype(float)])
+    if ct is None:
+        t = X[:,1:1+len(CAMERAS)].sum(axis=1)
+        m = np.zeros(len(T)) + default_mem
+        v = np.zeros(len(T)) + default_vsz
+    else:
+        t = np.maximum(X.dot(ct), 1.)
+        m = np.maximum(X.dot(cm), 1.)
+        v = np.maximum(X.dot(cv), 1.)
+    timed = np.zeros(len(T), bool) + (ct is not None)
+    for i,b in enumerate(T.brickname):
+        if b in history:
+            t[i], m[i], v[i] = history[b]
+            timed[i] = True
+    return t, m, v, timed
+
+def plan(T, w, m, v, timed, min_threads=4, max_threads=16, mem_margin=1.2):
+    """Longest first order, thread count, memory, ulimit and wall time of each brick
+
+    Threads scale with the predicted work up to max_threads for the
+    longest 10%, so the small bricks can share a node (see SubMaster
+    in mpi_master_slave) while the long ones finish early. The wall time
+    is the work over these threads and the memory (summed RSS, for that
+    packing) the per process memory times the threads and the main
+    process; the ulimit -Sv of each process of the brick comes from the
+    peak vsz of one process.
+
+    Returns:
+        list: (brick, threads, mem_kb, vsz_kb, seconds, timed), longest first
+    """
+    order = np.argsort(-w, kind='stable')
+    wmax = max(np.percentile(w, 90), 1e-9)
+    threads = np.clip(np.ceil(max_threads * w / wmax), min_threads, max_threads).astype(int)
+    seconds = w / threads
+    mem_kb = (m * (threads + 1) * mem_margin).astype(np.int64)
+    vsz_kb = (v * mem_margin).astype(np.int64)
+    return [(T.brickname[i], threads[i], mem_kb[i], vsz_kb[i], seconds[i], timed[i])
+            for i in order]
+
+def get_parser():
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,description='brick_cost')
+    parser.add_argument('--name_for_run', type=str, required=True, help='name of production run')
+    parser.add_argument('--rs', type=str, required=True, help='e.g. rs0, more_rs0,rs200; the --ps history of this rsdir is used')
+    parser.add_argument('--survey_dir', type=str, default=os.environ.get('LEGACY_SURVEY_DIR'), help='with survey-bricks and the annotated CCDs')
+    parser.add_argument('--nobj', type=int, default=200, help='sims per brick, unless --randoms_fn')
+    parser.add_argument('--randoms_fn', type=str, default=None, help='per brick randoms, e.g. .../divided_randoms/brick_%%s.fits, or the randoms store directory')
+    parser.add_argument('--no_refs', action='store_true', default=False, help='do not count Gaia stars per brick')
+    parser.add_argument('--min_threads', type=int, default=4)
+    parser.add_argument('--max_threads', type=int, default=16)
+    parser.add_argument('--default_mem', type=int, default=2000000, help='kB per process without a fitted memory model')
+    parser.add_argument('--default_vsz', type=int, default=125000000, help='ulimit -Sv [kB] per process without a fitted vsz model')
+    return parser
+
+if __name__ == '__main__':
+    parser= get_parser()
+    args = parser.parse_args()
+    bricks = np.atleast_1d(np.loadtxt('./%s/UnfinishedBricks.txt'%args.name_for_run, dtype=str))
+    T = brick_features(bricks, args.survey_dir, nobj=args.nobj,
+                       randoms_fn=args.randoms_fn, refs=not args.no_refs)
+    history = read_history(args.name_for_run, args.rs)
+    coeffs = fit_cost_model(T, history)
+    print('%d bricks, %d with history, cost model time %s mem %s vsz %s' %
+          ((len(T), len(set(T.brickname) & set(history))) + coeffs))
+    w, m, v, timed = predict(T, history, coeffs, args.default_mem, args.default_vsz)
+    if not timed.all():
+        print('%d bricks without a predicted time in seconds (timed 0), '
+              'example1.py does not hold them back for the deadline' % np.sum(~timed))
+    with open('./%s/ScheduledBricks.txt'%args.name_for_run, 'w') as f:
+        for brick,threads,mem_kb,vsz_kb,tpred,tm in plan(T, w, m, v, timed,
+                                                         min_threads=args.min_threads,
+                                                         max_threads=args.max_threads):
+            f.write('%s %d %d %d %.0f %d\n' % (brick, threads, mem_kb, vsz_kb, tpred, tm))
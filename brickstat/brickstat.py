@@ -1,12 +1,16 @@
 #e.g. python brickstat.py --name_for_run dr9m_test --rs rs0 --real_bricks_fn bricks_dr9f_south.txt
 #SV_bricks.txt
 #/global/cscratch1/sd/huikong/Obiwan/dr8/obiwan_out/SV_south/output/tractor/
+#The state of each brick comes from the run state manifests kenobi.py writes
+#(py/run_state.py, obiwan_code/py needs to be in PYTHONPATH); bricks without
+#a record, e.g. from runs before the manifests, are classified from their log
 import os
 topdir = os.environ['CSCRATCH']
 obiwan_out_dir = topdir+'/Obiwan/dr9m/obiwan_out/NAME4RUN/output/'
 NAME_FOR_RUN=None
 RS=None
 REAL_BRICKS_FN=None
+MANIFEST_ONLY=False
 
 def mkdir(fn):
     if os.path.exists(fn):
@@ -25,40 +29,55 @@ def OneBrickClassify(brickname):
     log_dir = obiwan_out_dir+'/logs/%s/%s/%s/log.%s'%(brickname[:3],brickname,RS,brickname)
     #print(log_dir)
     if os.path.isfile(log_dir) is False:
-        f1 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'a')
-        f1.write(str(brickname)+'\n')
-        f1.close()
         return -1
-    flag = False
-    if "decals_sim:All done!" in open(log_dir).read():
-        f2 = open('./%s/FinishedBricks.txt'%NAME_FOR_RUN, 'a')
-        f2.write(str(brickname)+'\n')
-        f2.close()
-        return 1
+    # "All done!" is logged last, no need to read the whole log
+    with open(log_dir, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 65536, 0))
+        if b"decals_sim:All done!" in f.read():
+            return 1
     tractor=obiwan_out_dir+'/tractor/%s/%s/%s/tractor-%s.fits'%(brickname[:3],brickname,RS,brickname)
     print(tractor)
     if os.path.isfile(tractor):
-        f2 = open('./%s/FinishedBricks.txt'%NAME_FOR_RUN, 'a')
-        f2.write(str(brickname)+'\n')
-        f2.close()
         return 1
-    f4 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'a')
-    f4.write(str(brickname)+'\n')
-    f4.close()
     return 2
 
 def BrickClassify():
     import numpy as np
     import multiprocessing as mp
-    N=16
-    p = mp.Pool(N)
+    from run_state import read_states
     global NAME_FOR_RUN
+    bricks = np.loadtxt('./real_brick_lists/%s'%REAL_BRICKS_FN, dtype=str)
+    # one read of the manifests, then a dict lookup per brick
+    states = read_states(obiwan_out_dir.replace('NAME4RUN',NAME_FOR_RUN), rsdir=RS)
+    status = {}
+    nostate = []
+    counts = {}
+    for brickname in bricks:
+        rec = states.get((brickname,RS))
+        if rec is None:
+            nostate.append(brickname)
+            continue
+        counts[rec['state']] = counts.get(rec['state'],0) + 1
+        status[brickname] = 1 if rec['state'] == 'done' else 2
+    print('run state manifests: %s, no record for %d bricks' % (counts, len(nostate)))
+    if MANIFEST_ONLY:
+        for brickname in nostate:
+            status[brickname] = -1
+    elif len(nostate):
+        N=16
+        p = mp.Pool(N)
+        status.update(zip(nostate, p.map(OneBrickClassify,nostate)))
+    # only this process writes the lists
     f1 = open('./%s/FinishedBricks.txt'%NAME_FOR_RUN, 'w')
-    f1.close
     f2 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'w')
+    for brickname in bricks:
+        if status[brickname] == 1:
+            f1.write(str(brickname)+'\n')
+        else:
+            f2.write(str(brickname)+'\n')
+    f1.close()
     f2.close()
-    bricks = np.loadtxt('./real_brick_lists/%s'%REAL_BRICKS_FN, dtype=np.str)
-    p.map(OneBrickClassify,bricks)
 
 def get_parser():
     import argparse
@@ -66,6 +85,7 @@ def get_parser():
     parser.add_argument('--name_for_run', type=str, required=True, help='name of production run')#currently: elg_like_run,elg_ngc_run
     parser.add_argument('--rs', type=str, required=True, help='e.g. rs0, more_rs0,rs200')
     parser.add_argument('--real_bricks_fn', type=str, required=True, help='bricks processed in this run')
+    parser.add_argument('--manifest_only', action='store_true', default=False, help='bricks without a run state record are unfinished, without looking at their logs')
     return parser
 if __name__ == '__main__':
     parser= get_parser()
@@ -76,5 +96,6 @@ if __name__ == '__main__':
     NAME_FOR_RUN = args.name_for_run
     RS = args.rs
     REAL_BRICKS_FN = args.real_bricks_fn   
+    MANIFEST_ONLY = args.manifest_only
     mkdir(NAME_FOR_RUN) 
     BrickClassify()
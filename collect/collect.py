@@ -9,10 +9,11 @@ from astropy.coordinates import SkyCoord
 from astropy import units as u
 import subprocess
 from astropy.table import hstack,Table
+from brick_match import match_pixels, match_sky, match_stars, STAR_COLUMNS
+from brick_match import ref_sources_fn, read_ref_stars
 
-def SV_brick_match(brickname, name_for_run, rs_type, name_for_randoms = None, startid = None, nobj = None, angle = 1.5/3600, MS_star=True):
-    
-    assert(name_for_randoms is not None);assert(startid is not None);assert(nobj is not None)
+def read_brick_tables(brickname, rs_type, startid, nobj):
+    """tractor catalog, simcat and original randoms of a brick"""
     topdir_tractor = os.environ['obiwan_out']+'/output/'
     sim_topdir = os.environ['obiwan_out']+'/divided_randoms/'
     print(brickname,rs_type)
@@ -22,11 +23,23 @@ def SV_brick_match(brickname, name_for_run, rs_type, name_for_randoms = None, st
     tractor = Table.read(fn_tractor)
     sim = Table.read(fn_sim)
     #MS stars
-    try:
+    if os.environ.get('randoms_store'):
+       # brick sorted store of random_division/GetBricksSrc.py, read just the rows
+       from randoms_store import read_brick
+       T = read_brick(os.environ['randoms_store'], brickname, rows=(startid, startid+nobj))
+       original_sim = Table([T.get(c) for c in T.get_columns()], names=T.get_columns())
+    else:
+     try:
        original_sim = Table.read(fn_original_sim)[startid:startid+nobj] 
-    except:
+     except:
        original_sim = Table.read(fn_original_sim)
+    return tractor, sim, original_sim
+
+def SV_brick_match(brickname, name_for_run, rs_type, name_for_randoms = None, startid = None, nobj = None, angle = 1.5/3600, MS_star=True):
     
+    assert(name_for_randoms is not None);assert(startid is not None);assert(nobj is not None)
+    topdir_tractor = os.environ['obiwan_out']+'/output/'
+    tractor, sim, original_sim = read_brick_tables(brickname, rs_type, startid, nobj)
     #import pdb;pdb.set_trace()
     c1 = SkyCoord(ra=sim['ra']*u.degree, dec=sim['dec']*u.degree)
     c2 = SkyCoord(ra=np.array(tractor['ra'])*u.degree, dec=np.array(tractor['dec'])*u.degree)
@@ -70,4 +83,49 @@ def SV_brick_match(brickname, name_for_run, rs_type, name_for_randoms = None, st
         tc['MS_delta_dec']= np.array(mt['dec']-tc['dec'],dtype=np.float)
     return tc
 
+def kd_brick_match(brickname, name_for_run, rs_type, name_for_randoms = None, startid = None, nobj = None, angle = 1.5/3600, MS_star=True):
+    """SV_brick_match without SkyCoord, same columns
+
+    Sims (x,y) are matched to the tractor sources (bx,by) in brick pixels;
+        sims to the original randoms, and tractor sources to the reference
+        stars, in the tangent plane at the brick center (see py/brick_match.py)
+    """
+    assert(name_for_randoms is not None);assert(startid is not None);assert(nobj is not None)
+    topdir_tractor = os.environ['obiwan_out']+'/output/'
+    tractor, sim, original_sim = read_brick_tables(brickname, rs_type, startid, nobj)
+    if len(tractor) == 0 or len(sim) == 0:
+        return None
+
+    idx1, distance = match_pixels(sim['x'], sim['y'], tractor['bx'], tractor['by'])
+    matched = distance <= angle
+    tc = tractor[idx1]
+
+    idx2, _ = match_sky(brickname, sim['ra'], sim['dec'], original_sim['ra'], original_sim['dec'])
+
+    tc.add_column(sim['ra'],name = 'sim_ra')
+    tc.add_column(sim['dec'],name = 'sim_dec')
+    tc.add_column(sim['gflux'],name = 'sim_gflux')
+    tc.add_column(sim['rflux'],name='sim_rflux')
+    tc.add_column(sim['zflux'],name='sim_zflux')
+    if idx2 is None:
+        # no original randoms left for the rows of this brick
+        tc['sim_redshift'] = np.zeros(len(sim)) + np.nan
+    else:
+        tc.add_column(original_sim['redshift'][idx2],name='sim_redshift')
+    tc.add_column(sim['rhalf'],name='sim_rhalf')
+    tc.add_column(sim['e1'],name='sim_e1')
+    tc.add_column(sim['e2'],name='sim_e2')
+    tc.add_column(sim['x'],name='sim_bx')
+    tc.add_column(sim['y'],name='sim_by')
+    tc['angle'] = np.array(distance*3600.,dtype=float)
+    tc['detected'] = np.array(matched,dtype=bool)
+    tc.add_column(sim['n'],name='sim_sersic_n')
+    if MS_star:
+        #match closest MS star to the output, in the ref-sources file kenobi's write_matched reads
+        ref_ra, ref_dec, ref_radius = read_ref_stars(ref_sources_fn(topdir_tractor, brickname, rs_type))
+        stars = match_stars(brickname, tc['ra'], tc['dec'], ref_ra, ref_dec, ref_radius)
+        for col in STAR_COLUMNS:
+            tc[col] = stars[col]
+    return tc
+
 #table = SV_brick_match('2167p345', 'dr9_wide','rs0', name_for_randoms='dr9g_north_empty', startid = 0, nobj = 200)
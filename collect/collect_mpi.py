@@ -3,8 +3,8 @@ from mpi_master_slave import Master, Slave
 from mpi_master_slave import WorkQueue
 import time
 import numpy as np
-from SV_collect import *
-from astropy.table import vstack
+from collect import SV_brick_match, kd_brick_match
+from stream_tables import stream_concat
 import os
 import sys
 import argparse
@@ -16,7 +16,26 @@ RS_TYPE=None
 START_ID=None
 N_OBJ=None
 NAME_FOR_RANDOMS=None
+# stream: the master concatenates the per brick tables into the output file;
+# tree: the slaves merge them MERGE_FANIN at a time, until one is left
+MERGE='stream'
+MERGE_FANIN=64
+# brick matching function, see collect.py; prematched uses the
+# matched-BRICK.fits kenobi.py --write_matched wrote, kdtree without it
+MATCHERS = dict(kdtree=kd_brick_match, skycoord=SV_brick_match, prematched=kd_brick_match)
+MATCHER='kdtree'
 topdir_obiwan_out=os.environ['obiwan_out']
+
+def get_prematched_fn(brickname):
+    return os.path.join(topdir_obiwan_out,'output','obiwan',brickname[:3],brickname,RS_TYPE,
+                        'matched-%s.fits' % brickname)
+
+def remove_temporary(fns):
+    """removes the tables the slaves wrote, not the prematched ones of the run"""
+    subset = os.path.join(topdir_obiwan_out,'subset','')
+    for fn in fns:
+        if fn.startswith(subset):
+            os.remove(fn)
 class MyApp(object):
     """
     This is my application that has a lot of work to do so it gives work to do
@@ -53,7 +72,6 @@ class MyApp(object):
         #version1 end
         #version 2:
         import glob
-        from astropy.table import vstack
         global BRICKPATH
         global topdir_obiwan_out
         print(BRICKPATH)
@@ -61,7 +79,6 @@ class MyApp(object):
         #paths = np.array_split(paths, N_splits)[split_idx]
         bricknames = np.loadtxt(BRICKPATH,dtype=np.str)
         bricknames = np.array_split(bricknames, N_splits)[split_idx]
-        final_sim = None
         n=0
         bricknames.sort()
         for brickname in bricknames:
@@ -75,11 +92,37 @@ class MyApp(object):
         #    self.work_queue.add_work(data=(i, bricknames[i]))
         #version 1 end
 
-        #
-        # Keeep starting slaves as long as there is work to do
-        #
-        sim_table = None
-        tab = None
+        # the slaves write the matched table of each brick, only the file
+        # names come back
+        brick_fns = {}
+        for done, fn in self.run_queue():
+            print('No %d is done' % done) 
+            if fn is not None:
+                brick_fns[done] = fn
+        fns = [brick_fns[i] for i in sorted(brick_fns)]
+        out_fn = os.path.join(topdir_obiwan_out,'subset','sim_%s_part%d_of_%d.fits' % (name_for_run, split_idx, N_splits))
+        if MERGE == 'tree':
+            level = 0
+            while len(fns) > MERGE_FANIN:
+                groups = [fns[i:i+MERGE_FANIN] for i in range(0, len(fns), MERGE_FANIN)]
+                outs = [out_fn.replace('.fits', '_merge%d_%d.fits' % (level, i))
+                        for i in range(len(groups))]
+                for i in range(len(groups)):
+                    self.work_queue.add_work(data=('merge', (groups[i], outs[i])))
+                for done in self.run_queue():
+                    pass
+                fns = outs
+                level += 1
+        print(out_fn)
+        print('writing all the output to one table...')
+        nrows = stream_concat(fns, out_fn)
+        remove_temporary(fns)
+        print('done! %d rows from %d bricks' % (nrows, len(brick_fns)))
+
+    def run_queue(self):
+        """
+        Runs the queued tasks, yielding what the slaves return
+        """
         while not self.work_queue.done():
 
             #
@@ -91,20 +134,10 @@ class MyApp(object):
             # reclaim returned data from completed slaves
             #
             for slave_return_data in self.work_queue.get_completed_work():
-                done, sim = slave_return_data
-                print('No %d is done' % done) 
-                if sim is not None:
-                    if final_sim is not None:
-                        final_sim = vstack((final_sim,sim))
-                    else:
-                         final_sim=sim 
+                yield slave_return_data
             
             # sleep some time
             time.sleep(0.3)
-        print(topdir_obiwan_out,'subset','sim_%s_part%d_of_%d.fits' %(name_for_run, split_idx, N_splits))
-        print('writing all the output to one table...')
-        final_sim.write(os.path.join(topdir_obiwan_out,'subset','sim_%s_part%d_of_%d.fits' % (name_for_run, split_idx, N_splits)), format='fits',overwrite=True)
-        print('done!')
 
 class MySlave(Slave):
     """
@@ -120,10 +153,26 @@ class MySlave(Slave):
         rank = MPI.COMM_WORLD.Get_rank()
         name = MPI.Get_processor_name()
         task, task_arg = data
+        if task == 'merge':
+            fns, out_fn = task_arg
+            stream_concat(fns, out_fn)
+            remove_temporary(fns)
+            print('  Slave %s rank %d merged %d tables into %s' % (name, rank, len(fns), out_fn))
+            return out_fn
+        if MATCHER == 'prematched' and os.path.exists(get_prematched_fn(task_arg)):
+            print('  Slave %s rank %d prematched "%s" task_id "%d"' % (name, rank, task_arg, task) )
+            return (task, get_prematched_fn(task_arg))
         #FUNCTION CAN BE CHANGED HERE
-        sim = SV_brick_match(task_arg, NAME_FOR_RUN,RS_TYPE, name_for_randoms=NAME_FOR_RANDOMS, startid = START_ID, nobj =N_OBJ, MS_star=True)
+        sim = MATCHERS[MATCHER](task_arg, NAME_FOR_RUN,RS_TYPE, name_for_randoms=NAME_FOR_RANDOMS, startid = START_ID, nobj =N_OBJ, MS_star=True)
         print('  Slave %s rank %d executing "%s" task_id "%d"' % (name, rank, task_arg, task) )
-        return (task, sim)
+        if sim is None:
+            return (task, None)
+        fn = os.path.join(topdir_obiwan_out,'subset','bricks_%s_%s' % (NAME_FOR_RUN, RS_TYPE),
+                          'sim_%s.fits' % task_arg)
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+        sim.write(fn, format='fits', overwrite=True)
+        return (task, fn)
 
 def get_parser():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,description='Collection of production run data')
@@ -134,6 +183,9 @@ def get_parser():
     parser.add_argument('--start_id',type=int,required = True, help='startid in run')
     parser.add_argument('--rs_type',type=str,required = True,help='rs0 rs201 rs202')
     parser.add_argument('--name_for_randoms',type=str,required=True,help='dir name for original randoms')
+    parser.add_argument('--merge',type=str,default='stream',choices=['stream','tree'],help='stream: the master concatenates the per brick tables; tree: the slaves merge them --merge_fanin at a time first')
+    parser.add_argument('--merge_fanin',type=int,default=64,help='tables per merge with --merge tree')
+    parser.add_argument('--matcher',type=str,default='kdtree',choices=sorted(MATCHERS),help='kdtree: kd_brick_match, in brick pixels; skycoord: SV_brick_match, with astropy SkyCoord; prematched: the matched-BRICK.fits of kenobi.py --write_matched, kdtree for the bricks without one')
     args = parser.parse_args(args=None)
     print(args)
     return parser
@@ -177,6 +229,9 @@ def main(args=None):
     global N_OBJ
     global NAME_FOR_RANDOMS
     global RS_TYPE
+    global MERGE
+    global MERGE_FANIN
+    global MATCHER
     global topdir_obiwan_out
 
     split_idx = args.split_idx
@@ -187,6 +242,9 @@ def main(args=None):
     N_OBJ = args.n_obj
     NAME_FOR_RANDOMS = args.name_for_randoms
     RS_TYPE = args.rs_type
+    MERGE = args.merge
+    MERGE_FANIN = args.merge_fanin
+    MATCHER = args.matcher
     
     print('replacing:')
     BRICKPATH=BRICKPATH.replace('name_for_run',NAME_FOR_RUN)
@@ -0,0 +1,67 @@
+'''
+concatenating fits tables with one input table in memory at a time
+
+The inputs can have different columns or string widths (e.g. per brick
+outputs): the output has all the columns, with the widest type of each,
+and the missing ones are zero.
+'''
+import os
+import numpy as np
+import fitsio
+
+def get_dtype(fn):
+    with fitsio.FITS(fn) as F:
+        return F[1].get_rec_dtype()[0]
+
+def unify_dtypes(dtypes):
+    names = []
+    fields = {}
+    for dt in dtypes:
+        for name in dt.names:
+            t = dt.fields[name][0]
+            if name not in fields:
+                names.append(name)
+                fields[name] = t
+                continue
+            old = fields[name]
+            if old.shape != t.shape:
+                raise ValueError('column %s has shapes %s and %s' % (name, old.shape, t.shape))
+            base = np.promote_types(old.base, t.base)
+            fields[name] = np.dtype((base, old.shape)) if old.shape else base
+    return np.dtype([(name, fields[name]) for name in names])
+
+def convert(data, dtype):
+    # by column name, numpy's astype of structured arrays goes by position
+    out = np.zeros(len(data), dtype)
+    for name in data.dtype.names:
+        out[name] = data[name]
+    return out
+
+def stream_concat(fns, out_fn, remove=False):
+    '''
+    Concatenates the fits tables fns into out_fn, in this order
+
+    Args:
+        remove: delete the inputs once out_fn is written
+
+    Returns:
+        number of rows written
+    '''
+    if len(fns) == 0:
+        raise ValueError('no tables to write to %s' % out_fn)
+    dtype = unify_dtypes([get_dtype(fn) for fn in fns])
+    tmp_fn = out_fn + '.tmp'
+    nrows = 0
+    with fitsio.FITS(tmp_fn, 'rw', clobber=True) as out:
+        out.create_table_hdu(dtype=dtype)
+        for fn in fns:
+            data = fitsio.read(fn, ext=1)
+            if len(data) == 0:
+                continue
+            out[-1].append(convert(data, dtype))
+            nrows += len(data)
+    os.rename(tmp_fn, out_fn)
+    if remove:
+        for fn in fns:
+            os.remove(fn)
+    return nrows
@@ -209,7 +209,12 @@ def make_coadds(tims, bands, targetwcs,
                 callback=None, callback_args=None,
                 plots=False, ps=None,
                 lanczos=True, mp=None,
-                satur_val=10.):
+                satur_val=10., footprint=None):
+    '''
+    *footprint*: None, or list of (x0,x1,y0,y1) rectangles in
+    *targetwcs* pixels (see legacypipe.survey.footprint_rects); only
+    those pixels of the coadds are computed, the rest are left zero.
+    '''
     from astrometry.util.ttime import Time
     t0 = Time()
 
@@ -284,7 +289,7 @@ def make_coadds(tims, bands, targetwcs,
                 bmo = None
             else:
                 bmo = blobmods[itim]
-            args.append((itim,tim,mo,bmo,lanczos,targetwcs,sbscale))
+            args.append((itim,tim,mo,bmo,lanczos,targetwcs,sbscale,footprint))
         if mp is not None:
             imaps.append(mp.imap_unordered(_resample_one, args))
         else:
@@ -869,7 +874,11 @@ def _make_coadds_plots_1(im, band, mods, mo, iv, unweighted,
     allresids.append((tim.time.toYear(), tim.name, rgbimg,rgbmod,thisres))
 
 def _resample_one(args):
-    (itim,tim,mod,blobmod,lanczos,targetwcs,sbscale) = args
+    from legacypipe.survey import resample_with_footprint
+    (itim,tim,mod,blobmod,lanczos,targetwcs,sbscale,footprint) = args
+    if lanczos and mod is not None:
+        # eg, a SparseImage of sims; without lanczos it is only indexed
+        mod = np.asarray(mod)
     if lanczos:
         from astrometry.util.miscutils import patch_image
         patched = tim.getImage().copy()
@@ -886,8 +895,9 @@ def _resample_one(args):
         imgs = []
 
     try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
-            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+        Yo,Xo,Yi,Xi,rimgs = resample_with_footprint(
+            targetwcs, tim.subwcs, imgs, 3, footprint=footprint,
+            intType=np.int16)
     except OverlapError:
         return None
     if len(Yo) == 0:
@@ -1062,7 +1072,7 @@ def write_coadd_images(band,
 # Pretty much only used for plots; the real deal is make_coadds()
 def quick_coadds(tims, bands, targetwcs, images=None,
                  get_cow=False, get_n2=False, fill_holes=True, get_max=False,
-                 get_saturated=False):
+                 get_saturated=False, footprint=None):
 
     W = int(targetwcs.get_width())
     H = int(targetwcs.get_height())
@@ -1094,7 +1104,7 @@ def quick_coadds(tims, bands, targetwcs, images=None,
         for itim,tim in enumerate(tims):
             if tim.band != band:
                 continue
-            R = tim_get_resamp(tim, targetwcs)
+            R = tim_get_resamp(tim, targetwcs, footprint=footprint)
             if R is None:
                 continue
             (Yo,Xo,Yi,Xi) = R
@@ -1105,10 +1115,13 @@ def quick_coadds(tims, bands, targetwcs, images=None,
                 if get_max:
                     maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], tim.getImage()[Yi,Xi] * nn)
             else:
-                coimg [Yo,Xo] += images[itim][Yi,Xi] * nn
-                coimg2[Yo,Xo] += images[itim][Yi,Xi]
+                # eg, a SparseImage of sims, indexed tile by tile
+                image = images[itim][Yi,Xi]
+                coimg [Yo,Xo] += image * nn
+                coimg2[Yo,Xo] += image
                 if get_max:
-                    maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], images[itim][Yi,Xi] * nn)
+                    maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], image * nn)
+                del image
             con   [Yo,Xo] += nn
             if get_cow:
                 cowimg[Yo,Xo] += tim.getInvvar()[Yi,Xi] * tim.getImage()[Yi,Xi]
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os, warnings
+from collections import OrderedDict
 import numpy as np
 import fitsio
 from tractor.splinesky import SplineSky
@@ -910,18 +911,15 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
+            M = get_merged_calib(fn)
+            I = M.rows(self.expnum, self.ccdname)
             debug('Found', len(I), 'matching CCDs in merged sky file')
             if len(I) != 1:
                 continue
-            if not validate_version(
-                    fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+            if not M.validate(self.expnum, self.plver, self.plprocid,
+                              old_calibs_ok=old_calibs_ok):
                 raise RuntimeError('Sky file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = M.row(I[0])
         if Ti is None:
             raise RuntimeError('Failed to find sky model in files: %s' % ', '.join(tryfns))
 
@@ -990,18 +988,15 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
+            M = get_merged_calib(fn)
+            I = M.rows(self.expnum, self.ccdname)
             debug('Found', len(I), 'matching CCDs')
             if len(I) != 1:
                 continue
-            if not validate_version(
-                    fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+            if not M.validate(self.expnum, self.plver, self.plprocid,
+                              old_calibs_ok=old_calibs_ok):
                 raise RuntimeError('Merged PSFEx file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = M.row(I[0])
             break
         if Ti is None:
             raise RuntimeError('Failed to find PsfEx model in files: %s' % ', '.join(tryfns))
@@ -1799,6 +1794,56 @@ def fix_weight_quantization(wt, weightfn, ext, slc):
     wt[wt <= zscale[:,np.newaxis]*0.5] = 0.
     return True
 
+class MergedCalib(object):
+    '''
+    A merged (per-exposure) PSFEx or splinesky table, parsed once, with
+    its rows indexed by (expnum, ccdname) and the validate_version
+    results remembered.
+    '''
+    def __init__(self, fn):
+        self.fn = fn
+        self.mtime = os.path.getmtime(fn)
+        self.T = fits_table(fn)
+        self.index = {}
+        for i,(e,c) in enumerate(zip(self.T.expnum, self.T.ccdname)):
+            self.index.setdefault((int(e), str(c).strip()), []).append(i)
+        self.valid = {}
+
+    def rows(self, expnum, ccdname):
+        return self.index.get((int(expnum), ccdname.strip()), [])
+
+    def row(self, i):
+        # A copy: callers trim and modify the row's arrays.
+        return self.T[np.array([i])][0]
+
+    def validate(self, expnum, plver, plprocid, old_calibs_ok=False):
+        key = (expnum, plver, plprocid, old_calibs_ok)
+        if key not in self.valid:
+            self.valid[key] = validate_version(
+                self.fn, 'table', expnum, plver, plprocid, data=self.T,
+                old_calibs_ok=old_calibs_ok)
+        return self.valid[key]
+
+# Per-process cache of merged calib files: filename -> MergedCalib, least
+# recently used first; a brick reads a few hundred of them (PSFEx and sky
+# of each exposure), a process running many bricks keeps the latest ones.
+merged_calibs = OrderedDict()
+MAX_MERGED_CALIBS = 500
+
+def get_merged_calib(fn):
+    '''
+    Returns the (cached) MergedCalib for *fn*, re-reading it if the file
+    changed since.
+    '''
+    M = merged_calibs.get(fn)
+    if M is None or M.mtime != os.path.getmtime(fn):
+        M = MergedCalib(fn)
+        merged_calibs[fn] = M
+    merged_calibs.move_to_end(fn)
+    while len(merged_calibs) > MAX_MERGED_CALIBS:
+        merged_calibs.popitem(last=False)
+    return M
+
 def validate_version(fn, filetype, expnum, plver, plprocid,
                      data=None, ext=1, cpheader=False,
                      old_calibs_ok=False, quiet=False):
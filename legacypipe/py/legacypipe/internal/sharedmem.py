@@ -113,6 +113,7 @@ __all__ = ['set_debug', 'get_debug',
         'empty', 'empty_like', 
         'full', 'full_like',
         'copy',
+        'enable_named', 'named_copy', 'remove_named',
         ]
 
 import os
@@ -140,6 +141,7 @@ import numpy
 from multiprocessing import RawArray
 import ctypes
 import mmap
+import weakref
 #logger = multiprocessing.log_to_stderr()
 #logger.setLevel(multiprocessing.SUBDEBUG)
 
@@ -795,3 +797,169 @@ class anonymousmemmap(numpy.memmap):
         return __unpickle__, (self.__array_interface__, self.dtype)
 
 
+
+# Named shared memory segments, for passing large arrays between the
+# processes of a multiprocessing pool by name rather than by value.
+#
+# A segment is a file in SHM_DIR, memory mapped.  The process that calls
+# enable_named() (before forking its pool) owns the segments: it maps them
+# shared, and unlinks each once it no longer has arrays in it.  Its
+# workers create segments with named_copy(); sent back to the owner, only
+# (name, shape, dtype, strides, offset) is pickled.  The owner's arrays
+# are sent to workers the same way, and the workers map them copy-on-write,
+# so writing to them does not change the owner's.
+#
+# Pickles written by the owner's main thread (stage pickles, checkpoints)
+# hold the values: the pool pickles its tasks in another thread.
+
+SHM_DIR = '/dev/shm'
+
+_named = dict(owner=None, prefix=None, count=0)
+
+# owner: name -> _Segment, while the owner has arrays in it
+_owned_segments = weakref.WeakValueDictionary()
+
+def enable_named(shm_dir=None):
+    """ Makes this process the owner of the named segments; call before
+        forking the workers.  The segments left by dead owners (e.g. a
+        killed brick) are removed.
+    """
+    global SHM_DIR
+    if shm_dir is not None:
+        SHM_DIR = shm_dir
+    elif not os.path.isdir(SHM_DIR):
+        import tempfile
+        SHM_DIR = tempfile.gettempdir()
+    _named['owner'] = os.getpid()
+    _named['prefix'] = 'legacypipe-shm-%d-' % os.getpid()
+    remove_stale_named()
+
+def _pid_alive(pid):
+    import errno
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def remove_stale_named():
+    """ Unlinks the segments in SHM_DIR whose owner process is gone.
+    """
+    from glob import glob
+    for fn in glob(os.path.join(SHM_DIR, 'legacypipe-shm-*-*')):
+        try:
+            # legacypipe-shm-OWNER-PID-N, see named_copy
+            pid = int(os.path.basename(fn).split('-')[2])
+        except ValueError:
+            continue
+        if _pid_alive(pid):
+            continue
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+def named_enabled():
+    return _named['owner'] is not None
+
+def remove_named():
+    """ Unlinks the segments left (e.g. by a failed worker); the arrays
+        of this process stay valid, but can no longer be sent by name.
+    """
+    from glob import glob
+    if _named['prefix'] is None:
+        return
+    for fn in glob(os.path.join(SHM_DIR, _named['prefix'] + '*')):
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+class _Segment(object):
+    def __init__(self, name, nbytes=None):
+        self.name = name
+        self.fn = os.path.join(SHM_DIR, name)
+        self.owner = (os.getpid() == _named['owner'])
+        if nbytes is None:
+            fd = os.open(self.fn, os.O_RDWR)
+            nbytes = os.fstat(fd).st_size
+            # workers map the owner's segments copy-on-write
+            access = mmap.ACCESS_WRITE if self.owner else mmap.ACCESS_COPY
+            self.created = False
+        else:
+            fd = os.open(self.fn, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            nbytes = max(nbytes, 1)
+            os.ftruncate(fd, nbytes)
+            access = mmap.ACCESS_WRITE
+            self.created = True
+        try:
+            self.mm = mmap.mmap(fd, nbytes, access=access)
+        finally:
+            os.close(fd)
+        self.nbytes = nbytes
+        self.address = numpy.frombuffer(self.mm, numpy.uint8).ctypes.data
+
+    def sendable(self):
+        # copy-on-write mappings may hold changes the others cannot see
+        return self.owner or self.created
+
+    def __del__(self):
+        if self.owner:
+            try:
+                os.unlink(self.fn)
+            except OSError:
+                pass
+
+def _attach_named(name, shape, dtype, strides, offset):
+    seg = _owned_segments.get(name)
+    if seg is None:
+        seg = _Segment(name)
+        if seg.owner:
+            _owned_segments[name] = seg
+    a = numpy.ndarray(shape, dtype, buffer=seg.mm, offset=offset,
+                      strides=strides).view(namedmemmap)
+    a._segment = seg
+    return a
+
+def named_copy(a):
+    """ Copy of array a in a new named segment, if enable_named() was
+        called (in this process or before the fork), else a itself.
+    """
+    if not named_enabled():
+        return a
+    a = numpy.asarray(a)
+    _named['count'] += 1
+    name = '%s%d-%d' % (_named['prefix'], os.getpid(), _named['count'])
+    seg = _Segment(name, a.nbytes)
+    if seg.owner:
+        _owned_segments[name] = seg
+    out = numpy.ndarray(a.shape, a.dtype, buffer=seg.mm).view(namedmemmap)
+    out._segment = seg
+    out[...] = a
+    return out
+
+class namedmemmap(numpy.ndarray):
+    """ Array (or view of one) in a named segment, see named_copy().
+    """
+    def __array_finalize__(self, obj):
+        seg = getattr(obj, '_segment', None)
+        if seg is not None:
+            # only views into the segment keep it
+            addr = self.__array_interface__['data'][0]
+            if not (seg.address <= addr < seg.address + seg.nbytes):
+                seg = None
+        self._segment = seg
+
+    def __array_wrap__(self, outarr, *args):
+        # after ufunc this won't be on shm!
+        return numpy.ndarray.__array_wrap__(self.view(numpy.ndarray), outarr, *args)
+
+    def __reduce__(self):
+        seg = self._segment
+        if (seg is None or not seg.sendable() or
+            (os.getpid() == _named['owner'] and
+             threading.current_thread() is threading.main_thread())):
+            return self.view(numpy.ndarray).__reduce__()
+        offset = self.__array_interface__['data'][0] - seg.address
+        return _attach_named, (seg.name, self.shape, self.dtype,
+                               self.strides, offset)
@@ -96,7 +96,11 @@ def read_outlier_mask_file(survey, tims, brickname, subimage=True, output=True,
 
 def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_header,
                         mp=None, plots=False, ps=None, make_badcoadds=True,
-                        refstars=None):
+                        refstars=None, footprint=None):
+    '''
+    *footprint*: None, or list of (x0,x1,y0,y1) rectangles in
+    *targetwcs* pixels; outliers are only searched for there.
+    '''
     from legacypipe.bits import DQ_BITS
     from scipy.ndimage.morphology import binary_dilation
 
@@ -163,7 +167,8 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
             cow   = np.zeros((H,W), np.float32)
             masks = np.zeros((H,W), np.int16)
 
-            R = mp.map(blur_resample_one, [(tim,sig,targetwcs) for tim,sig in zip(btims,addsigs)])
+            R = mp.map(blur_resample_one, [(tim,sig,targetwcs,footprint)
+                                           for tim,sig in zip(btims,addsigs)])
             for tim,r in zip(btims, R):
                 if r is None:
                     continue
@@ -187,7 +192,8 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
             #     plt.title('SATUR, BLEED veto (%s band)' % band)
             #     ps.savefig()
 
-            R = mp.map(compare_one, [(tim, sig, targetwcs, coimg,cow, veto, make_badcoadds, plots,ps)
+            R = mp.map(compare_one, [(tim, sig, targetwcs, coimg,cow, veto, make_badcoadds, plots,ps,
+                                      footprint)
                                      for tim,sig in zip(btims,addsigs)])
             del coimg, cow, veto
 
@@ -253,9 +259,10 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
 def compare_one(X):
     from scipy.ndimage.filters import gaussian_filter
     from scipy.ndimage.morphology import binary_dilation
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.survey import resample_with_footprint
 
-    (tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps) = X
+    (tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps,footprint) = X
 
     if plots:
         import pylab as plt
@@ -264,8 +271,8 @@ def compare_one(X):
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = resample_with_footprint(
+            targetwcs, tim.subwcs, [img], footprint=footprint, intType=np.int16)
     except OverlapError:
         return None
     del img
@@ -407,8 +414,9 @@ def compare_one(X):
     # Actually do the masking!
     # Resample "hot" (in brick coords) back to tim coords.
     try:
-        mYo,mXo,mYi,mXi,_ = resample_with_wcs(
-            tim.subwcs, targetwcs, intType=np.int16)
+        mYo,mXo,mYi,mXi,_ = resample_with_footprint(
+            tim.subwcs, targetwcs, footprint=footprint, footprint_on_input=True,
+            intType=np.int16)
     except OverlapError:
         return None
     Ibad, = np.nonzero(hot[mYi,mXi])
@@ -422,14 +430,15 @@ def compare_one(X):
 
 def blur_resample_one(X):
     from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.survey import resample_with_footprint
 
-    tim,sig,targetwcs = X
+    tim,sig,targetwcs,footprint = X
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = resample_with_footprint(
+            targetwcs, tim.subwcs, [img], footprint=footprint, intType=np.int16)
     except OverlapError:
         return None
     del img
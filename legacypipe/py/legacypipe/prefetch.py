@@ -0,0 +1,170 @@
+'''
+Staging of the input files of upcoming bricks into a node-local cache.
+
+LegacySurveyData(cache_dir=...).check_cache() reads a file from
+cache_dir, at the same path relative to survey_dir, when it is there.
+InputStager fills cache_dir: given the bricks about to run on the node, it
+copies their CCD images, weight and DQ maps and merged PSFEx and splinesky
+calibs there in a background thread, while the current bricks compute.
+
+Files shared by several bricks (every CCD of an exposure is in the same
+image and calib files) are copied once. The cache is kept under a size
+budget by removing the least recently staged files (by modification time,
+refreshed each time a brick asks for a file) that none of the latest
+bricks need.
+'''
+import os
+import shutil
+import threading
+from collections import deque
+
+import logging
+logger = logging.getLogger('legacypipe.prefetch')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def brick_input_files(survey, brickname):
+    '''
+    Returns the list of existing input files (under survey.survey_dir) of
+    the CCDs touching the brick.
+    '''
+    from legacypipe.survey import wcs_for_brick
+    brick = survey.get_brick_by_name(brickname)
+    if brick is None:
+        return []
+    ccds = survey.ccds_touching_wcs(wcs_for_brick(brick))
+    if ccds is None:
+        return []
+    I = survey.ccds_for_fitting(brick, ccds)
+    if I is not None:
+        ccds.cut(I)
+    fns = []
+    seen = set()
+    for ccd in ccds:
+        im = survey.get_image_object(ccd)
+        for key in im.get_cacheable_filename_variables():
+            fn = getattr(im, key, None)
+            if fn is None or fn in seen:
+                continue
+            seen.add(fn)
+            if fn.startswith(survey.survey_dir) and os.path.exists(fn):
+                fns.append(fn)
+    return fns
+
+class InputStager(object):
+    '''
+    Copies the input files of the bricks given to stage() into
+    *cache_dir*, one brick after the other in a background thread.
+
+    *budget*: maximum size of the cache, in bytes.
+    *keep*: number of latest bricks whose files are never evicted (those
+    running and about to run).
+    '''
+    def __init__(self, survey, cache_dir, budget, keep=16):
+        self.survey = survey
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.recent = deque(maxlen=keep)
+        self.queue = deque()
+        self.queued = set()
+        self.cond = threading.Condition()
+        # cached filename -> size, for the files in the cache
+        self.sizes = {}
+        for dirpath,_,fns in os.walk(cache_dir):
+            for fn in fns:
+                fn = os.path.join(dirpath, fn)
+                self.sizes[fn] = os.path.getsize(fn)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stage(self, bricknames):
+        '''
+        Queues the bricks (in order) for staging.
+        '''
+        with self.cond:
+            for b in bricknames:
+                if b in self.queued:
+                    continue
+                self.queued.add(b)
+                self.queue.append(b)
+            self.cond.notify()
+
+    def cached_filename(self, fn):
+        # as LegacySurveyData.check_cache()
+        return fn.replace(self.survey.survey_dir, self.cache_dir)
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                brickname = self.queue.popleft()
+            try:
+                self.stage_brick(brickname)
+            except Exception as e:
+                # staging only saves time; the bricks read the originals
+                info('Failed to stage the inputs of brick', brickname, ':', e)
+
+    def stage_brick(self, brickname):
+        fns = brick_input_files(self.survey, brickname)
+        cfns = [self.cached_filename(fn) for fn in fns]
+        self.recent.append(set(cfns))
+        ncopied = 0
+        for fn,cfn in zip(fns, cfns):
+            if os.path.exists(cfn):
+                # most recently used
+                os.utime(cfn, None)
+                self.sizes.setdefault(cfn, os.path.getsize(cfn))
+                continue
+            size = os.path.getsize(fn)
+            if not self.make_room(size):
+                info('Input cache', self.cache_dir, 'is full, not staging', fn)
+                continue
+            dirnm = os.path.dirname(cfn)
+            if not os.path.exists(dirnm):
+                os.makedirs(dirnm, exist_ok=True)
+            # copy and rename, so readers only see complete files
+            tmpfn = cfn + '.tmp-%i' % os.getpid()
+            shutil.copyfile(fn, tmpfn)
+            os.rename(tmpfn, cfn)
+            self.sizes[cfn] = size
+            ncopied += 1
+        debug('Staged brick', brickname, ':', ncopied, 'of', len(fns),
+              'input files copied to', self.cache_dir)
+
+    def make_room(self, size):
+        '''
+        Evicts the least recently used files not needed by the latest
+        bricks until *size* more bytes fit in the budget; returns whether
+        they do.
+        '''
+        used = self.used()
+        if used + size <= self.budget:
+            return True
+        pinned = set.union(set(), *self.recent)
+        lru = []
+        for cfn in self.sizes:
+            if cfn in pinned:
+                continue
+            try:
+                lru.append((os.path.getmtime(cfn), cfn))
+            except OSError:
+                lru.append((0, cfn))
+        lru.sort()
+        for _,cfn in lru:
+            if used + size <= self.budget:
+                break
+            try:
+                os.remove(cfn)
+            except OSError:
+                pass
+            used -= self.sizes.pop(cfn)
+        return used + size <= self.budget
@@ -293,24 +293,7 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                       +' on PLVER "%s"') % (str(tim), tim.plver, cal, ver[1]))
 
     # Add additional columns to the CCDs table.
-    ccds.ccd_x0 = np.array([tim.x0 for tim in tims]).astype(np.int16)
-    ccds.ccd_y0 = np.array([tim.y0 for tim in tims]).astype(np.int16)
-    ccds.ccd_x1 = np.array([tim.x0 + tim.shape[1]
-                            for tim in tims]).astype(np.int16)
-    ccds.ccd_y1 = np.array([tim.y0 + tim.shape[0]
-                            for tim in tims]).astype(np.int16)
-    rd = np.array([[tim.subwcs.pixelxy2radec(1, 1)[-2:],
-                    tim.subwcs.pixelxy2radec(1, y1-y0)[-2:],
-                    tim.subwcs.pixelxy2radec(x1-x0, 1)[-2:],
-                    tim.subwcs.pixelxy2radec(x1-x0, y1-y0)[-2:]]
-                    for tim,x0,y0,x1,y1 in
-                    zip(tims, ccds.ccd_x0+1, ccds.ccd_y0+1,
-                        ccds.ccd_x1, ccds.ccd_y1)])
-    _,x,y = targetwcs.radec2pixelxy(rd[:,:,0], rd[:,:,1])
-    ccds.brick_x0 = np.floor(np.min(x, axis=1)).astype(np.int16)
-    ccds.brick_x1 = np.ceil (np.max(x, axis=1)).astype(np.int16)
-    ccds.brick_y0 = np.floor(np.min(y, axis=1)).astype(np.int16)
-    ccds.brick_y1 = np.ceil (np.max(y, axis=1)).astype(np.int16)
+    set_ccd_extents(ccds, tims, targetwcs)
     ccds.psfnorm = np.array([tim.psfnorm for tim in tims])
     ccds.galnorm = np.array([tim.galnorm for tim in tims])
     ccds.propid = np.array([tim.propid for tim in tims])
@@ -357,6 +340,30 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
     rtn = dict([(k,L[k]) for k in keys])
     return rtn
 
+def set_ccd_extents(ccds, tims, targetwcs):
+    '''
+    Sets the ccd_{x,y}{0,1} (pixels of the CCD) and brick_{x,y}{0,1}
+    (pixels of the brick) extent columns of the *ccds* rows of *tims*.
+    '''
+    ccds.ccd_x0 = np.array([tim.x0 for tim in tims]).astype(np.int16)
+    ccds.ccd_y0 = np.array([tim.y0 for tim in tims]).astype(np.int16)
+    ccds.ccd_x1 = np.array([tim.x0 + tim.shape[1]
+                            for tim in tims]).astype(np.int16)
+    ccds.ccd_y1 = np.array([tim.y0 + tim.shape[0]
+                            for tim in tims]).astype(np.int16)
+    rd = np.array([[tim.subwcs.pixelxy2radec(1, 1)[-2:],
+                    tim.subwcs.pixelxy2radec(1, y1-y0)[-2:],
+                    tim.subwcs.pixelxy2radec(x1-x0, 1)[-2:],
+                    tim.subwcs.pixelxy2radec(x1-x0, y1-y0)[-2:]]
+                    for tim,x0,y0,x1,y1 in
+                    zip(tims, ccds.ccd_x0+1, ccds.ccd_y0+1,
+                        ccds.ccd_x1, ccds.ccd_y1)])
+    _,x,y = targetwcs.radec2pixelxy(rd[:,:,0], rd[:,:,1])
+    ccds.brick_x0 = np.floor(np.min(x, axis=1)).astype(np.int16)
+    ccds.brick_x1 = np.ceil (np.max(x, axis=1)).astype(np.int16)
+    ccds.brick_y0 = np.floor(np.min(y, axis=1)).astype(np.int16)
+    ccds.brick_y1 = np.ceil (np.max(y, axis=1)).astype(np.int16)
+
 def _add_stage_version(version_header, short, stagename):
     from legacypipe.survey import get_git_version
     version_header.add_record(dict(name='VER_%s'%short, value=get_git_version(),
@@ -447,11 +454,58 @@ def stage_refs(survey=None,
     rtn = dict([(k,L[k]) for k in keys])
     return rtn
 
+def _get_footprint(targetwcs, footprint_margin=None, blobxy=None, blobradec=None,
+                   blobmap=None):
+    '''
+    Returns the footprint -- list of (x0,x1,y0,y1) rectangles in
+    *targetwcs* pixels -- that the outliers, coadds and WISE stages are
+    restricted to when *footprint_margin* is set and only some blobs
+    are fit (*blobxy* or *blobradec*).  The rectangles surround the
+    fit blobs in *blobmap*, or the *blobxy* / *blobradec* pixels before
+    the blobs exist, grown by *footprint_margin* pixels.
+
+    Before the blobs exist (stage_outliers, stage_image_coadds) the
+    footprint is only an approximation of the fit blobs, which is right
+    when *footprint_margin* exceeds the largest blob radius; given
+    *blobmap*, the fit blobs reaching outside that approximation are
+    reported.
+
+    Returns None (no restriction) otherwise.
+    '''
+    from legacypipe.survey import footprint_rects
+    if footprint_margin is None or (blobxy is None and blobradec is None):
+        return None
+    H,W = targetwcs.shape
+    if blobmap is not None:
+        from scipy.ndimage.measurements import find_objects
+        boxes = [(sx.start, sx.stop, sy.start, sy.stop)
+                 for sy,sx in [s for s in find_objects(blobmap + 1) if s is not None]]
+        approx = _get_footprint(targetwcs, footprint_margin, blobxy, blobradec)
+        nout = len([1 for x0,x1,y0,y1 in boxes
+                    if not any([ax0 <= x0 and x1 <= ax1 and ay0 <= y0 and y1 <= ay1
+                                for ax0,ax1,ay0,ay1 in approx])])
+        if nout:
+            info('Warning:', nout, 'of', len(boxes), 'fit blobs reach beyond the',
+                 'footprint_margin =', footprint_margin, 'footprint used by the',
+                 'outliers and image_coadds stages; use a margin larger than',
+                 'the largest blob radius')
+    else:
+        if blobradec is not None:
+            rd = np.array(blobradec)
+            _,x,y = targetwcs.radec2pixelxy(rd[:,0], rd[:,1])
+            blobxy = list(zip(x - 1, y - 1))
+        boxes = [(x, x+1, y, y+1) for x,y in blobxy]
+    fp = footprint_rects(boxes, W, H, margin=footprint_margin)
+    info('Restricting to a footprint of', len(fp), 'rectangles,',
+         sum([(x1-x0)*(y1-y0) for x0,x1,y0,y1 in fp]), 'of', W*H, 'pixels')
+    return fp
+
 def stage_outliers(tims=None, targetwcs=None, W=None, H=None, bands=None,
                    mp=None, nsigma=None, plots=None, ps=None, record_event=None,
                    survey=None, brickname=None, version_header=None,
                    refstars=None, outlier_mask_file=None,
                    outliers=True, cache_outliers=False,
+                   footprint_margin=None, blobxy=None, blobradec=None,
                    **kwargs):
     '''This pipeline stage tries to detect artifacts in the individual
     exposures, by blurring all images in the same band to the same PSF size,
@@ -475,8 +529,10 @@ def stage_outliers(tims=None, targetwcs=None, W=None, H=None, bands=None,
     if (outliers and
         not (cache_outliers and
              read_outlier_mask_file(survey, tims, brickname, outlier_mask_file=outlier_mask_file))):
+        footprint = _get_footprint(targetwcs, footprint_margin, blobxy, blobradec)
         # Make before-n-after plots (before)
-        C = make_coadds(tims, bands, targetwcs, mp=mp, sbscale=False)
+        C = make_coadds(tims, bands, targetwcs, mp=mp, sbscale=False,
+                        footprint=footprint)
         with survey.write_output('outliers-pre', brick=brickname) as out:
             imsave_jpeg(out.fn, get_rgb(C.coimgs, bands), origin='lower')
 
@@ -487,10 +543,11 @@ def stage_outliers(tims=None, targetwcs=None, W=None, H=None, bands=None,
         make_badcoadds = True
         badcoaddspos, badcoaddsneg = mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_header,
                                                          mp=mp, plots=plots, ps=ps, make_badcoadds=make_badcoadds,
-                                                         refstars=refstars)
+                                                         refstars=refstars, footprint=footprint)
 
         # Make before-n-after plots (after)
-        C = make_coadds(tims, bands, targetwcs, mp=mp, sbscale=False)
+        C = make_coadds(tims, bands, targetwcs, mp=mp, sbscale=False,
+                        footprint=footprint)
         with survey.write_output('outliers-post', brick=brickname) as out:
             imsave_jpeg(out.fn, get_rgb(C.coimgs, bands), origin='lower')
         with survey.write_output('outliers-masked-pos', brick=brickname) as out:
@@ -548,6 +605,7 @@ def stage_image_coadds(survey=None, targetwcs=None, bands=None, tims=None,
                        T_clusters=None,
                        saturated_pix=None,
                        less_masking=False,
+                       footprint_margin=None, blobxy=None, blobradec=None,
                        **kwargs):
     record_event and record_event('stage_image_coadds: starting')
     '''
@@ -559,12 +617,13 @@ def stage_image_coadds(survey=None, targetwcs=None, bands=None, tims=None,
     with survey.write_output('ccds-table', brick=brickname) as out:
         ccds.writeto(None, fits_object=out.fits, primheader=version_header)
 
+    footprint = _get_footprint(targetwcs, footprint_margin, blobxy, blobradec)
     C = make_coadds(tims, bands, targetwcs,
                     detmaps=True, ngood=True, lanczos=lanczos,
                     callback=write_coadd_images,
                     callback_args=(survey, brickname, version_header, tims,
                                    targetwcs, co_sky),
-                    mp=mp, plots=plots, ps=ps)
+                    mp=mp, plots=plots, ps=ps, footprint=footprint)
 
     # interim maskbits
     from legacypipe.utils import copy_header_with_wcs
@@ -600,7 +659,8 @@ def stage_image_coadds(survey=None, targetwcs=None, bands=None, tims=None,
     # Sims: coadds of galaxy sims only, image only
     if hasattr(tims[0], 'sims_image'):
         sims_coadd,_ = quick_coadds(
-            tims, bands, targetwcs, images=[tim.sims_image for tim in tims])
+            tims, bands, targetwcs, images=[tim.sims_image for tim in tims],
+            footprint=footprint)
     
 
     # obiwan  
@@ -1135,16 +1195,21 @@ def stage_fitblobs(T=None,
         last_checkpoint = CpuMeas()
         n_finished = 0
         n_finished_total = 0
+        global _checkpoint_requested
         while True:
             import multiprocessing
             # Time to write a checkpoint file? (And have something to write?)
             tnow = CpuMeas()
             dt = tnow.wall_seconds_since(last_checkpoint)
-            if dt >= checkpoint_period and n_finished > 0:
+            if ((dt >= checkpoint_period or _checkpoint_requested)
+                and n_finished > 0):
                 # Write checkpoint!
                 debug('Writing', n_finished, 'new results; total for this run', n_finished_total)
                 try:
                     _write_checkpoint(R, checkpoint_filename)
+                    if _checkpoint_requested:
+                        info('Wrote requested checkpoint with', len(R), 'results')
+                    _checkpoint_requested = False
                     last_checkpoint = tnow
                     dt = 0.
                     n_finished = 0
@@ -1155,7 +1220,8 @@ def stage_fitblobs(T=None,
             # Wait for results (with timeout)
             try:
                 if mp.pool is not None:
-                    timeout = max(1, checkpoint_period - dt)
+                    # wake up now and then to notice a request_checkpoint
+                    timeout = max(1, min(checkpoint_period - dt, 30))
                     r = Riter.next(timeout)
                 else:
                     r = next(Riter)
@@ -1480,6 +1546,19 @@ def _get_bailout_mask(blobmap, skipblobs, targetwcs, W, H, brick, blobslices):
     bailout_mask = bmap[blobmap+1]
     return bailout_mask
 
+# Set by request_checkpoint: stage_fitblobs writes its checkpoint file
+# right away instead of waiting for checkpoint_period.
+_checkpoint_requested = False
+
+def request_checkpoint(signum=None, frame=None):
+    '''
+    Asks a running stage_fitblobs to write its checkpoint file now, e.g.
+    before the batch job runs out of time.  run_brick installs it as the
+    SIGUSR1 handler when checkpointing.
+    '''
+    global _checkpoint_requested
+    _checkpoint_requested = True
+
 def _write_checkpoint(R, checkpoint_filename):
     from astrometry.util.file import pickle_to_file, trymakedirs
     d = os.path.dirname(checkpoint_filename)
@@ -1490,6 +1569,77 @@ def _write_checkpoint(R, checkpoint_filename):
     os.rename(fn, checkpoint_filename)
     debug('Wrote checkpoint to', checkpoint_filename)
 
+def _write_stage_checkpoint(R, fn):
+    '''
+    Writes the state after a stage as a gzipped pickle (see --in-memory).
+
+    This is the whole state (tims, blobs, catalog, ...) in one stream,
+    written and read back in full, so it costs about as much time and
+    memory as the regular stage pickles; write it only for the stages
+    that are worth restarting from.
+    '''
+    import gzip
+    import pickle
+    from astrometry.util.file import trymakedirs
+    d = os.path.dirname(fn)
+    if len(d) and not os.path.exists(d):
+        trymakedirs(d)
+    tmpfn = fn + '.tmp'
+    with gzip.open(tmpfn, 'wb', compresslevel=1) as f:
+        pickle.dump(R, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfn, fn)
+    info('Wrote stage checkpoint', fn)
+
+def _read_stage_checkpoint(fn):
+    import gzip
+    import pickle
+    info('Reading stage checkpoint', fn)
+    with gzip.open(fn, 'rb') as f:
+        return pickle.load(f)
+
+def _runstage_in_memory(stage, pickle_pat, stagefunc, prereqs={},
+                        initial_args={}, force=[], forceall=False,
+                        write=False, done=None, **kwargs):
+    '''
+    Like astrometry.util.stages.runstage, but the results of the stages
+    are only passed along in memory.  Checkpoints (gzipped pickles,
+    *pickle_pat* + '.gz') are written only for the stages in *write*
+    (or all stages if *write* is True), and read only when the results
+    of that stage are needed, ie, for the latest checkpointed stage.
+
+    *done*: dict, stage -> results, of the stages already run; when
+    several stages are requested in a row (with the same dict), their
+    common prerequisites are run only once.
+    '''
+    if done is not None and stage in done:
+        return done[stage]
+    fn = (pickle_pat % dict(stage=stage)) + '.gz'
+    if os.path.exists(fn) and not (forceall or stage in force):
+        P = _read_stage_checkpoint(fn)
+        if done is not None:
+            done[stage] = P
+        return P
+
+    prereq = prereqs.get(stage, None)
+    if prereq is None:
+        P = initial_args.copy()
+    else:
+        # a copy: the prereq's results may be in *done*
+        P = _runstage_in_memory(prereq, pickle_pat, stagefunc, prereqs=prereqs,
+                                initial_args=initial_args, force=force,
+                                forceall=forceall, write=write, done=done,
+                                **kwargs).copy()
+    Px = P.copy()
+    Px.update(kwargs)
+    R = stagefunc(stage, **Px)
+    if R is not None:
+        P.update(R)
+    if (write is True) or (write and stage in write):
+        _write_stage_checkpoint(P, fn)
+    if done is not None:
+        done[stage] = P
+    return P
+
 def _check_checkpoints(R, blobslices, brickname):
     # Check that checkpointed blobids match our current set of blobs,
     # based on blob bounding-box.  This can fail if the code changes
@@ -1683,15 +1833,17 @@ def _get_mod(X):
     return mod
 
 def _get_both_mods(X):
-    from astrometry.util.resample import resample_with_wcs, OverlapError
+    from astrometry.util.resample import OverlapError
     from astrometry.util.miscutils import get_overlapping_region
-    (tim, srcs, srcblobs, blobmap, targetwcs, frozen_galaxies, ps, plots) = X
+    from legacypipe.survey import resample_with_footprint
+    (tim, srcs, srcblobs, blobmap, targetwcs, frozen_galaxies, ps, plots, footprint) = X
     mod = np.zeros(tim.getModelShape(), np.float32)
     blobmod = np.zeros(tim.getModelShape(), np.float32)
     assert(len(srcs) == len(srcblobs))
     ### modelMasks during fitblobs()....?
     try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(tim.subwcs, targetwcs)
+        Yo,Xo,Yi,Xi,_ = resample_with_footprint(tim.subwcs, targetwcs, footprint=footprint,
+                                                footprint_on_input=True)
     except OverlapError:
         return None,None
     timblobmap = np.empty(mod.shape, blobmap.dtype)
@@ -1811,11 +1963,15 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                  bailout_mask=None,
                  mp=None,
                  record_event=None,
+                 footprint_margin=None, blobxy=None, blobradec=None,
                  **kwargs):
     '''
     After the `stage_fitblobs` fitting stage, we have all the source
     model fits, and we can create coadds of the images, model, and
     residuals.  We also perform aperture photometry in this stage.
+
+    With *footprint_margin*, the coadds are only computed around the
+    fit blobs (see `_get_footprint`) and are zero elsewhere.
     '''
     from functools import reduce
     from legacypipe.survey import apertures_arcsec
@@ -1823,6 +1979,8 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
     record_event and record_event('stage_coadds: starting')
     _add_stage_version(version_header, 'COAD', 'coadds')
     tlast = Time()
+    footprint = _get_footprint(targetwcs, footprint_margin, blobxy, blobradec,
+                               blobmap=blobmap)
     
     #obiwan
     # Coadd of simulated galaxies
@@ -1830,7 +1988,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
         sims_mods = [tim.sims_image for tim in tims]
         T_sims_coadds = make_coadds(tims, bands, targetwcs, mods=sims_mods,
                 lanczos=lanczos, mp=mp,callback=write_coadd_images, callback_args=(survey, brickname, version_header, tims,
-                    targetwcs,co_sky))
+                    targetwcs,co_sky), footprint=footprint)
         sims_coadd = T_sims_coadds.comods
         del T_sims_coadds
         for band in bands:
@@ -1903,7 +2061,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
     Ireg = np.flatnonzero(T.regular)
     Nreg = len(Ireg)
     bothmods = mp.map(_get_both_mods, [(tim, [cat[i] for i in Ireg], T.blob[Ireg], blobmap,
-                                        targetwcs, frozen_galaxies, ps, plots)
+                                        targetwcs, frozen_galaxies, ps, plots, footprint)
                                        for tim in tims])
     mods     = [r[0] for r in bothmods]
     blobmods = [r[1] for r in bothmods]
@@ -1934,19 +2092,19 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                     callback=write_coadd_images,
                     callback_args=(survey, brickname, version_header, tims,
                                    targetwcs, co_sky),
-                    plots=plots, ps=ps, mp=mp)
+                    plots=plots, ps=ps, mp=mp, footprint=footprint)
     record_event and record_event('stage_coadds: extras')
 
     # Coadds of galaxy sims only, image only
     if hasattr(tims[0], 'sims_image'):
         sims_mods = [tim.sims_image for tim in tims]
         T_sims_coadds = make_coadds(tims, bands, targetwcs, mods=sims_mods,
-                                    lanczos=lanczos, mp=mp)
+                                    lanczos=lanczos, mp=mp, footprint=footprint)
         sims_coadd = T_sims_coadds.comods
         del T_sims_coadds
         image_only_mods= [tim.data-tim.sims_image for tim in tims]
         make_coadds(tims, bands, targetwcs, mods=image_only_mods,
-                    lanczos=lanczos, mp=mp)
+                    lanczos=lanczos, mp=mp, footprint=footprint)
     ###
 
     # Save per-source measurements of the maps produced during coadding
@@ -2361,10 +2519,15 @@ def stage_wise_forced(
     record_event=None,
     ps=None,
     plots=False,
+    footprint_margin=None, blobxy=None, blobradec=None, blobmap=None,
     **kwargs):
     '''
     After the model fits are finished, we can perform forced
     photometry of the unWISE coadds.
+
+    With *footprint_margin*, only the sources and the unWISE pixels
+    within the footprint of the fit blobs (see `_get_footprint`) are
+    used.
     '''
     from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs
     from legacypipe.survey import wise_apertures_arcsec
@@ -2385,6 +2548,21 @@ def stage_wise_forced(
     # Sources to photometer
     do_phot = T.regular.copy()
 
+    footprint = _get_footprint(targetwcs, footprint_margin, blobxy, blobradec,
+                               blobmap=blobmap)
+    if footprint is not None:
+        fx0 = min([r[0] for r in footprint])
+        fx1 = max([r[1] for r in footprint])
+        fy0 = min([r[2] for r in footprint])
+        fy1 = max([r[3] for r in footprint])
+        r0,d0 = targetwcs.pixelxy2radec(fx0+1, fy0+1)
+        r1,d1 = targetwcs.pixelxy2radec(fx1, fy1)
+        roiradec = [r0, r1, d0, d1]
+        infp = np.zeros(len(T), bool)
+        for x0,x1,y0,y1 in footprint:
+            infp |= ((T.bx >= x0) * (T.bx < x1) * (T.by >= y0) * (T.by < y1))
+        do_phot *= infp
+
     # Drop sources within the CLUSTER mask from forced photometry.
     Icluster = None
     if maskbits is not None:
@@ -2930,6 +3108,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               bands=None,
               allbands='grz',
               nblobs=None, blob=None, blobxy=None, blobradec=None, blobid=None,
+              footprint_margin=None,
               max_blobsize=None,
               nsigma=6,
               saddle_fraction=0.1,
@@ -2982,6 +3161,8 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               pickle_pat='pickles/runbrick-%(brick)s-%%(stage)s.pickle',
               stages=None,
               force=None, forceall=False, write_pickles=True,
+              in_memory=False,
+              shared_tims=False,
               checkpoint_filename=None,
               checkpoint_period=None,
               prereqs_update=None,
@@ -3046,6 +3227,13 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
       containing these pixels.
     - *blobradec*: list of (RA,Dec) tuples; only run the blobs
       containing these coordinates.
+    - *footprint_margin*: None or int; with *blobxy* or *blobradec*,
+      restrict the outliers, image_coadds, coadds and wise_forced stages
+      to within this many pixels of the blobs being fit.  Coadd images
+      are zero outside; sources outside get no WISE photometry.  The
+      outliers and image_coadds stages run before the blobs exist and
+      use boxes of this margin around *blobxy* / *blobradec* instead,
+      so it must exceed the largest blob radius.
 
     Other options:
 
@@ -3110,6 +3298,14 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
       even if pickle files exist.
     - *forceall*: boolean; run all stages, ignoring all pickle files.
     - *write_pickles*: boolean; write pickle files after each stage?
+      Or list of strings; stages to write pickle files for.
+    - *in_memory*: boolean; pass the stage results along in memory only,
+      reading and writing gzipped pickles (*pickle_pat* + '.gz') only for
+      the stages in *write_pickles*.  Each of them holds the whole state
+      after its stage, written and read in one piece.
+    - *shared_tims*: boolean; the pool workers put the tim pixels in named
+      shared memory, and the tims go to and from the workers by name
+      (see legacypipe.internal.sharedmem.named_copy).
 
     Raises
     ------
@@ -3232,6 +3428,19 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         kwargs.update(checkpoint_filename=checkpoint_filename)
         if checkpoint_period is not None:
             kwargs.update(checkpoint_period=checkpoint_period)
+        # "kill -USR1" writes the fitblobs checkpoint; set before the pool
+        # forks, so that a USR1 to the process group does not kill the workers
+        import signal
+        try:
+            signal.signal(signal.SIGUSR1, request_checkpoint)
+        except ValueError:
+            # not the main thread
+            pass
+
+    if shared_tims:
+        # before the pool forks: the workers' segments come back to us
+        from legacypipe.internal.sharedmem import enable_named
+        enable_named()
 
     if threads and threads > 1:
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
@@ -3252,9 +3461,12 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
     if blob is not None:
         kwargs.update(blob0=blob)
     if blobxy is not None:
-        kwargs.update(blobxy=blobxy)
+        # a list, since several stages look at it
+        kwargs.update(blobxy=list(blobxy))
     if blobradec is not None:
         kwargs.update(blobradec=blobradec)
+    if footprint_margin is not None:
+        kwargs.update(footprint_margin=footprint_margin)
     if blobid is not None:
         kwargs.update(blobid=blobid)
     if max_blobsize is not None:
@@ -3366,9 +3578,29 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     t0 = StageTime()
     R = None
-    for stage in stages:
-        R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
-                     initial_args=initargs, **kwargs)
+    # results of the stages run so far, with in_memory
+    done = {}
+    finished = False
+    try:
+        for stage in stages:
+            if in_memory:
+                R = _runstage_in_memory(stage, pickle_pat, mystagefunc,
+                                        prereqs=prereqs, initial_args=initargs,
+                                        done=done, **kwargs)
+            else:
+                R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
+                             initial_args=initargs, **kwargs)
+        finished = True
+    finally:
+        if pool is not None and not finished:
+            # a failed stage: don't leave the workers behind, eg in a
+            # process that goes on with another brick
+            pool.terminate()
+            pool.join()
+        if shared_tims:
+            # segments no process will claim, e.g. of a failed stage
+            from legacypipe.internal.sharedmem import remove_named
+            remove_named()
 
     info('All done:', StageTime()-t0)
 
@@ -3419,6 +3651,12 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         action='store_false')
     parser.add_argument('-w', '--write-stage', action='append', default=None,
                         help='Write a pickle for a given stage: eg "tims", "image_coadds", "srcs"')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true',
+                        default=False,
+                        help='Keep stage results in memory; only write (gzipped) pickles for --write-stage stages, and read only the one needed. Each pickle holds the whole state after its stage and is written and read in one piece')
+    parser.add_argument('--shared-tims', dest='shared_tims', action='store_true',
+                        default=False,
+                        help='Pass the tim pixels between the pool workers in named shared memory (/dev/shm) instead of pickling them')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
                         default=0, help='Make more verbose')
 
@@ -3493,6 +3731,12 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
         help=('Debugging: run the single blob containing RA,Dec <ra> <dec>; '+
               'this option can be repeated to run multiple blobs.'))
 
+    parser.add_argument('--footprint-margin', type=int, default=None,
+                        help=('With --blobxy/--blobradec, only compute outliers, coadds and WISE '+
+                              'photometry within this many pixels of the blobs being fit. '+
+                              'Outliers and image coadds are computed before the blobs exist, '+
+                              'within this many pixels of the --blobxy/--blobradec points: an '+
+                              'approximation that requires a margin larger than the largest blob radius.'))
     parser.add_argument('--max-blobsize', type=int,
                         help='Skip blobs containing more than the given number of pixels.')
 
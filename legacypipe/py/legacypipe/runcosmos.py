@@ -40,6 +40,8 @@ class CosmosSurvey(LegacySurveyData):
     def __init__(self, subset=0, **kwargs):
         super(CosmosSurvey, self).__init__(**kwargs)
         self.subset = subset
+        # get_ccds() cuts to the subset
+        self.index_ccds = False
         self.image_typemap.update({'decam+noise' : DecamImagePlusNoise})
 
     def get_ccds(self, **kwargs):
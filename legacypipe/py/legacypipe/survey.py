@@ -490,13 +490,93 @@ def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, gale
         headers.append(('DEPVER%02i' % i, value, ''))
     return headers
 
-def tim_get_resamp(tim, targetwcs):
+def footprint_rects(boxes, W, H, margin=0):
+    '''
+    Grows the (x0,x1,y0,y1) pixel *boxes* (x1,y1 exclusive) by *margin*
+    pixels, clips them to a W x H image and merges them into a list of
+    non-overlapping (x0,x1,y0,y1) rectangles covering all of them.
+    '''
+    rects = []
+    for x0,x1,y0,y1 in boxes:
+        x0,x1 = max(0, int(np.floor(x0 - margin))), min(W, int(np.ceil(x1 + margin)))
+        y0,y1 = max(0, int(np.floor(y0 - margin))), min(H, int(np.ceil(y1 + margin)))
+        if x0 < x1 and y0 < y1:
+            rects.append((x0,x1,y0,y1))
+    # Merging two rectangles into their bounding box can create a new
+    # overlap, so repeat until nothing changes.
+    nlast = -1
+    while len(rects) != nlast:
+        nlast = len(rects)
+        merged = []
+        while len(rects):
+            a = rects.pop()
+            grew = True
+            while grew:
+                grew = False
+                rest = []
+                for b in rects:
+                    if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                        a = (min(a[0],b[0]), max(a[1],b[1]),
+                             min(a[2],b[2]), max(a[3],b[3]))
+                        grew = True
+                    else:
+                        rest.append(b)
+                rects = rest
+            merged.append(a)
+        rects = merged
+    return rects
+
+def resample_with_footprint(targetwcs, wcs, Limages=[], L=3, footprint=None,
+                            footprint_on_input=False, **kwargs):
+    '''
+    Like astrometry.util.resample.resample_with_wcs, but only for the
+    pixels inside *footprint*, a list of non-overlapping (x0,x1,y0,y1)
+    rectangles (see footprint_rects) in the pixel space of *targetwcs*,
+    or of *wcs* if *footprint_on_input*.  The work done scales with the
+    footprint area instead of the full overlap.
+
+    Returns Yo,Xo,Yi,Xi,rimgs in full-image pixel coordinates, or raises
+    OverlapError if nothing in the footprint overlaps.
+    '''
     from astrometry.util.resample import resample_with_wcs,OverlapError
-
-    if hasattr(tim, 'resamp'):
+    if footprint is None:
+        return resample_with_wcs(targetwcs, wcs, Limages, L, **kwargs)
+    R = []
+    for x0,x1,y0,y1 in footprint:
+        if footprint_on_input:
+            sub = wcs.get_subimage(x0, y0, x1-x0, y1-y0)
+            subims = [im[y0:y1, x0:x1] for im in Limages]
+            try:
+                Yo,Xo,Yi,Xi,rims = resample_with_wcs(targetwcs, sub, subims, L, **kwargs)
+            except OverlapError:
+                continue
+            Yi += y0
+            Xi += x0
+        else:
+            sub = targetwcs.get_subimage(x0, y0, x1-x0, y1-y0)
+            try:
+                Yo,Xo,Yi,Xi,rims = resample_with_wcs(sub, wcs, Limages, L, **kwargs)
+            except OverlapError:
+                continue
+            Yo += y0
+            Xo += x0
+        if len(Yo):
+            R.append((Yo,Xo,Yi,Xi,rims))
+    if len(R) == 0:
+        raise OverlapError('No overlap within footprint')
+    Yo,Xo,Yi,Xi = [np.hstack([r[i] for r in R]) for i in range(4)]
+    rimgs = [np.hstack([r[4][i] for r in R]) for i in range(len(R[0][4]))]
+    return Yo,Xo,Yi,Xi,rimgs
+
+def tim_get_resamp(tim, targetwcs, footprint=None):
+    from astrometry.util.resample import OverlapError
+
+    if hasattr(tim, 'resamp') and footprint is None:
         return tim.resamp
     try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
+        Yo,Xo,Yi,Xi,_ = resample_with_footprint(targetwcs, tim.subwcs,
+                                                footprint=footprint,
+                                                intType=np.int16)
     except OverlapError:
         debug('No overlap between tim', tim.name, 'and target WCS')
         return None
@@ -624,6 +704,83 @@ def bricks_touching_wcs(targetwcs, survey=None, B=None, margin=20):
         keep.append(i)
     return B[np.array(keep)]
 
+def get_ccd_radec_index(fn, fallback_dir=None, rows_copy=False):
+    '''
+    Returns the RA,Dec index of the CCDs table *fn*: a dict of 'dec'
+    (sorted), 'ra' and 'row' (the row in *fn* of each), and 'fn', the
+    file to read those rows from.
+
+    The index is kept in a sidecar file, *fn*.radec.npz (24 bytes per
+    CCD), or in *fallback_dir* if *fn*'s directory is not writable, and
+    is rebuilt when *fn* changes (size or modification time).
+
+    Reading some rows of a gzipped table still decompresses all of it.
+    With *rows_copy*, a gzipped *fn* gets a second sidecar the rows are
+    read from instead, an uncompressed copy (*fn*.rows.fits) that takes
+    as much disk as the decompressed table (several GB for the DECam
+    CCDs); otherwise they are read from *fn*.
+    '''
+    st = os.stat(fn)
+    compressed = fn.endswith('.gz') and rows_copy
+    def rows_fn(ifn):
+        # the file to read the rows from, with index file ifn
+        if compressed:
+            return ifn.replace('.radec.npz', '.rows.fits')
+        return fn
+    base = os.path.basename(fn) + '.radec.npz'
+    fns = [fn + '.radec.npz']
+    if fallback_dir is not None:
+        fns.append(os.path.join(fallback_dir, base))
+    for ifn in fns:
+        if not (os.path.exists(ifn) and os.path.exists(rows_fn(ifn))):
+            continue
+        with np.load(ifn) as X:
+            if X['size'] == st.st_size and X['mtime'] == st.st_mtime:
+                return dict(dec=X['dec'], ra=X['ra'], row=X['row'],
+                            fn=rows_fn(ifn))
+
+    debug('Building RA,Dec index of', fn)
+    T = fits_table(fn, columns=['ra', 'dec'])
+    row = np.argsort(T.dec, kind='stable')
+    index = dict(dec=T.dec[row].astype(np.float64), ra=T.ra[row].astype(np.float64),
+                 row=row)
+    for ifn in fns:
+        # write and rename, other processes may be reading it
+        tmpfn = ifn + '.tmp-%i' % os.getpid()
+        try:
+            dirnm = os.path.dirname(ifn)
+            if not os.path.exists(dirnm):
+                os.makedirs(dirnm)
+            if compressed:
+                # before the index, which vouches for it
+                import gzip
+                import shutil
+                tmprows = rows_fn(ifn) + '.tmp-%i' % os.getpid()
+                with gzip.open(fn, 'rb') as fin, open(tmprows, 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, 1<<24)
+                os.rename(tmprows, rows_fn(ifn))
+            with open(tmpfn, 'wb') as f:
+                np.savez(f, size=st.st_size, mtime=st.st_mtime, **index)
+            os.rename(tmpfn, ifn)
+            index.update(fn=rows_fn(ifn))
+            break
+        except OSError as e:
+            debug('Failed to write CCDs index', ifn, ':', e)
+    # no sidecar written: read the rows from fn itself
+    index.setdefault('fn', fn)
+    return index
+
+def ccd_rows_near(index, ra, dec, radius):
+    '''
+    Returns the (sorted) rows of the CCDs in *index* (see
+    get_ccd_radec_index) within *radius* degrees of RA,Dec.
+    '''
+    from astrometry.util.starutil_numpy import degrees_between
+    lo,hi = np.searchsorted(index['dec'], [dec - radius, dec + radius])
+    J = np.arange(lo, hi)
+    J = J[degrees_between(ra, dec, index['ra'][J], index['dec'][J]) < radius]
+    return np.sort(index['row'][J])
+
 def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
     '''
     targetwcs: wcs object describing region of interest
@@ -763,6 +920,8 @@ class LegacySurveyData(object):
         self.output_file_hashes = OrderedDict()
         self.ccds = None
         self.bricks = None
+        self.brick_index = None
+        self.brick_rows = {}
         self.ccds_index = None
 
         # Create and cache a kd-tree for bricks_touching_radec_box ?
@@ -774,6 +933,19 @@ class LegacySurveyData(object):
         # Cached CCD kd-tree --
         # - initially None, then a list of (fn, kd)
         self.ccd_kdtrees = None
+        # Without kd-trees, read the CCDs near a region through RA,Dec
+        # index sidecars of the CCDs tables (get_ccd_radec_index), rather
+        # than reading the full tables; subclasses whose get_ccds() cuts
+        # rows turn this off.  Cached: a list of (fn, index)
+        self.index_ccds = True
+        self.ccd_indices = None
+        # Read the rows of gzipped CCDs tables from uncompressed copies
+        # next to their index sidecars, see get_ccd_radec_index()
+        self.ccd_rows_copy = False
+        # Where the index sidecars go when the CCDs tables' directory is
+        # not writable; None for output_dir/ccd-index.  Set it to a
+        # directory shared by all the bricks of a run.
+        self.ccd_index_dir = None
 
         self.image_typemap = {
             'decam'  : DecamImage,
@@ -1149,13 +1321,16 @@ class LegacySurveyData(object):
 
     def __getstate__(self):
         '''
-        For pickling; we omit cached tables.
+        For pickling; we omit cached tables, but keep the brick name
+        index and the bricks looked up by name, so the workers need not
+        read the bricks table again.
         '''
         d = self.__dict__.copy()
         d['ccds'] = None
         d['bricks'] = None
         d['bricktree'] = None
         d['ccd_kdtrees'] = None
+        d['ccd_indices'] = None
         return d
 
     def drop_cache(self):
@@ -1165,6 +1340,9 @@ class LegacySurveyData(object):
         '''
         self.ccds = None
         self.bricks = None
+        self.brick_index = None
+        self.brick_rows = {}
+        self.ccd_indices = None
         if self.bricktree is not None:
             from astrometry.libkd.spherematch import tree_free
             tree_free(self.bricktree)
@@ -1227,15 +1405,38 @@ class LegacySurveyData(object):
             return None
         return B[I[0]]
 
+    def get_brick_index(self):
+        '''
+        Returns a (shared) dict from brick name to row in the table of
+        bricks.  If the table is not loaded, only its names are read.
+        '''
+        if self.brick_index is None:
+            if self.bricks is not None:
+                names = self.bricks.brickname
+            else:
+                names = fits_table(self.find_file('bricks'),
+                                   columns=['brickname']).brickname
+            names = np.char.strip(names)
+            if names.dtype.kind == 'S':
+                names = np.char.decode(names)
+            self.brick_index = dict(zip(names, range(len(names))))
+        return self.brick_index
+
     def get_brick_by_name(self, brickname):
         '''
         Returns a brick (as one row in a table) by name (string).
+
+        If the table of bricks is not loaded, only that row is read, once.
         '''
-        B = self.get_bricks_readonly()
-        I, = np.nonzero(np.array([n == brickname for n in B.brickname]))
-        if len(I) == 0:
+        i = self.get_brick_index().get(brickname)
+        if i is None:
             return None
-        return B[I[0]]
+        if self.bricks is not None:
+            return self.bricks[i]
+        if brickname not in self.brick_rows:
+            self.brick_rows[brickname] = fits_table(self.find_file('bricks'),
+                                                    rows=[i])[0]
+        return self.brick_rows[brickname]
 
     def get_bricks_near(self, ra, dec, radius):
         '''
@@ -1404,6 +1605,25 @@ class LegacySurveyData(object):
                 return None
             ccds = merge_tables(TT, columns='fillzero')
             ccds = self.cleanup_ccds_table(ccds)
+        elif self.ccds is None and self.index_ccds:
+            # Same MAGIC 1-degree radius as with the kd-trees.
+            radius = 1.
+            ra,dec = wcs.radec_center()
+            TT = []
+            for fn,index in self.get_ccd_indices():
+                I = ccd_rows_near(index, ra, dec, radius)
+                debug(len(I), 'CCDs in', fn, 'within', radius,
+                      'deg of RA,Dec', '(%.3f, %.3f)' % (ra,dec))
+                if len(I) == 0:
+                    continue
+                TT.append(fits_table(index['fn'], rows=I))
+            if len(TT) == 0:
+                return None
+            if len(TT) > 1:
+                ccds = merge_tables(TT, columns='fillzero')
+            else:
+                ccds = TT[0]
+            ccds = self.cleanup_ccds_table(ccds)
         else:
             ccds = self.get_ccds_readonly()
         I = ccds_touching_wcs(wcs, ccds, **kwargs)
@@ -1411,6 +1631,27 @@ class LegacySurveyData(object):
             return None
         return ccds[I]
 
+    def get_ccd_indices(self):
+        '''
+        Returns the RA,Dec indices of the CCDs tables get_ccds() reads, as
+        a list of (fn, index); see get_ccd_radec_index().
+        '''
+        if self.ccd_indices is not None:
+            return self.ccd_indices
+        fns = self.find_file('ccds')
+        fns.sort()
+        fns = self.filter_ccds_files(fns)
+        if len(fns) == 0:
+            print('Failed to find any valid survey-ccds tables')
+            raise RuntimeError('No survey-ccds files')
+        fallback = self.ccd_index_dir
+        if fallback is None:
+            fallback = os.path.join(self.output_dir, 'ccd-index')
+        self.ccd_indices = [(fn, get_ccd_radec_index(fn, fallback_dir=fallback,
+                                                     rows_copy=self.ccd_rows_copy))
+                            for fn in fns]
+        return self.ccd_indices
+
     def get_ccd_kdtrees(self):
         # check cache...
         if self.ccd_kdtrees is not None:
@@ -1586,5 +1827,21 @@ def read_one_tim(X):
     if tim is not None:
         th,tw = tim.shape
         print('Time to read %i x %i image, hdu %i:' % (tw,th, im.hdu), Time()-t0)
+        share_tim_pixels(tim)
     return tim
 
+def share_tim_pixels(tim):
+    '''
+    With run_brick(shared_tims=True), moves the image, inverse-error and
+    DQ arrays of *tim* to named shared memory, so that they are sent to and
+    from the pool workers by name.
+    '''
+    from legacypipe.internal.sharedmem import named_enabled, named_copy
+    if not named_enabled():
+        return
+    tim.data = named_copy(tim.data)
+    tim.inverr = named_copy(tim.inverr)
+    dq = getattr(tim, 'dq', None)
+    if dq is not None:
+        tim.dq = named_copy(dq)
+
@@ -107,6 +107,118 @@ class iterwrapper(object):
     def __len__(self):
         return self.n
 
+class SparseImage(object):
+    '''
+    A mostly-zero image, eg the simulated sources added to a tim, kept
+    as a dict of square tiles; tiles that were never added to are zero.
+
+    np.asarray(img) gives the dense image, img[Y,X] the pixels at index
+    arrays Y,X, and "array - img" works.
+    '''
+    def __init__(self, shape, dtype=np.float32, tilesize=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.tilesize = tilesize
+        self.tiles = {}
+
+    # so that "array - img" calls __rsub__ rather than densifying img
+    __array_ufunc__ = None
+
+    def _tile_slice(self, ty, tx):
+        T = self.tilesize
+        H,W = self.shape
+        return (slice(ty*T, min((ty+1)*T, H)), slice(tx*T, min((tx+1)*T, W)))
+
+    def add(self, slc, arr):
+        '''
+        img[slc] += arr, for slc a (y,x) tuple of slices with
+        non-negative start and stop inside the image.
+        '''
+        T = self.tilesize
+        sy,sx = slc
+        for ty in range(sy.start // T, (sy.stop - 1) // T + 1):
+            for tx in range(sx.start // T, (sx.stop - 1) // T + 1):
+                ty0,tx0 = ty*T, tx*T
+                y0,y1 = max(sy.start, ty0), min(sy.stop, ty0+T)
+                x0,x1 = max(sx.start, tx0), min(sx.stop, tx0+T)
+                tile = self.tiles.get((ty,tx))
+                if tile is None:
+                    ys,xs = self._tile_slice(ty, tx)
+                    tile = np.zeros((ys.stop-ys.start, xs.stop-xs.start),
+                                    self.dtype)
+                    self.tiles[(ty,tx)] = tile
+                tile[y0-ty0:y1-ty0, x0-tx0:x1-tx0] += \
+                    arr[y0-sy.start:y1-sy.start, x0-sx.start:x1-sx.start]
+
+    def __getitem__(self, idx):
+        '''
+        img[Y,X] for integer index arrays Y,X, read from the tiles.
+        '''
+        Y,X = idx
+        Y = np.asarray(Y, dtype=np.int64)
+        X = np.asarray(X, dtype=np.int64)
+        out = np.zeros(Y.shape, self.dtype)
+        if len(self.tiles) == 0 or Y.size == 0:
+            return out
+        T = self.tilesize
+        ntx = (self.shape[1] + T - 1) // T
+        key = (Y // T) * ntx + (X // T)
+        order = np.argsort(key.ravel(), kind='stable')
+        keys = key.ravel()[order]
+        starts = np.flatnonzero(np.diff(keys)) + 1
+        yy = Y.ravel()
+        xx = X.ravel()
+        flat = out.reshape(-1)
+        for J in np.split(order, starts):
+            ty,tx = divmod(int(key.flat[J[0]]), ntx)
+            tile = self.tiles.get((ty,tx))
+            if tile is None:
+                continue
+            flat[J] = tile[yy[J] - ty*T, xx[J] - tx*T]
+        return out
+
+    def map(self, func):
+        '''
+        New SparseImage with func applied to each tile; func(0) must be 0.
+        '''
+        img = SparseImage(self.shape, dtype=self.dtype, tilesize=self.tilesize)
+        img.tiles = dict([(k, func(tile)) for k,tile in self.tiles.items()])
+        return img
+
+    def min(self):
+        mins = [tile.min() for tile in self.tiles.values()]
+        if len(self.tiles) < self._ntiles():
+            mins.append(0)
+        return min(mins)
+
+    def _ntiles(self):
+        T = self.tilesize
+        H,W = self.shape
+        return ((H + T - 1) // T) * ((W + T - 1) // T)
+
+    @property
+    def nbytes(self):
+        return sum([tile.nbytes for tile in self.tiles.values()])
+
+    def dense(self, out=None):
+        if out is None:
+            out = np.zeros(self.shape, self.dtype)
+        for (ty,tx),tile in self.tiles.items():
+            out[self._tile_slice(ty, tx)] = tile
+        return out
+
+    def __array__(self, dtype=None):
+        img = self.dense()
+        if dtype is not None:
+            img = img.astype(dtype)
+        return img
+
+    def __rsub__(self, other):
+        out = np.array(other, dtype=np.result_type(other, self.dtype))
+        for (ty,tx),tile in self.tiles.items():
+            out[self._tile_slice(ty, tx)] -= tile
+        return out
+
 def _ring_unique(wcs, W, H, i, unique, ra1,ra2,dec1,dec2):
     lo, hix, hiy = i, W-i-1, H-i-1
     # one slice per side; we double-count the last pix of each side.
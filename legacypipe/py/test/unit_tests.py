@@ -56,6 +56,258 @@ class TestOneblob(unittest.TestCase):
         mod = _select_model(chisqs, nparams, galaxy_margin)
         self.assertTrue(mod == 'dev')
 
+class TestFootprint(unittest.TestCase):
+
+    def test_footprint_rects(self):
+        from legacypipe.survey import footprint_rects
+
+        # grown, clipped to the image, overlapping boxes merged
+        rects = footprint_rects([(10,11,10,11), (20,21,10,11), (100,101,100,101)],
+                                200, 200, margin=5)
+        self.assertEqual(sorted(rects), [(5,26,5,16), (95,106,95,106)])
+
+        rects = footprint_rects([(0,1,0,1)], 50, 50, margin=5)
+        self.assertEqual(rects, [(0,6,0,6)])
+
+        # merging two boxes can make their bounding box overlap a third
+        rects = footprint_rects([(0,10,0,10), (20,30,0,10), (8,22,20,30), (9,21,5,25)],
+                                100, 100)
+        self.assertEqual(rects, [(0,30,0,30)])
+
+class TestSparseImage(unittest.TestCase):
+
+    def test_sparse_image(self):
+        import numpy as np
+        from legacypipe.utils import SparseImage
+
+        dense = np.zeros((100,70), np.float32)
+        img = SparseImage(dense.shape, tilesize=32)
+        # overlapping boxes, across tile boundaries and the image edge
+        for y0,y1,x0,x1 in [(10,40,20,50), (30,35,25,70), (90,100,60,70)]:
+            box = np.arange((y1-y0)*(x1-x0), dtype=np.float32).reshape(y1-y0,x1-x0) + 1
+            img.add((slice(y0,y1), slice(x0,x1)), box)
+            dense[y0:y1, x0:x1] += box
+        self.assertTrue(np.all(np.asarray(img) == dense))
+        self.assertTrue(np.all(np.asarray(img.map(np.sqrt)) == np.sqrt(dense)))
+        data = np.ones(dense.shape, np.float32)
+        self.assertTrue(np.all(data - img == data - dense))
+        Y,X = np.meshgrid(np.arange(100), np.arange(70), indexing='ij')
+        Y,X = Y[::3, ::2].ravel()[::-1], X[::3, ::2].ravel()[::-1]
+        self.assertTrue(np.all(img[Y,X] == dense[Y,X]))
+        self.assertEqual(len(img[Y[:0],X[:0]]), 0)
+        self.assertEqual(img.min(), 0)
+        self.assertTrue(img.nbytes < dense.nbytes)
+
+class TestMergedCalib(unittest.TestCase):
+
+    def test_merged_calib(self):
+        import os
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.image import get_merged_calib
+
+        T = fits_table()
+        T.expnum = np.array([100, 100, 100])
+        T.ccdname = np.array(['N4', 'S1', 'N10'])
+        T.plver = np.array(['V4.8', 'V4.8', 'V4.8'])
+        T.plprocid = np.array(['abc', 'abc', 'abc'])
+        T.sig1 = np.array([1., 2., 3.])
+        fn = os.path.join(tempfile.mkdtemp(), 'merged-psfex.fits')
+        T.writeto(fn)
+
+        M = get_merged_calib(fn)
+        self.assertTrue(get_merged_calib(fn) is M)
+        self.assertEqual(M.rows(100, 'S1'), [1])
+        self.assertEqual(M.rows(100, 'S2'), [])
+        self.assertEqual(M.rows(101, 'N4'), [])
+        self.assertEqual(M.row(2).sig1, 3.)
+        self.assertTrue(M.validate(100, 'V4.8', 'abc'))
+        self.assertFalse(M.validate(100, 'V4.9', 'abc'))
+
+        # a rewritten file is read again
+        T.sig1 *= 10
+        T.writeto(fn)
+        os.utime(fn, (M.mtime + 10, M.mtime + 10))
+        M2 = get_merged_calib(fn)
+        self.assertFalse(M2 is M)
+        self.assertEqual(M2.row(2).sig1, 30.)
+
+        # only the latest MAX_MERGED_CALIBS files are kept
+        import legacypipe.image
+        nmax = legacypipe.image.MAX_MERGED_CALIBS
+        legacypipe.image.MAX_MERGED_CALIBS = 1
+        try:
+            fn2 = fn.replace('psfex', 'splinesky')
+            T.writeto(fn2)
+            get_merged_calib(fn2)
+            self.assertEqual(list(legacypipe.image.merged_calibs.keys()), [fn2])
+        finally:
+            legacypipe.image.MAX_MERGED_CALIBS = nmax
+
+class TestCcdIndex(unittest.TestCase):
+
+    def test_ccd_radec_index(self):
+        import os
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.survey import get_ccd_radec_index, ccd_rows_near
+
+        T = fits_table()
+        T.ra = np.array([10., 150., 10.5, 359.9, 10.2])
+        T.dec = np.array([0., 30., 0.5, 0.1, -0.3])
+        fn = os.path.join(tempfile.mkdtemp(), 'survey-ccds-test.fits')
+        T.writeto(fn)
+
+        index = get_ccd_radec_index(fn)
+        self.assertTrue(os.path.exists(fn + '.radec.npz'))
+        self.assertEqual(list(ccd_rows_near(index, 10., 0., 1.)), [0, 2, 4])
+        self.assertEqual(list(ccd_rows_near(index, 0.2, 0., 1.)), [3])
+        self.assertEqual(list(ccd_rows_near(index, 200., 0., 1.)), [])
+
+        # the sidecar is rebuilt when the table changes
+        T.ra[1] = 10.1
+        T.dec[1] = 0.
+        T.writeto(fn)
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime + 10))
+        index = get_ccd_radec_index(fn)
+        self.assertEqual(list(ccd_rows_near(index, 10., 0., 1.)), [0, 1, 2, 4])
+        self.assertEqual(index['fn'], fn)
+
+        # a gzipped table is read as is, or through an uncompressed copy
+        import gzip
+        import shutil
+        gzfn = fn + '.gz'
+        with open(fn, 'rb') as fin, gzip.open(gzfn, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        index = get_ccd_radec_index(gzfn)
+        self.assertEqual(index['fn'], gzfn)
+        self.assertFalse(os.path.exists(gzfn + '.rows.fits'))
+        index = get_ccd_radec_index(gzfn, rows_copy=True)
+        self.assertEqual(index['fn'], gzfn + '.rows.fits')
+        rows = ccd_rows_near(index, 10., 0., 1.)
+        self.assertTrue(np.all(fits_table(index['fn'], rows=rows).ra == T.ra[rows]))
+        self.assertEqual(get_ccd_radec_index(gzfn, rows_copy=True)['fn'], index['fn'])
+
+class TestBrickByName(unittest.TestCase):
+
+    def test_brick_by_name(self):
+        import os
+        import gzip
+        import pickle
+        import shutil
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.survey import LegacySurveyData
+
+        survey_dir = tempfile.mkdtemp()
+        B = fits_table()
+        B.brickname = np.array(['0001m002', '0001p000', '0003p000'])
+        B.brickid = np.array([1, 2, 3], np.int32)
+        B.ra = np.array([0.125, 0.125, 0.375])
+        fn = os.path.join(survey_dir, 'survey-bricks.fits')
+        B.writeto(fn)
+        with open(fn, 'rb') as fin, gzip.open(fn + '.gz', 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+
+        survey = LegacySurveyData(survey_dir=survey_dir)
+        self.assertEqual(survey.get_brick_by_name('0001p000').brickid, 2)
+        self.assertEqual(survey.get_brick_by_name('0002p000'), None)
+        # the index and the row are kept, also through pickling
+        survey = pickle.loads(pickle.dumps(survey))
+        os.remove(fn + '.gz')
+        self.assertEqual(survey.get_brick_by_name('0001p000').brickid, 2)
+        self.assertEqual(survey.get_brick_by_name('0002p000'), None)
+
+class TestNamedSharedMem(unittest.TestCase):
+
+    def test_named_copy(self):
+        import os
+        import pickle
+        import tempfile
+        import threading
+        import numpy as np
+        from legacypipe.internal import sharedmem
+
+        shmdir = tempfile.mkdtemp()
+        sharedmem.enable_named(shm_dir=shmdir)
+        a = np.arange(60, dtype=np.float32).reshape(6,10)
+        b = sharedmem.named_copy(a)
+        self.assertTrue(np.all(b == a))
+        self.assertEqual(len(os.listdir(shmdir)), 1)
+
+        # the main thread (stage pickles) pickles the values
+        c = pickle.loads(pickle.dumps(b[2:5, 1::3]))
+        self.assertEqual(type(c), np.ndarray)
+        self.assertTrue(np.all(c == a[2:5, 1::3]))
+
+        # other threads (the pool's task handler) pickle the name
+        out = []
+        t = threading.Thread(target=lambda: out.append(pickle.dumps(b[2:5, 1::3])))
+        t.start()
+        t.join()
+        self.assertTrue(b'legacypipe-shm' in out[0])
+        self.assertFalse(b'legacypipe-shm' in pickle.dumps(b))
+        d = pickle.loads(out[0])
+        self.assertTrue(np.all(d == a[2:5, 1::3]))
+        b[3, 1] = -1
+        self.assertEqual(d[1, 0], -1)
+        # ufunc results are not in the segment
+        self.assertEqual(type(b + 1), np.ndarray)
+
+        del b, c, d
+        import gc
+        gc.collect()
+        self.assertEqual(os.listdir(shmdir), [])
+
+    def test_remove_stale(self):
+        import os
+        import subprocess
+        import sys
+        import tempfile
+        from legacypipe.internal import sharedmem
+
+        # the segments of a dead owner go, those of a live one stay
+        p = subprocess.Popen([sys.executable, '-c', 'pass'])
+        p.wait()
+        shmdir = tempfile.mkdtemp()
+        dead = 'legacypipe-shm-%i-%i-1' % (p.pid, p.pid)
+        live = 'legacypipe-shm-%i-%i-1' % (os.getppid(), os.getppid())
+        for name in [dead, live]:
+            open(os.path.join(shmdir, name), 'wb').close()
+        sharedmem.enable_named(shm_dir=shmdir)
+        self.assertEqual(os.listdir(shmdir), [live])
+
+class TestInputStager(unittest.TestCase):
+
+    def test_make_room(self):
+        import os
+        import tempfile
+        from legacypipe.prefetch import InputStager
+
+        class FakeSurvey(object):
+            survey_dir = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+        fns = [os.path.join(cache_dir, 'images', 'f%i.fits' % i) for i in range(4)]
+        os.makedirs(os.path.dirname(fns[0]))
+        for i,fn in enumerate(fns):
+            with open(fn, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(fn, (1000 + i, 1000 + i))
+
+        stager = InputStager(FakeSurvey(), cache_dir, 450)
+        self.assertEqual(stager.used(), 400)
+        # the latest brick needs f0: f1 then f2 go
+        stager.recent.append(set([fns[0]]))
+        self.assertTrue(stager.make_room(200))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(fns[0]))),
+                         ['f0.fits', 'f3.fits'])
+        self.assertEqual(stager.used(), 200)
+        stager.recent.append(set([fns[3]]))
+        self.assertFalse(stager.make_room(300))
 
 if __name__ == '__main__':
     unittest.main()
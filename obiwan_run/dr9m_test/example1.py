@@ -1,66 +1,267 @@
 from mpi4py import MPI
-from mpi_master_slave import Master, Slave
-from mpi_master_slave import WorkQueue
+from mpi_master_slave import Slave
+from mpi_master_slave import run_tasks
 import time
 import numpy as np
 import sys
 import os
 name = sys.argv[1]
 BRICKSTAT_DIR=os.environ['obiwan_code']+'/brickstat/%s/'%name
-class MyApp(object):
+# yes: run kenobi.main in the rank itself, importing everything and reading
+# the survey tables and dust maps once for all its bricks. With a
+# ScheduledBricks.txt, each brick still runs with its scheduled threads and
+# under its vsz_kb, lowering the rank's ulimit of example1.sh while it runs
+IN_PROCESS = os.environ.get('in_process','no') == 'yes'
+SUBMASTERS = os.environ.get('submasters','no') == 'yes'
+# with submasters=yes, pack the bricks of ScheduledBricks.txt (see
+# brickstat/brick_cost.py) on each node within these cores and memory [kB]
+NODE_CORES = int(os.environ.get('node_cores', 0))
+NODE_MEM_KB = int(os.environ.get('node_mem_kb', 0))
+# seconds before the end of the job: no brick predicted to run past it is
+# started, and the running ones write their fitblobs checkpoint then
+CHECKPOINT_MARGIN = int(os.environ.get('checkpoint_margin', 600))
+# node-local directory the SubMasters copy the inputs of their node's
+# bricks to, ahead of running them, keeping it under cache_budget_gb
+CACHE_DIR = os.environ.get('cache_dir') or None
+CACHE_BUDGET = float(os.environ.get('cache_budget_gb', 16)) * 2**30
+# memory [kB] kept out of the SubMaster packing for the tim pixels of the
+# running bricks in /dev/shm, with shared_tims=yes
+SHM_RESERVE_KB = float(os.environ.get('shm_reserve_gb', 8)) * 2**20
+# the InputStager of this rank, if it is a SubMaster
+STAGER = []
+# set in main
+JOB_END = None
+
+def get_job_end():
+    """Unix time the Slurm job ends, $job_end if set, None if unknown"""
+    import subprocess
+    from datetime import datetime
+    if os.environ.get('job_end'):
+        return int(os.environ['job_end'])
+    if not os.environ.get('SLURM_JOB_ID'):
+        return None
+    try:
+        end = subprocess.check_output(['squeue','-h','-j',os.environ['SLURM_JOB_ID'],
+                                       '-o','%e']).decode().strip()
+        return int(time.mktime(datetime.strptime(end, '%Y-%m-%dT%H:%M:%S').timetuple()))
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+def get_kenobi_args(brick, threads=None):
+    """kenobi.py command line for brick, as in slurm_brick_scheduler.sh
+
+    Returns:
+        tuple: argument list, log file name
+    """
+    from common import get_rsdir
+    env = os.environ
+    outdir = env['obiwan_out']
+    bri = brick[:3]
+    rsdir = get_rsdir(env['rowstart'], do_skipids=env['do_skipids'],
+                      do_more=env['do_more'])
+    log = os.path.join(outdir,'logs',bri,brick,rsdir,'log.%s' % brick)
+    checkpoint = os.path.join(outdir,'checkpoint',bri,brick,rsdir,
+                              'checkpoint-%s.pickle' % brick)
+    for dirnm in [os.path.dirname(log), os.path.dirname(checkpoint),
+                  os.path.join(outdir,'metrics',bri,brick,rsdir)]:
+        if not os.path.exists(dirnm):
+            os.makedirs(dirnm)
+    randoms = env.get('randoms_store') or os.path.join(env['CSCRATCH'],
+                           'Obiwan/dr9m/obiwan_out',env['name_for_run'],
+                           'divided_randoms','brick_%s.fits' % brick)
+    args = ['--dataset', env['dataset'], '--brick', brick,
+            '--nobj', env['nobj'], '--rowstart', env['rowstart'],
+            '-o', env['object'], '--randoms_db', env['randoms_db'],
+            '--outdir', outdir, '--threads', str(threads or env['threads']),
+            '--do_skipids', env['do_skipids'], '--do_more', env['do_more'],
+            '--minid', env['minid'], '--randoms_from_fits', randoms,
+            '--verbose',
+            '--pickle', os.path.join(outdir,'pickles',bri,brick,rsdir,
+                                     'runbrick-%(brick)s-%%(stage)s.pickle'),
+            '--ps', os.path.join(outdir,'metrics',bri,brick,rsdir,
+                                 'ps-%s-%s.fits' % (brick, env.get('SLURM_JOB_ID',''))),
+            '--ps-t0', str(int(time.time())),
+            '--checkpoint', checkpoint,
+            '--checkpoint_period', env.get('checkpoint_period', '600'),
+            '--write-stage', 'writecat', '--stage', 'writecat',
+            '--no-galaxy-forcepsf', '--less-masking', '--run', 'decam']
+    if env.get('rowstarts'):
+        args += ['--rowstarts'] + env['rowstarts'].split()
+    if env.get('in_memory'):
+        args += ['--in_memory']
+    if env.get('checkpoint_stages'):
+        args += ['--checkpoint_stages'] + env['checkpoint_stages'].split()
+    if env.get('cache_dir'):
+        args += ['--cache_dir', env['cache_dir']]
+    if env.get('shared_tims') == 'yes':
+        args += ['--shared_tims']
+    if env.get('write_matched') == 'yes':
+        args += ['--write_matched']
+    if env.get('ccd_rows_copy') == 'yes':
+        args += ['--ccd_rows_copy']
+    return args, log
+
+def run_brick_in_process(brick, threads=None, vsz_kb=0):
+    """Runs kenobi.main for brick in this process, output appended to its log
+
+    A failure (exception or sys.exit) is logged and returned, so the rank
+        carries on with its next brick. With vsz_kb, the soft address space
+        limit of the rank and of the workers it forks is vsz_kb [kB] while
+        the brick runs (the ulimit -Sv of slurm_brick_scheduler.sh), so a
+        brick over its schedule fails with a MemoryError instead of taking
+        the node down; the rank's own limit is restored afterwards
+
+    Returns:
+        tuple: ok, message
+    """
+    import traceback
+    import resource
+    import kenobi
+    args, log = get_kenobi_args(brick, threads=threads)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # redirect the file descriptors, so the multiprocessing workers log there too
+    saved = os.dup(1), os.dup(2)
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    limits = resource.getrlimit(resource.RLIMIT_AS)
+    try:
+        if vsz_kb:
+            soft = int(vsz_kb) * 1024
+            if limits[1] != resource.RLIM_INFINITY:
+                soft = min(soft, limits[1])
+            resource.setrlimit(resource.RLIMIT_AS, (soft, limits[1]))
+        print('Starting %s in process on %s' % (brick, MPI.Get_processor_name()))
+        kenobi.main(args=kenobi.get_parser().parse_args(args=args))
+        ok, message = True, 'finished %s' % brick
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        traceback.print_exc()
+        ok, message = False, 'failed %s: %r' % (brick, e)
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, limits)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+    return ok, message
+def get_tasks(tasks=None):
+    """
+    (brick, task_id, threads, mem_kb, vsz_kb, seconds) for the bricks in
+    ScheduledBricks.txt, longest first, or UnfinishedBricks.txt with the
+    default threads, memory and vsz limits (0) and runtime (0, unknown) if
+    there is no schedule; the first `tasks` of them if given. The runtime
+    of the scheduled bricks whose predicted seconds are not timed (no cost
+    model, only their number of CCDs) is unknown too, the deadline does
+    not hold them back
+    """
+    fn = BRICKSTAT_DIR + 'ScheduledBricks.txt'
+    if os.path.exists(fn):
+        S = np.atleast_2d(np.loadtxt(fn, dtype=str))
+        task_list = [(s[0], int(s[1]), int(s[2]), int(s[3]),
+                      float(s[4]) if int(s[5]) else 0.) for s in S]
+    else:
+        bricks = np.atleast_1d(np.loadtxt(BRICKSTAT_DIR + 'UnfinishedBricks.txt', dtype=str))
+        task_list = [(b, int(os.environ['threads']), 0, 0, 0.) for b in bricks]
+    if tasks is None:
+        tasks = len(task_list)
+    tasks = [(t[0], i) + tuple(t[1:]) for i,t in enumerate(task_list[:tasks])]
+    record_queued([t[0] for t in tasks])
+    return tasks
+
+
+def stage_inputs(tasks):
+    """SubMaster callback: copies the inputs of the bricks queued on this
+    node to CACHE_DIR, in the background (see legacypipe/prefetch.py)"""
+    if not STAGER:
+        from legacypipe.survey import LegacySurveyData
+        from legacypipe.prefetch import InputStager
+        STAGER.append(InputStager(LegacySurveyData(), CACHE_DIR, CACHE_BUDGET))
+    STAGER[0].stage([t[0] for t in tasks])
+
+def record_queued(bricks):
+    """Marks bricks as queued in the run state manifest, see run_state.py"""
+    from common import get_rsdir
+    from run_state import record_states
+    env = os.environ
+    rowstarts = env['rowstarts'].split() if env.get('rowstarts') else [env['rowstart']]
+    rsdirs = [get_rsdir(rs, do_skipids=env['do_skipids'], do_more=env['do_more'])
+              for rs in rowstarts]
+    record_states(env['obiwan_out'],
+                  [dict(brick=b, rsdir=rsdir, state='queued')
+                   for b in bricks for rsdir in rsdirs])
+
+
+def on_tmpfs(path):
+    """whether path is on a tmpfs (e.g. /dev/shm), i.e. takes memory"""
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    with open('/proc/mounts') as f:
+        for line in f:
+            words = line.split()
+            mnt = words[1]
+            if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > len(best):
+                best, fstype = mnt, words[2]
+    return fstype == 'tmpfs'
+
+
+def node_capacity():
+    """cores and memory [kB] the SubMaster packs the bricks of a node in
+
+    The memory is node_mem_kb less what /dev/shm takes outside of the
+    bricks' RSS: the input cache, if on a tmpfs, and SHM_RESERVE_KB for
+    the shared tims (segments of killed bricks are removed by the next
+    brick, see legacypipe.internal.sharedmem.enable_named)
     """
-    This is my application that has a lot of work to do so it gives work to do
-    to its slaves until all the work is done
+    mem_kb = NODE_MEM_KB
+    if CACHE_DIR and on_tmpfs(CACHE_DIR):
+        mem_kb -= int(CACHE_BUDGET / 1024)
+    if os.environ.get('shared_tims') == 'yes':
+        mem_kb -= int(SHM_RESERVE_KB)
+    if mem_kb <= 0:
+        raise ValueError('node_mem_kb=%d leaves no memory for the bricks' % NODE_MEM_KB)
+    return NODE_CORES, mem_kb
+
+
+def task_cost(task):
+    """cores and memory [kB] (summed RSS) of a task, for the SubMaster packing"""
+    brick, task_arg, threads, mem_kb, vsz_kb, seconds = task
+    return threads, mem_kb
+
+
+def task_duration(task):
+    """predicted seconds of a task, for the deadline"""
+    return task[5]
+
+
+def checkpoint_at(job_end, request):
+    """Calls request() CHECKPOINT_MARGIN seconds before job_end
+
+    Returns:
+        the started threading.Timer, cancel it when the brick is done;
+            None if the end of the job is unknown
     """
+    import threading
+    if job_end is None:
+        return None
+    timer = threading.Timer(max(job_end - CHECKPOINT_MARGIN - time.time(), 0), request)
+    timer.daemon = True
+    timer.start()
+    return timer
+
 
-    def __init__(self, slaves):
-        # when creating the Master we tell it what slaves it can handle
-        self.master = Master(slaves)
-        # WorkQueue is a convenient class that run slaves on a tasks queue
-        self.work_queue = WorkQueue(self.master)
-
-    def terminate_slaves(self):
-        """
-        Call this to make all slaves exit their run loop
-        """
-        self.master.terminate_slaves()
-
-    def run(self, tasks=None):
-        """
-        This is the core of my application, keep starting slaves
-        as long as there is work to do
-        """
-        #
-        # let's prepare our work queue. This can be built at initialization time
-        # but it can also be added later as more work become available
-        #
-        task_list = np.loadtxt(BRICKSTAT_DIR + 'UnfinishedBricks.txt', dtype=np.str)
-        if tasks is None:
-           tasks = len(task_list)
-        for i in range(tasks):
-            # 'data' will be passed to the slave and can be anything
-            self.work_queue.add_work(data=(task_list[i], i))
-       
-        #
-        # Keeep starting slaves as long as there is work to do
-        #
-        while not self.work_queue.done():
-
-            #
-            # give more work to do to each idle slave (if any)
-            #
-            self.work_queue.do_work()
-
-            #
-            # reclaim returned data from completed slaves
-            #
-            for slave_return_data in self.work_queue.get_completed_work():
-                done, message = slave_return_data
-                if done:
-                    print('Master: slave finished is task and says "%s"' % message)
-
-            # sleep some time
-            time.sleep(0.3)
+def print_result(slave_return_data):
+    done, message = slave_return_data
+    if done:
+        print('Master: slave finished is task and says "%s"' % message)
+    else:
+        print('Master: slave failed its task and says "%s"' % message)
+    sys.stdout.flush()
 
 
 class MySlave(Slave):
@@ -69,15 +270,39 @@ class MySlave(Slave):
     and calls 'Slave.run'. The Master will do the rest
     """
 
-    def __init__(self):
-        super(MySlave, self).__init__()
+    def __init__(self, comm=None, master=0):
+        super(MySlave, self).__init__(comm=comm, master=master)
+        self.job_end = JOB_END
+        if IN_PROCESS:
+            # pay for the legacypipe/tractor/galsim imports once
+            import kenobi
 
     def do_work(self, data):
         import subprocess
         rank = MPI.COMM_WORLD.Get_rank()
         name = MPI.Get_processor_name()
-        task, task_arg = data
-        subprocess.call(["./slurm_brick_scheduler.sh",task])
+        task, task_arg, threads, mem_kb, vsz_kb, seconds = data
+        if IN_PROCESS:
+            from legacypipe.runbrick import request_checkpoint
+            # the scheduled threads and vsz_kb of the brick ($threads and 0
+            # without a ScheduledBricks.txt: the limit of example1.sh); with
+            # submasters=yes its mem_kb is also packed within node_mem_kb
+            timer = checkpoint_at(self.job_end, request_checkpoint)
+            ok, message = run_brick_in_process(task, threads=threads, vsz_kb=vsz_kb)
+            if timer is not None:
+                timer.cancel()
+            print('  Slave %s rank %d: %s' % (name, rank, message))
+            sys.stdout.flush()
+            return (ok, '%s (%d)' % (message, task_arg))
+        import signal
+        # ulimit -Sv of each process of the brick: the peak vsz of one process
+        proc = subprocess.Popen(["./slurm_brick_scheduler.sh", task, str(threads),
+                                 str(vsz_kb or '')])
+        # the script passes the USR1 on to kenobi.py
+        timer = checkpoint_at(self.job_end, lambda: proc.send_signal(signal.SIGUSR1))
+        proc.wait()
+        if timer is not None:
+            timer.cancel()
         print(task)
         sys.stdout.flush()
         print('  Slave %s rank %d executing "%s" task_id "%d"' % (name, rank, task, task_arg) )
@@ -92,15 +317,22 @@ def main():
 
     print('I am  %s rank %d (total %d)' % (name, rank, size) )
 
-    if rank == 0: # Master
-
-        app = MyApp(slaves=range(1, size))
-        app.run()
-        app.terminate_slaves()
-
-    else: # Any slave
-
-        MySlave().run()
+    # Rank 0 hands out the bricks as the slaves ask for them; with
+    # submasters=yes it only talks to one rank per node, which hands them
+    # out to the other ranks of its node
+    capacity = None
+    if NODE_CORES and NODE_MEM_KB:
+        capacity = node_capacity()
+    # ask Slurm once
+    global JOB_END
+    JOB_END = MPI.COMM_WORLD.bcast(get_job_end() if rank == 0 else None, root=0)
+    deadline = None
+    if JOB_END is not None:
+        deadline = JOB_END - CHECKPOINT_MARGIN
+    run_tasks(get_tasks, MySlave, submasters=SUBMASTERS,
+              callback=print_result, capacity=capacity, cost=task_cost,
+              deadline=deadline, duration=task_duration,
+              on_queued=stage_inputs if CACHE_DIR else None)
 
     print('Task completed (rank %d)' % (rank) )
 
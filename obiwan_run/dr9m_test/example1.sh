@@ -1,5 +1,12 @@
 #!/bin/bash -l
 #source /srv/py3_venv/bin/activate
+if [ "${in_process}" == "yes" ]; then
+    # the ranks run kenobi.main themselves, see MySlave.do_work; this
+    # limit covers a rank, lowered to the vsz_kb of each brick of a
+    # ScheduledBricks.txt while it runs
+    source ./obiwan_env.sh
+    ulimit -Sv 125000000
+fi
 export PYTHONPATH=$CSCRATCH/Obiwan/dr9m/obiwan_code/py:$PYTHONPATH
 
 python ./example1.py $name_for_run
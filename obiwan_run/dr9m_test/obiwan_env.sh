@@ -0,0 +1,31 @@
+#! /bin/bash
+# Environment for running kenobi.py, sourced by slurm_brick_scheduler.sh
+# and by example1.sh (for in_process=yes, where the ranks run kenobi.main
+# themselves)
+export LEGACY_SURVEY_DIR=$CSCRATCH/Obiwan/dr9m/obiwan_data
+export DUST_DIR=/global/cfs/projectdirs/cosmo/data/dust/v0_1
+export UNWISE_COADDS_DIR=/global/cfs/projectdirs/cosmo/work/wise/outputs/merge/neo5/fulldepth:/global/cfs/projectdirs/cosmo/data/unwise/allwise/unwise-coadds/fulldepth
+export UNWISE_COADDS_TIMERESOLVED_DIR=/global/cfs/projectdirs/cosmo/work/wise/outputs/merge/neo5
+export UNWISE_MODEL_SKY_DIR=/global/cfs/cdirs/cosmo/work/wise/unwise_catalog/dr2/mod
+export GAIA_CAT_DIR=/global/cfs/projectdirs/cosmo/work/gaia/chunks-gaia-dr2-astrom-2
+export GAIA_CAT_VER=2
+export TYCHO2_KD_DIR=/global/cfs/projectdirs/cosmo/staging/tycho2
+export LARGEGALAXIES_CAT=/global/cfs/projectdirs/cosmo/staging/largegalaxies/v6.0/LSLGA-model-v6.0.kd.fits
+export PS1CAT_DIR=/global/cfs/projectdirs/cosmo/work/ps1/cats/chunks-qz-star-v3
+export SKY_TEMPLATE_DIR=/global/cfs/cdirs/cosmo/work/legacysurvey/dr9m/calib/sky_pattern
+
+
+export PYTHONPATH=$CSCRATCH/Obiwan/dr9m/obiwan_code/legacypipe/py:/usr/local/lib/python:/usr/local/lib/python3.6/dist-packages:/src/unwise_psf/py:.
+
+# Don't add ~/.local/ to Python's sys.path
+export PYTHONNOUSERSITE=1
+
+# Force MKL single-threaded
+# https://software.intel.com/en-us/articles/using-threaded-intel-mkl-in-multi-thread-application
+export MKL_NUM_THREADS=1
+export OMP_NUM_THREADS=1
+
+# To avoid problems with MPI and Python multiprocessing
+export MPICH_GNI_FORK_MODE=FULLCOPY
+export KMP_AFFINITY=disabled
+
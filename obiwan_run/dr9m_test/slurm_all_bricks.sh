@@ -23,6 +23,40 @@ export do_more=no
 export minid=1
 export object=elg
 export nobj=200
+# randoms of random_division/GetBricksSrc.py: unset for
+# divided_randoms/brick_*.fits, or opt in to its brick sorted store with
+#export randoms_store=$CSCRATCH/Obiwan/dr9m/obiwan_out/$name_for_run/randoms_store
+# yes: each rank imports kenobi once and runs its bricks in process, under
+# the memory limit of example1.sh or the vsz_kb of ScheduledBricks.txt
+export in_process=no
+# yes: one rank per node relays bricks from rank 0 to the others of its node
+export submasters=no
+# with submasters=yes and brickstat/brick_cost.py's ScheduledBricks.txt: pack
+# bricks on a node within these cores and memory (kB), less the input cache
+# in /dev/shm and shm_reserve_gb (example1.py node_capacity); 0 to take one
+# brick per slave
+export node_cores=64
+export node_mem_kb=125000000
+# bricks write a fitblobs checkpoint every checkpoint_period s, and
+# checkpoint_margin s before the end of the job, when no new brick starts
+export checkpoint_period=600
+export checkpoint_margin=600
+# opt in with yes: kenobi writes matched-BRICK.fits at the end of each
+# brick, for collect/collect_mpi.py --matcher prematched
+#export write_matched=yes
+# opt in with yes: runbrick's workers pass the tim pixels in /dev/shm, not
+# pickled; shm_reserve_gb of node_mem_kb is then kept for them
+#export shared_tims=yes
+export shm_reserve_gb=8
+# opt in with yes: read the CCDs of gzipped survey-ccds tables from
+# uncompressed copies in the run's ccd-index, as large as the decompressed
+# tables (several GB), instead of decompressing them for every brick
+#export ccd_rows_copy=yes
+# opt in, with submasters=yes: each node copies the images and calibs of
+# its next chunk of bricks here while the current ones run, up to
+# cache_budget_gb (LRU); unset, they are read from $LEGACY_SURVEY_DIR
+#export cache_dir=/dev/shm/obiwan_inputs
+export cache_budget_gb=16
 
 export usecores=16
 export threads=$usecores
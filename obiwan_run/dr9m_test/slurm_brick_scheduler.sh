@@ -11,40 +11,19 @@
 # {4}: maxmem, in KB (93750000 total for knl, 125000000 total for haswell)
 # {5}: threads
 #writecat decam 125000000 $threads
-export LEGACY_SURVEY_DIR=$CSCRATCH/Obiwan/dr9m/obiwan_data
+# example1.py passes: brickname [threads [maxmem in KB]], from ScheduledBricks.txt
+# (maxmem is its vsz_kb, the peak virtual size of one process of the brick)
+source $(dirname $0)/obiwan_env.sh
+threads=${2:-$threads}
+maxmem=${3:-125000000}
 BB=${LEGACY_SURVEY_DIR}/
 echo $BB
-export DUST_DIR=/global/cfs/projectdirs/cosmo/data/dust/v0_1
-export UNWISE_COADDS_DIR=/global/cfs/projectdirs/cosmo/work/wise/outputs/merge/neo5/fulldepth:/global/cfs/projectdirs/cosmo/data/unwise/allwise/unwise-coadds/fulldepth
-export UNWISE_COADDS_TIMERESOLVED_DIR=/global/cfs/projectdirs/cosmo/work/wise/outputs/merge/neo5
-export UNWISE_MODEL_SKY_DIR=/global/cfs/cdirs/cosmo/work/wise/unwise_catalog/dr2/mod
-export GAIA_CAT_DIR=/global/cfs/projectdirs/cosmo/work/gaia/chunks-gaia-dr2-astrom-2
-export GAIA_CAT_VER=2
-export TYCHO2_KD_DIR=/global/cfs/projectdirs/cosmo/staging/tycho2
-export LARGEGALAXIES_CAT=/global/cfs/projectdirs/cosmo/staging/largegalaxies/v6.0/LSLGA-model-v6.0.kd.fits
-export PS1CAT_DIR=/global/cfs/projectdirs/cosmo/work/ps1/cats/chunks-qz-star-v3
-export SKY_TEMPLATE_DIR=/global/cfs/cdirs/cosmo/work/legacysurvey/dr9m/calib/sky_pattern
-
-
-export PYTHONPATH=$CSCRATCH/Obiwan/dr9m/obiwan_code/legacypipe/py:/usr/local/lib/python:/usr/local/lib/python3.6/dist-packages:/src/unwise_psf/py:.
-
-# Don't add ~/.local/ to Python's sys.path
-export PYTHONNOUSERSITE=1
-
-# Force MKL single-threaded
-# https://software.intel.com/en-us/articles/using-threaded-intel-mkl-in-multi-thread-application
-export MKL_NUM_THREADS=1
-export OMP_NUM_THREADS=1
-
-# To avoid problems with MPI and Python multiprocessing
-export MPICH_GNI_FORK_MODE=FULLCOPY
-export KMP_AFFINITY=disabled
 
 # Try limiting memory to avoid killing the whole MPI job...
 # 16 is the default for both Edison and Cori: it corresponds
 # to 3 and 4 bricks per node respectively.
 ncores=$threads
-ulimit -Sv 125000000
+ulimit -Sv $maxmem
 
 # Reduce the number of cores so that a task doesn't use too much memory.
 # Using more threads than the number of physical cores usually causes the
@@ -73,7 +52,7 @@ brick="$1"
 
 bri=$(echo $brick | head -c 3)
 
-RANDOMS_FROM_FITS=$CSCRATCH/Obiwan/dr9m/obiwan_out/$name_for_run/divided_randoms/brick_${brick}.fits
+RANDOMS_FROM_FITS=${randoms_store:-$CSCRATCH/Obiwan/dr9m/obiwan_out/$name_for_run/divided_randoms/brick_${brick}.fits}
 
 log="${outdir}/logs/${bri}/${brick}/${rsdir}/log.$brick"
 mkdir -p $(dirname $log)
@@ -81,6 +60,8 @@ echo $dirname
 echo logging to...${log}
 
 mkdir -p $outdir/metrics/$bri/${brick}/${rsdir}/
+checkpoint="${outdir}/checkpoint/${bri}/${brick}/${rsdir}/checkpoint-${brick}.pickle"
+mkdir -p $(dirname $checkpoint)
 
 echo Logging to: $log
 echo Running on $(hostname)
@@ -101,7 +82,7 @@ echo $PYTHONPATH
 python $CSCRATCH/Obiwan/dr9m/obiwan_code/py/kenobi.py \
 --dataset ${dataset} \
 --brick $brick \
---nobj ${nobj} --rowstart ${rowstart} -o ${object} \
+--nobj ${nobj} --rowstart ${rowstart} ${rowstarts:+--rowstarts ${rowstarts}} -o ${object} \
 --randoms_db ${randoms_db} --outdir $outdir \
 --threads $threads \
 --do_skipids $do_skipids \
@@ -111,16 +92,28 @@ python $CSCRATCH/Obiwan/dr9m/obiwan_code/py/kenobi.py \
 --pickle "${outdir}/pickles/${bri}/${brick}/${rsdir}/runbrick-%(brick)s-%%(stage)s.pickle" \
 --ps "${outdir}/metrics/${bri}/${brick}/${rsdir}/ps-${brick}-${SLURM_JOB_ID}.fits" \
 --ps-t0 $(date "+%s") \
+--checkpoint $checkpoint --checkpoint_period ${checkpoint_period:-600} \
 --write-stage writecat \
+${in_memory:+--in_memory} ${checkpoint_stages:+--checkpoint_stages ${checkpoint_stages}} \
+$([ "$write_matched" = yes ] && echo --write_matched) \
+$([ "$shared_tims" = yes ] && echo --shared_tims) \
+$([ "$ccd_rows_copy" = yes ] && echo --ccd_rows_copy) \
+${cache_dir:+--cache_dir $cache_dir} \
 --stage writecat \
 --no-galaxy-forcepsf \
 --less-masking \
 --run decam \
->> $log 2>&1
-
-
-
+>> $log 2>&1 &
 
+# example1.py sends USR1 before the job ends: kenobi.py writes its fitblobs
+# checkpoint, and the next run of the brick resumes from it
+pid=$!
+trap 'kill -USR1 $pid' USR1
+wait $pid
 status=$?
+while kill -0 $pid 2>/dev/null; do
+    wait $pid
+    status=$?
+done
 #cat $tmplog >> $log
 #python legacypipe/rmckpt.py --brick $brick --outdir $outdir
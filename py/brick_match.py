@@ -0,0 +1,102 @@
+"""
+Matching the simulated sources of a brick to its tractor catalog and
+reference stars, with kd-trees
+
+Used by kenobi.py (--write_matched, at the end of each rowstart) and
+collect/collect.py (kd_brick_match), which give the same columns
+"""
+import os
+import numpy as np
+
+PIXSCALE = 0.262 #arcsec per brick pixel
+
+def brick_center(brickname):
+    """ra,dec of a brick from its name, e.g. 2167p345"""
+    ra = int(brickname[:4])/10.
+    dec = int(brickname[5:])/10.
+    if brickname[4] == 'm':
+        dec = -dec
+    return ra, dec
+
+def tangent_plane(ra, dec, ra0, dec0):
+    """gnomonic projection about ra0,dec0, in degrees"""
+    ra, dec, ra0, dec0 = [np.radians(np.asarray(v, dtype=np.float64)) for v in (ra, dec, ra0, dec0)]
+    cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+    xi = np.cos(dec)*np.sin(ra-ra0)/cosc
+    eta = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/cosc
+    return np.degrees(np.vstack((xi, eta)).T)
+
+class NearestMatcher(object):
+    """kd-tree of a set of points, built once, queried for the nearest one"""
+    def __init__(self, xy):
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(xy)
+
+    def match(self, xy):
+        """index of the nearest point and distance to it"""
+        d, idx = self.tree.query(xy, k=1)
+        return idx, d
+
+def match_pixels(sim_x, sim_y, bx, by):
+    """nearest tractor source (bx,by) of each sim (x,y), both 0-indexed
+    brick pixels
+
+    Returns:
+        tuple: index, distance [deg]
+    """
+    idx, d = NearestMatcher(np.vstack((bx, by)).T).match(np.vstack((sim_x, sim_y)).T)
+    return idx, d*PIXSCALE/3600.
+
+def match_sky(brickname, ra, dec, ref_ra, ref_dec):
+    """nearest ref_ra,ref_dec of each ra,dec, in the tangent plane at the
+    brick center
+
+    Returns:
+        tuple: index, distance [deg]; None,None if there are no refs
+    """
+    if len(ref_ra) == 0:
+        return None, None
+    ra0, dec0 = brick_center(brickname)
+    tree = NearestMatcher(tangent_plane(ref_ra, ref_dec, ra0, dec0))
+    return tree.match(tangent_plane(ra, dec, ra0, dec0))
+
+def ref_sources_fn(outdir, brickname, rs_type):
+    """the ref-sources file of a brick (LegacySurveyData.find_file), where
+    kenobi's do_ith_cleanup moves it: outdir/metrics/bri/brick/rs_type/"""
+    return os.path.join(outdir, 'metrics', brickname[:3], brickname, rs_type,
+                        'reference-%s.fits' % brickname)
+
+def read_ref_stars(fn):
+    """ra, dec and radius arrays of the reference stars in the ref-sources
+    file fn, which stage_refs writes before it cuts the donotfit and
+    iscluster stars; empty arrays if there is no such file"""
+    import fitsio
+    if not os.path.exists(fn):
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    F = fitsio.FITS(fn)
+    if F[1].get_nrows() == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    T = F[1].read(columns=['ra', 'dec', 'radius'])
+    return T['ra'], T['dec'], T['radius']
+
+STAR_COLUMNS = ['star_distance', 'star_radius', 'MS_delta_ra', 'MS_delta_dec']
+
+def match_stars(brickname, ra, dec, ref_ra, ref_dec, ref_radius):
+    """nearest reference star of each ra,dec (tractor sources), see match_sky
+
+    Returns:
+        dict: the STAR_COLUMNS, distance [deg] to the star, its radius and
+            its ra,dec minus ra,dec; inf distance, zero radius and NaN
+            deltas if there are no reference stars
+    """
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    idx, distance = match_sky(brickname, ra, dec, ref_ra, ref_dec)
+    if idx is None:
+        nan = np.zeros(len(ra)) + np.nan
+        return dict(star_distance=np.zeros(len(ra)) + np.inf,
+                    star_radius=np.zeros(len(ra)),
+                    MS_delta_ra=nan, MS_delta_dec=nan.copy())
+    return dict(star_distance=distance,
+                star_radius=np.asarray(ref_radius, dtype=np.float64)[idx],
+                MS_delta_ra=np.asarray(ref_ra, dtype=np.float64)[idx] - ra,
+                MS_delta_dec=np.asarray(ref_dec, dtype=np.float64)[idx] - dec)
@@ -15,6 +15,9 @@ import sys
 import subprocess
 import time as time_builtin
 import shutil
+import copy
+import hashlib
+import zlib
 import logging
 import argparse
 import photutils
@@ -39,6 +42,7 @@ from astropy.coordinates import SkyCoord
 from db_tools import getSrcsInBrick
 from common import get_outdir_runbrick, get_brickinfo_hack
 from common import stack_tables
+from run_state import record_state, record_states
 
 # Sphinx build would crash
 #try:
@@ -58,6 +62,7 @@ from tractor.basics import GaussianMixtureEllipsePSF, RaDecPos
 from tractor.sfd import SFDMap
 from tractor.galaxy import DevGalaxy, ExpGalaxy
 from legacypipe.survey import LegacyEllipseWithPriors
+from legacypipe.utils import SparseImage
 import tractor
 from tractor import *
 
@@ -70,6 +75,46 @@ import galsim
 DATASETS=['cosmos','dr8','dr9']
 BRICKNAME='BRICKNAME'
 SURVEY_DIR='SURVEY_DIR'
+# (survey_dir, brickname) -> (brick, targetwcs), see get_brick_geometry
+BRICK_GEOMETRY={}
+# Read-only tables and maps kept for all the bricks a process runs
+# (see obiwan_run/*/example1.py in_process mode), see get_survey
+SURVEYS={}
+SURVEY_TABLES={}
+SFD_MAP=[]
+
+def get_survey(survey_dir):
+    """LegacySurveyData for survey_dir, one per process"""
+    if not survey_dir in SURVEYS:
+        SURVEYS[survey_dir]= LegacySurveyData(survey_dir=survey_dir)
+    return SURVEYS[survey_dir]
+
+def get_sfd_map():
+    """SFDMap, read once per process"""
+    if len(SFD_MAP) == 0:
+        SFD_MAP.append(SFDMap())
+    return SFD_MAP[0]
+
+def get_brick_geometry(brickname=None, survey_dir=None):
+    """Returns the survey-bricks row and the full brick WCS, once per process
+
+    Args:
+        brickname,survey_dir: default to the BRICKNAME, SURVEY_DIR globals
+            set in main()
+
+    Returns:
+        brick: single row fits_table (see get_brickinfo_hack)
+        targetwcs: wcs_for_brick(brick), the WCS of simcat x,y
+    """
+    if brickname is None:
+        brickname= BRICKNAME
+    if survey_dir is None:
+        survey_dir= SURVEY_DIR
+    key= (survey_dir, brickname)
+    if not key in BRICK_GEOMETRY:
+        brick= get_brickinfo_hack(get_survey(survey_dir),brickname)
+        BRICK_GEOMETRY[key]= (brick, wcs_for_brick(brick))
+    return BRICK_GEOMETRY[key]
 NN=0
 def write_dict(fn,d):
     '''d -- dictionary'''
@@ -149,6 +194,22 @@ class SimDecals(LegacySurveyData):
         image_eq_model: referred to as 'testA'
             wherever add a simulated source, replace both image and invvar of the image
             with that of the simulated source only
+        sparse_margin: None to read the whole CCD, otherwise only read the
+            windows of each CCD within this many arcsec (plus
+            SPARSE_RHALF_GROWTH half-light radii) of sparse_radec
+        sparse_radec: (ra,dec,rhalf) arrays, defaults to those of simcat
+        targetwcs: full brick WCS the simcat x,y are in, None to look it up
+            with get_brick_geometry in each process
+        stamp_engine: 'buildstamp' for the per source BuildStamp, 'batch'
+            to draw the elg/lrg sims with BatchStamp
+        psf_grid: see BatchStamp
+        cache_dir: node-local copy of (part of) survey_dir, filled by
+            legacypipe/prefetch.py, read first if the file is there
+        ccd_index_dir: where the RA,Dec index sidecars of the CCDs tables
+            go if survey_dir is read-only, shared by the bricks of a run
+            (output_dir is per brick)
+        ccd_rows_copy: read the CCDs of gzipped CCDs tables from
+            uncompressed copies there, as large as the decompressed tables
 
     Attributes:
         DR: see above
@@ -165,14 +226,19 @@ class SimDecals(LegacySurveyData):
 
     def __init__(self, dataset=None, survey_dir=None, metacat=None, simcat=None,
                  output_dir=None,add_sim_noise=False, seed=0,
-                 image_eq_model=False,**kwargs):
+                 image_eq_model=False, sparse_margin=None, sparse_radec=None,
+                 targetwcs=None, stamp_engine='buildstamp', psf_grid=None,
+                 cache_dir=None, ccd_index_dir=None, ccd_rows_copy=False, **kwargs):
         self.dataset= dataset
         kw= dict(survey_dir=survey_dir,
-                 output_dir=output_dir)
+                 output_dir=output_dir,
+                 cache_dir=cache_dir)
         if self.dataset == 'cosmos':
             kw.update(subset=kwargs['subset'])
         super(SimDecals, self).__init__(**kw)
 
+        self.ccd_index_dir= ccd_index_dir
+        self.ccd_rows_copy= ccd_rows_copy
         self.metacat = metacat
         self.simcat = simcat
         # Additional options from command line
@@ -180,6 +246,21 @@ class SimDecals(LegacySurveyData):
         self.seed= seed
         self.image_eq_model= image_eq_model
         print('SimDecals: self.image_eq_model=',self.image_eq_model)
+        self.sparse_margin= sparse_margin
+        if sparse_radec is None and simcat is not None:
+            sparse_radec= (simcat.ra, simcat.dec, simcat.rhalf)
+        self.sparse_radec= sparse_radec
+        # pickled along to the read_one_tim workers
+        self.targetwcs= targetwcs
+        self.stamp_engine= stamp_engine
+        self.psf_grid= psf_grid
+
+    def ccds_touching_wcs(self, wcs, **kwargs):
+        ccds= super(SimDecals, self).ccds_touching_wcs(wcs, **kwargs)
+        if (ccds is None or self.sparse_margin is None or
+            self.sparse_radec is None):
+            return ccds
+        return sparse_windows(self, ccds)
 
     def get_image_object(self, t):
         if self.dataset == 'cosmos':
@@ -198,6 +279,37 @@ class SimDecals(LegacySurveyData):
         """see legacypipe/runs.py"""
         return fns
 
+    def get_table_key(self, name):
+        return (self.__class__.__name__, self.survey_dir,
+                getattr(self,'subset',None), name)
+
+    def get_ccds_readonly(self):
+        """Shared with the other SimDecals of this process (see SURVEY_TABLES)"""
+        if self.ccds is None:
+            key= self.get_table_key('ccds')
+            if not key in SURVEY_TABLES:
+                SURVEY_TABLES[key]= super(SimDecals, self).get_ccds_readonly()
+            self.ccds= SURVEY_TABLES[key]
+        return self.ccds
+
+    def get_bricks_readonly(self):
+        """Shared with the other SimDecals of this process (see SURVEY_TABLES)"""
+        if self.bricks is None:
+            key= self.get_table_key('bricks')
+            if not key in SURVEY_TABLES:
+                SURVEY_TABLES[key]= super(SimDecals, self).get_bricks_readonly()
+            self.bricks= SURVEY_TABLES[key]
+        return self.bricks
+
+    def get_brick_index(self):
+        """Shared with the other SimDecals of this process (see SURVEY_TABLES)"""
+        if self.brick_index is None:
+            key= self.get_table_key('brick_index')
+            if not key in SURVEY_TABLES:
+                SURVEY_TABLES[key]= super(SimDecals, self).get_brick_index()
+            self.brick_index= SURVEY_TABLES[key]
+        return self.brick_index
+
     def ccds_for_fitting(self, brick, ccds):
         if self.dataset in ['dr3','dr5','dr8']:#dr9 is decam/90prime/mosaic
             return np.flatnonzero(ccds.camera == 'decam')
@@ -207,9 +319,30 @@ class SimDecals(LegacySurveyData):
             #   return np.flatnonzero(np.logical_or(ccds.camera == 'mosaic',
         #                         ccds.camera == '90prime'))
 
+    def get_ccd_indices(self):
+        """Shared with the other SimDecals of this process (see SURVEY_TABLES)"""
+        if self.ccd_indices is None:
+            key= self.get_table_key('ccd_indices')
+            if not key in SURVEY_TABLES:
+                SURVEY_TABLES[key]= super(SimDecals, self).get_ccd_indices()
+            self.ccd_indices= SURVEY_TABLES[key]
+        return self.ccd_indices
+
     def filter_ccd_kd_files(self, fns):
-        """see legacypipe/runs.py"""
-        return []
+        """Only the kd-trees of the survey-ccds tables get_ccds reads, and
+        not older than them: their rows must be those of the tables. Without
+        any, ccds_touching_wcs uses the RA,Dec index sidecars of the tables"""
+        ccdfns= dict((os.path.basename(fn).replace('.fits.gz',''), fn)
+                     for fn in self.filter_ccds_files(self.find_file('ccds')))
+        keep= []
+        for fn in fns:
+            ccdfn= ccdfns.get(os.path.basename(fn).replace('.kd.fits',''))
+            if ccdfn is not None and os.path.getmtime(fn) >= os.path.getmtime(ccdfn):
+                keep.append(fn)
+        # all of them or none, or some CCDs would be missed
+        if len(keep) < len(ccdfns):
+            return []
+        return keep
 
 def get_srcimg_invvar(stamp_ivar,img_ivar):
     """stamp_ivar, img_ivar -- galsim Image objects"""
@@ -264,7 +397,87 @@ class SimDecalsCosmos(SimDecals,CosmosSurvey):
 #     pass
 
 
-class SimImageMosaic(MosaicImage):
+# half-light radii a sparse window extends beyond sparse_margin, so the
+# window follows the size of the blob a source ends up in
+SPARSE_RHALF_GROWTH= 5.
+
+def sparse_rects(survey, wcs, w, h):
+    """[x0,x1) [y0,y1) windows of a w x h image with wcs around survey.sparse_radec
+
+    Each source gets a box of sparse_margin arcsec plus SPARSE_RHALF_GROWTH
+        times its rhalf, the overlapping boxes are merged (footprint_rects)
+    """
+    from legacypipe.survey import footprint_rects
+    ra,dec = survey.sparse_radec[:2]
+    if len(survey.sparse_radec) > 2:
+        rhalf = np.array(survey.sparse_radec[2], dtype=float)
+    else:
+        rhalf = np.zeros(len(ra))
+    ok,x,y = wcs.radec2pixelxy(ra, dec)
+    # FITS to python image coords
+    x = x - 1
+    y = y - 1
+    margin = (survey.sparse_margin + SPARSE_RHALF_GROWTH * rhalf) / wcs.pixel_scale()
+    J = np.flatnonzero(ok)
+    return footprint_rects([(x[j]-margin[j], x[j]+1+margin[j],
+                             y[j]-margin[j], y[j]+1+margin[j]) for j in J],
+                           w, h)
+
+def sparse_windows(survey, ccds):
+    """One row of ccds per window of the CCD to read around survey.sparse_radec
+
+    Each window of a CCD (sparse_rects) becomes a copy of the CCD row
+        with sparse_x0,sparse_x1,sparse_y0,sparse_y1 set (x1,y1 exclusive).
+        A single bounding box of all the sources (e.g. every realization of
+        --rowstarts) would read most of the CCD. CCDs with no source nearby
+        are dropped.
+    """
+    I,boxes = [],[]
+    for i,ccd in enumerate(ccds):
+        rects = sparse_rects(survey, survey.get_approx_wcs(ccd),
+                             ccd.width, ccd.height)
+        for r in rects:
+            I.append(i)
+            boxes.append(r)
+    if len(I) == 0:
+        return None
+    ccds = ccds[np.array(I)]
+    boxes = np.array(boxes, dtype=np.int32).reshape(-1,4)
+    ccds.sparse_x0 = boxes[:,0]
+    ccds.sparse_x1 = boxes[:,1]
+    ccds.sparse_y0 = boxes[:,2]
+    ccds.sparse_y1 = boxes[:,3]
+    return ccds
+
+class SparseReadMixin(object):
+    """Reads only a window of a CCD around the simulated sources
+
+    Used when survey.sparse_margin is set, SimDecals.ccds_touching_wcs then
+        lists a CCD once per window (see sparse_windows) and the pixels read
+        are that window, clipped to the usual extent. fitsio only decompresses
+        the tiles a slice touches, so the image, invvar and dq reads all
+        shrink with the window.
+    """
+    def __init__(self, survey, t):
+        super(SparseReadMixin, self).__init__(survey, t)
+        if getattr(t, 'sparse_x0', None) is not None:
+            self.name += '-x%iy%i' % (t.sparse_x0, t.sparse_y0)
+
+    def get_image_extent(self, wcs=None, slc=None, radecpoly=None):
+        x0,x1,y0,y1,slc = super(SparseReadMixin, self).get_image_extent(
+                            wcs=wcs, slc=slc, radecpoly=radecpoly)
+        t = self.t
+        if slc is None or getattr(t, 'sparse_x0', None) is None:
+            return x0,x1,y0,y1,slc
+        x0 = max(x0, t.sparse_x0)
+        x1 = min(x1, t.sparse_x1)
+        y0 = max(y0, t.sparse_y0)
+        y1 = min(y1, t.sparse_y1)
+        if x0 >= x1 or y0 >= y1:
+            return 0,0,0,0,None
+        return x0,x1,y0,y1,(slice(y0,y1), slice(x0,x1))
+
+class SimImageMosaic(SparseReadMixin, MosaicImage):
     def __init__(self, survey, t):
         super(SimImageMosaic, self).__init__(survey, t)
         self.t = t
@@ -282,99 +495,14 @@ class SimImageMosaic(MosaicImage):
         #shot the image to 0
         #tim.data = np.zeros(tim.data.shape)
 
-        t1=time_builtin.clock()
-        objtype = self.survey.metacat.get('objtype')[0]
-        objstamp = BuildStamp(tim, seed=self.survey.seed,
-                              camera=self.t.camera,
-                              gain=tim.gain,exptime=self.t.exptime)
-        # ids make it onto a ccd (geometry cut)
-        tim.ids_added=[]
-
-        # Grab the data and inverse variance images [nanomaggies!]
-        tim_image = galsim.Image(tim.getImage())
-        tim_invvar = galsim.Image(tim.getInvvar())
-        tim_dq = galsim.Image(tim.dq)
-        # Also store galaxy sims and sims invvar
-        sims_image = tim_image.copy()
-        sims_image.fill(0.0)
-        sims_ivar = sims_image.copy()
-
-        # Store simulated galaxy images in tim object
-        # Loop on each object.
-        #f = open(self.stamp_stat_fn,'a')
-        for ii, obj in enumerate(self.survey.simcat):
-            # Print timing
-            t0= Time()
-            if objtype in ['lrg','elg']:
-                obj.n = int(obj.n)
-                strin= 'Drawing 1 %s: n=%.2f, rhalf=%.2f, e1=%.2f, e2=%.2f' % \
-                        (objtype.upper(), obj.n,obj.rhalf,obj.e1,obj.e2)
-                print(strin)
-
-            if objtype == 'star':
-                stamp = objstamp.star(obj)
-            elif objtype == 'elg':
-                stamp = objstamp.elg(obj)
-            elif objtype == 'lrg':
-                stamp = objstamp.lrg(obj)
-            elif objtype == 'qso':
-                stamp = objstamp.qso(obj)
-            t0= ptime('Finished Drawing %s: id=%d band=%s dbflux=%f addedflux=%f' %
-                (objtype.upper(), obj.id,objstamp.band,
-                 obj.get(objstamp.band+'flux'),stamp.array.sum()), t0)
-            stamp_nonoise= stamp.copy()
-            if self.survey.add_sim_noise:
-                stamp += noise_for_galaxy(stamp,objstamp.nano2e)
-            ivarstamp= ivar_for_galaxy(stamp,objstamp.nano2e)
-            # Add source if EVEN 1 pix falls on the CCD
-            overlap = stamp.bounds & tim_image.bounds
-            if overlap.area() > 0:
-                print('Stamp overlaps tim: id=%d band=%s' % (obj.id,objstamp.band))
-                tim.ids_added.append(obj.id)
-                stamp = stamp[overlap]
-                ivarstamp = ivarstamp[overlap]
-                stamp_nonoise= stamp_nonoise[overlap]
-
-                # Zero out invvar where bad pixel mask is flagged (> 0)
-                keep = np.ones(tim_dq[overlap].array.shape)
-                keep[ tim_dq[overlap].array > 0 ] = 0.
-                ivarstamp *= keep
-                # Add stamp to image
-                back= tim_image[overlap].copy()
-                tim_image[overlap] += stamp #= back.copy() + stamp.copy()
-                #print('this is mosaic')
-                #import pdb;pdb.set_trace()
-                #print(objstamp.xpos,objstamp.ypos)
-                #print(stamp.array.max())
-                #print(tim_image[objstamp.ypos][objstamp.xpos])
-                # Add variances
-                back_ivar= tim_invvar[overlap].copy()
-                tot_ivar= get_srcimg_invvar(ivarstamp, back_ivar)
-                tim_invvar[overlap] = tot_ivar.copy()
-
-                #Extra
-                sims_image[overlap] += stamp.copy()
-                sims_ivar[overlap] += ivarstamp.copy()
-
-                if np.min(sims_ivar.array) < 0:
-                    log.warning('Negative invvar!')
-                    import pdb ; pdb.set_trace()
-        #f.close()
-        tim.sims_image = sims_image.array
-        tim.sims_inverr = np.sqrt(sims_ivar.array)
-        # Can set image=model, ivar=1/model for testing
-        if self.survey.image_eq_model:
-            tim.data = sims_image.array.copy()
-            tim.inverr = np.zeros(tim.data.shape)
-            tim.inverr[sims_image.array > 0.] = np.sqrt(1./sims_image.array.copy()[sims_image.array > 0.])
-        else:
-            tim.data = tim_image.array
-            tim.inverr = np.sqrt(tim_invvar.array)
-        sys.stdout.flush()
-        #print('get_tractor_image in obiwan :time '+str(time_builtin.clock()-t1))
+        if self.survey.simcat is None:
+            # pristine tim, sims are added later (see do_realizations)
+            return tim
+        tim = inject_simcat(tim, self.survey, camera=self.t.camera,
+                            exptime=self.t.exptime)
         return tim
 
-class SimImageBok(BokImage):
+class SimImageBok(SparseReadMixin, BokImage):
     def __init__(self, survey, t):
         super(SimImageBok, self).__init__(survey, t)
         self.t = t
@@ -391,128 +519,19 @@ class SimImageBok(BokImage):
         #shot the image to 0
         #tim.data = np.zeros_like(tim.data)
 
-        t1=time_builtin.clock()
-        objtype = self.survey.metacat.get('objtype')[0]
-        objstamp = BuildStamp(tim, seed=self.survey.seed,
-                              camera=self.t.camera,
-                              gain=tim.gain,exptime=self.t.exptime)
-        # ids make it onto a ccd (geometry cut)
-        tim.ids_added=[]
-
-        # Grab the data and inverse variance images [nanomaggies!]
-        tim_image = galsim.Image(tim.getImage())
-        tim_invvar = galsim.Image(tim.getInvvar())
-        tim_dq = galsim.Image(tim.dq)
-        # Also store galaxy sims and sims invvar
-        sims_image = tim_image.copy()
-        sims_image.fill(0.0)
-        sims_ivar = sims_image.copy()
-
-        # Store simulated galaxy images in tim object
-        # Loop on each object.
-        #f = open(self.stamp_stat_fn,'a')
-        for ii, obj in enumerate(self.survey.simcat):
-            # Print timing
-            t0= Time()
-            if objtype in ['lrg','elg']:
-                obj.n = int(obj.n)
-                strin= 'Drawing 1 %s: n=%.2f, rhalf=%.2f, e1=%.2f, e2=%.2f' % \
-                        (objtype.upper(), obj.n,obj.rhalf,obj.e1,obj.e2)
-                print(strin)
-
-            if objtype == 'star':
-                stamp = objstamp.star(obj)
-            elif objtype == 'elg':
-                stamp = objstamp.elg(obj)
-            elif objtype == 'lrg':
-                stamp = objstamp.lrg(obj)
-            elif objtype == 'qso':
-                stamp = objstamp.qso(obj)
-            t0= ptime('Finished Drawing %s: id=%d band=%s dbflux=%f addedflux=%f' %
-                (objtype.upper(), obj.id,objstamp.band,
-                 obj.get(objstamp.band+'flux'),stamp.array.sum()), t0)
-            stamp_nonoise= stamp.copy()
-            if self.survey.add_sim_noise:
-                stamp += noise_for_galaxy(stamp,objstamp.nano2e)
-            ivarstamp= ivar_for_galaxy(stamp,objstamp.nano2e)
-            # Add source if EVEN 1 pix falls on the CCD
-            overlap = stamp.bounds & tim_image.bounds
-            if overlap.area() > 0:
-
-                print('Stamp overlaps tim: id=%d band=%s' % (obj.id,objstamp.band))
-                tim.ids_added.append(obj.id)
-                stamp = stamp[overlap]
-                ivarstamp = ivarstamp[overlap]
-                stamp_nonoise= stamp_nonoise[overlap]  
-                
-                # Zero out invvar where bad pixel mask is flagged (> 0)
-                keep = np.ones(tim_dq[overlap].array.shape)
-                keep[ tim_dq[overlap].array > 0 ] = 0.
-                ivarstamp *= keep
-
-                # Add stamp to image
-                back= tim_image[overlap].copy()
-                #import pdb;pdb.set_trace()
-                tim_image[overlap] += stamp #= back.copy() + stamp.copy()
-                #global BRICKNAME
-                #global SURVEY_DIR
-                #survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-                #brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-                #brickwcs = wcs_for_brick(brickinfo)
-                #W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-                #get_offset_image(tim,objstamp.target_x,objstamp.target_y,stamp.array.max(),tim_image.array)
-                #print('this is bok image')
-                #import pdb;pdb.set_trace()
-                #brick00 = survey.get_brick_by_name(BRICKNAME)
-                #targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
-                #flag, xx, yy = tim.subwcs.radec2pixelxy(*(targetwcs.pixelxy2radec(objstamp.target_x+1,objstamp.target_x+1)[-2:]))
-                #print(xx,yy)
-                #print(objstamp.xpos,objstamp.ypos)
-                #print(stamp.array.max())
-                #print(tim_image.array[objstamp.ypos][objstamp.xpos])
-                #get_offset_check(tim,objstamp.xpos,objstamp.ypos)
-                #tim_image = galsim.Image(np.zeros_like(tim.data))
-                # Add variances
-                back_ivar= tim_invvar[overlap].copy()
-                tot_ivar= get_srcimg_invvar(ivarstamp, back_ivar)
-                tim_invvar[overlap] = tot_ivar.copy()
-
-                #Extra
-                sims_image[overlap] += stamp.copy()
-                sims_ivar[overlap] += ivarstamp.copy()
-                
-                if np.min(sims_ivar.array) < 0:
-                    log.warning('Negative invvar!')
-                    import pdb ; pdb.set_trace()
-
-
-        #f.close()
-        tim.sims_image = sims_image.array
-        tim.sims_inverr = np.sqrt(sims_ivar.array)
-        # Can set image=model, ivar=1/model for testing
-        if self.survey.image_eq_model:
-            tim.data = sims_image.array.copy()
-            tim.inverr = np.zeros(tim.data.shape)
-            tim.inverr[sims_image.array > 0.] = np.sqrt(1./sims_image.array.copy()[sims_image.array > 0.])
-        else:
-            tim.data = tim_image.array
-            tim.inverr = np.sqrt(tim_invvar.array)
-        sys.stdout.flush()
-        #print('get_tractor_image in obiwan :time '+str(time_builtin.clock()-t1))
+        if self.survey.simcat is None:
+            # pristine tim, sims are added later (see do_realizations)
+            return tim
+        tim = inject_simcat(tim, self.survey, camera=self.t.camera,
+                            exptime=self.t.exptime)
         
         return tim
 
 
 def get_offset_image(tim,x_cen,y_cen,value,img):
         #Jun9 input x,y coordinat, output x,y on coimg
-        global BRICKNAME
-        global SURVEY_DIR
-        survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-        brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-        brickwcs = wcs_for_brick(brickinfo)
-        W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-        brick00 = survey.get_brick_by_name(BRICKNAME)
-        targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+        _,targetwcs = get_brick_geometry()
+        W, H = targetwcs.get_width(), targetwcs.get_height()
         from astrometry.util.miscutils import patch_image
         from astrometry.util.resample import resample_with_wcs
         #set the center pixel to 100
@@ -534,14 +553,8 @@ def get_offset_image(tim,x_cen,y_cen,value,img):
 
 def get_offset_check(tim,x_cen,y_cen):
         #Jun9 input x,y coordinat, output x,y on coimg
-        global BRICKNAME
-        global SURVEY_DIR
-        survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-        brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-        brickwcs = wcs_for_brick(brickinfo)
-        W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-        brick00 = survey.get_brick_by_name(BRICKNAME)
-        targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+        _,targetwcs = get_brick_geometry()
+        W, H = targetwcs.get_width(), targetwcs.get_height()
         from astrometry.util.miscutils import patch_image
         from astrometry.util.resample import resample_with_wcs
         metric_img = np.zeros_like(tim.data)
@@ -570,14 +583,8 @@ def get_offset_check(tim,x_cen,y_cen):
 
 def get_center_pix(tim,target_x,target_y):
      #Jun9 input x,y coordinat, output x,y on coimg
-        global BRICKNAME
-        global SURVEY_DIR
-        survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-        brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-        brickwcs = wcs_for_brick(brickinfo)
-        W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-        brick00 = survey.get_brick_by_name(BRICKNAME)
-        targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+        _,targetwcs = get_brick_geometry()
+        W, H = targetwcs.get_width(), targetwcs.get_height()
         from astrometry.util.miscutils import patch_image
         from astrometry.util.resample import resample_with_wcs
         metric_img = np.zeros_like(tim.data)
@@ -600,8 +607,60 @@ def get_center_pix(tim,target_x,target_y):
         else:
             return None,None
 
+def crop_tim(tim, x0, x1, y0, y1):
+    """tim cut to its pixels [x0,x1) [y0,y1), as SparseReadMixin would have read them
+
+    The pixels are views of those of tim, wcs, sky and psf are shifted
+        (as legacypipe.runbrick._blob_iter does) and the other attributes
+        of tim are shared
+    """
+    slc = (slice(y0,y1), slice(x0,x1))
+    sub = tractor.Image(data=tim.data[slc], inverr=tim.inverr[slc],
+                        wcs=tim.getWcs().shifted(x0, y0),
+                        psf=tim.getPsf().getShifted(x0, y0),
+                        photocal=tim.getPhotoCal(),
+                        sky=tim.getSky().shifted(x0, y0),
+                        name='%s-x%iy%i' % (tim.name, tim.x0+x0, tim.y0+y0))
+    for key,val in tim.__dict__.items():
+        if not key in sub.__dict__:
+            setattr(sub, key, val)
+    if tim.dq is not None:
+        sub.dq = tim.dq[slc]
+    sub.x0 = tim.x0 + x0
+    sub.y0 = tim.y0 + y0
+    sub.slice = (slice(sub.y0, sub.y0 + y1-y0), slice(sub.x0, sub.x0 + x1-x0))
+    sub.subwcs = tim.subwcs.get_subimage(x0, y0, x1-x0, y1-y0)
+    return sub
+
+def window_tims(R, survey):
+    """stage_tims output R of whole CCDs cut to the --sparse_margin windows
+
+    What SimDecals with sparse_margin reads (sparse_windows) taken from
+        whole CCD tims, e.g. those of read_tims_cache: one tim per window
+        of survey.sparse_radec on each tim (crop_tim), the ccds row of the
+        tim repeated for each of them with its extent columns set for the
+        window
+    """
+    from legacypipe.runbrick import set_ccd_extents
+    from legacypipe.utils import NothingToDoError
+    tims,I = [],[]
+    for i,tim in enumerate(R['tims']):
+        h,w = tim.shape
+        for x0,x1,y0,y1 in sparse_rects(survey, tim.subwcs, w, h):
+            tims.append(crop_tim(tim, x0, x1, y0, y1))
+            I.append(i)
+    if len(tims) == 0:
+        raise NothingToDoError('No CCD pixels near the simulated sources')
+    ccds = R['ccds'][np.array(I)]
+    set_ccd_extents(ccds, tims, R['targetwcs'])
+    timbands = set([tim.band for tim in tims])
+    R = dict(R)
+    R.update(tims=tims, ccds=ccds,
+             bands=[b for b in R['bands'] if b in timbands])
+    return R
+
 # try:
-class SimImage(DecamImage):
+class SimImage(SparseReadMixin, DecamImage):
     """Adds simulated sources to a single exposure
 
     Similar behavior as legacypipe.decam.DecamImage. Instead of
@@ -647,91 +706,11 @@ class SimImage(DecamImage):
         #shot the image to 0
         #tim.data = np.zeros(tim.data.shape)
 
-        t1=time_builtin.clock()
-        objtype = self.survey.metacat.get('objtype')[0]
-        objstamp = BuildStamp(tim, seed=self.survey.seed,
-                              camera=self.t.camera,
-                              gain=tim.gain,exptime=self.t.exptime)
-        # ids make it onto a ccd (geometry cut)
-        tim.ids_added=[]
-
-        # Grab the data and inverse variance images [nanomaggies!]
-        tim_image = galsim.Image(tim.getImage())
-        tim_invvar = galsim.Image(tim.getInvvar())
-        tim_dq = galsim.Image(tim.dq)
-        # Also store galaxy sims and sims invvar
-        sims_image = tim_image.copy()
-        sims_image.fill(0.0)
-        sims_ivar = sims_image.copy()
-
-        # Store simulated galaxy images in tim object
-        # Loop on each object.
-        #f = open(self.stamp_stat_fn,'a')
-        for ii, obj in enumerate(self.survey.simcat):
-            # Print timing
-            t0= Time()
-            if objtype in ['lrg','elg']:
-                obj.n = int(obj.n)
-                strin= 'Drawing 1 %s: n=%.2f, rhalf=%.2f, e1=%.2f, e2=%.2f' % \
-                        (objtype.upper(), obj.n,obj.rhalf,obj.e1,obj.e2)
-                print(strin)
-
-            if objtype == 'star':
-                stamp = objstamp.star(obj)
-            elif objtype == 'elg':
-                stamp = objstamp.elg(obj)
-            elif objtype == 'lrg':
-                stamp = objstamp.lrg(obj)
-            elif objtype == 'qso':
-                stamp = objstamp.qso(obj)
-            t0= ptime('Finished Drawing %s: id=%d band=%s dbflux=%f addedflux=%f' %
-                (objtype.upper(), obj.id,objstamp.band,
-                 obj.get(objstamp.band+'flux'),stamp.array.sum()), t0)
-            stamp_nonoise= stamp.copy()
-            if self.survey.add_sim_noise:
-                stamp += noise_for_galaxy(stamp,objstamp.nano2e)
-            ivarstamp= ivar_for_galaxy(stamp,objstamp.nano2e)
-            # Add source if EVEN 1 pix falls on the CCD
-            overlap = stamp.bounds & tim_image.bounds
-            if overlap.area() > 0:
-                print('Stamp overlaps tim: id=%d band=%s' % (obj.id,objstamp.band))
-                tim.ids_added.append(obj.id)
-                stamp = stamp[overlap]
-                ivarstamp = ivarstamp[overlap]
-                stamp_nonoise= stamp_nonoise[overlap]
-
-                # Zero out invvar where bad pixel mask is flagged (> 0)
-                keep = np.ones(tim_dq[overlap].array.shape)
-                keep[ tim_dq[overlap].array > 0 ] = 0.
-                ivarstamp *= keep
-                # Add stamp to image
-                back= tim_image[overlap].copy()
-                tim_image[overlap] += stamp #= back.copy() + stamp.copy()
-                # Add variances
-                back_ivar= tim_invvar[overlap].copy()
-                tot_ivar= get_srcimg_invvar(ivarstamp, back_ivar)
-                tim_invvar[overlap] = tot_ivar.copy()
-
-                #Extra
-                sims_image[overlap] += stamp.copy()
-                sims_ivar[overlap] += ivarstamp.copy()
-
-                if np.min(sims_ivar.array) < 0:
-                    log.warning('Negative invvar!')
-                    import pdb ; pdb.set_trace()
-        #f.close()
-        tim.sims_image = sims_image.array
-        tim.sims_inverr = np.sqrt(sims_ivar.array)
-        # Can set image=model, ivar=1/model for testing
-        if self.survey.image_eq_model:
-            tim.data = sims_image.array.copy()
-            tim.inverr = np.zeros(tim.data.shape)
-            tim.inverr[sims_image.array > 0.] = np.sqrt(1./sims_image.array.copy()[sims_image.array > 0.])
-        else:
-            tim.data = tim_image.array
-            tim.inverr = np.sqrt(tim_invvar.array)
-        sys.stdout.flush()
-        #print('get_tractor_image in obiwan :time '+str(time_builtin.clock()-t1))
+        if self.survey.simcat is None:
+            # pristine tim, sims are added later (see do_realizations)
+            return tim
+        tim = inject_simcat(tim, self.survey, camera=self.t.camera,
+                            exptime=self.t.exptime)
         return tim
 # except NameError:
 #     pass
@@ -751,21 +730,321 @@ class SimImageCosmos(SimImage,DecamImagePlusNoise):
 # except NameError:
 #     pass
 
-def noise_for_galaxy(gal,nano2e):
-    """Returns numpy array of noise in Img count units for gal in image cnt units"""
+def inject_simcat(tim, survey, camera=None, exptime=None):
+    """Adds the sources in survey.simcat to tim, in place
+
+    Args:
+        tim: tractor Image returned by LegacySurveyImage.get_tractor_image
+        survey: SimDecals object, provides simcat, metacat, seed, add_sim_noise,
+            image_eq_model
+        camera,exptime: of the CCD tim was read from
+
+    Returns:
+        tim, with data/inverr including the sims and ids_added, sims_image,
+            sims_inverr set (SparseImages, only the tiles under the stamps
+            are allocated)
+    """
+    log = logging.getLogger('decals_sim')
+    objtype = survey.metacat.get('objtype')[0]
+    if survey.stamp_engine == 'batch' and objtype in BatchStamp.objtypes:
+        return inject_simcat_batch(tim, survey, camera=camera)
+    objstamp = BuildStamp(tim, seed=survey.seed,
+                          camera=camera,
+                          gain=tim.gain,exptime=exptime,
+                          targetwcs=survey.targetwcs)
+    # ids make it onto a ccd (geometry cut)
+    tim.ids_added=[]
+
+    # Grab the data and inverse variance images [nanomaggies!]
+    tim_image = galsim.Image(tim.getImage())
+    tim_invvar = galsim.Image(tim.getInvvar())
+    tim_dq = galsim.Image(tim.dq)
+    # Also store galaxy sims and sims invvar
+    sims_image = SparseImage(tim.shape)
+    sims_ivar = SparseImage(tim.shape)
+
+    # Store simulated galaxy images in tim object
+    # Loop on each object.
+    for ii, obj in enumerate(survey.simcat):
+        # Print timing
+        t0= Time()
+        if objtype in ['lrg','elg']:
+            obj.n = int(obj.n)
+            strin= 'Drawing 1 %s: n=%.2f, rhalf=%.2f, e1=%.2f, e2=%.2f' % \
+                    (objtype.upper(), obj.n,obj.rhalf,obj.e1,obj.e2)
+            print(strin)
+
+        if objtype == 'star':
+            stamp = objstamp.star(obj)
+        elif objtype == 'elg':
+            stamp = objstamp.elg(obj)
+        elif objtype == 'lrg':
+            stamp = objstamp.lrg(obj)
+        elif objtype == 'qso':
+            stamp = objstamp.qso(obj)
+        t0= ptime('Finished Drawing %s: id=%d band=%s dbflux=%f addedflux=%f' %
+            (objtype.upper(), obj.id,objstamp.band,
+             obj.get(objstamp.band+'flux'),stamp.array.sum()), t0)
+        if survey.add_sim_noise:
+            rng= get_source_rng(survey.seed, obj.id,
+                                tim.imobj.expnum, tim.imobj.ccdname)
+            stamp += noise_for_galaxy(stamp,objstamp.nano2e,rng=rng)
+        # Add source if EVEN 1 pix falls on the CCD
+        overlap = stamp.bounds & tim_image.bounds
+        if overlap.area() > 0:
+            print('Stamp overlaps tim: id=%d band=%s' % (obj.id,objstamp.band))
+            tim.ids_added.append(obj.id)
+            stamp = stamp[overlap]
+            ivarstamp, tot_ivar = get_stamp_invvars(stamp, objstamp.nano2e,
+                                    tim_dq[overlap].array, tim_invvar[overlap].copy())
+            # Add stamp to image
+            tim_image[overlap] += stamp
+            # Add variances
+            tim_invvar[overlap] = tot_ivar.copy()
+
+            #Extra
+            slc = (slice(overlap.ymin-1, overlap.ymax),
+                   slice(overlap.xmin-1, overlap.xmax))
+            sims_image.add(slc, stamp.array)
+            sims_ivar.add(slc, ivarstamp.array)
+
+            if sims_ivar.min() < 0:
+                log.warning('Negative invvar!')
+                import pdb ; pdb.set_trace()
+    # SparseImages, np.asarray() for the full CCD
+    tim.sims_image = sims_image
+    tim.sims_inverr = sims_ivar.map(np.sqrt)
+    # Can set image=model, ivar=1/model for testing
+    if survey.image_eq_model:
+        tim.data = np.asarray(sims_image)
+        tim.inverr = np.zeros(tim.data.shape)
+        tim.inverr[tim.data > 0.] = np.sqrt(1./tim.data[tim.data > 0.])
+    else:
+        tim.data = tim_image.array
+        tim.inverr = np.sqrt(tim_invvar.array)
+    sys.stdout.flush()
+    return tim
+
+def inject_simcat_batch(tim, survey, camera=None):
+    """inject_simcat with all the sources drawn by one BatchStamp"""
+    stamps = BatchStamp(tim, seed=survey.seed, camera=camera, gain=tim.gain,
+                        targetwcs=survey.targetwcs, psf_grid=survey.psf_grid)
+    tim.ids_added, sims_image, sims_ivar = stamps.inject(
+                        survey.simcat, add_sim_noise=survey.add_sim_noise)
+    # SparseImages, np.asarray() for the full CCD
+    tim.sims_image = sims_image
+    tim.sims_inverr = sims_ivar.map(np.sqrt)
+    # Can set image=model, ivar=1/model for testing
+    if survey.image_eq_model:
+        tim.data = np.asarray(sims_image)
+        tim.inverr = np.zeros(tim.data.shape)
+        tim.inverr[tim.data > 0.] = np.sqrt(1./tim.data[tim.data > 0.])
+    sys.stdout.flush()
+    return tim
+
+def copy_pixels(a):
+    """Copy of a pixel array that can be modified without touching a
+
+    The memory maps of read_tims_cache are mapped again, copy-on-write:
+    nothing is read or copied until used, and only the pages written to
+    are copied. Windows of them (window_tims) are copied
+    """
+    fn= getattr(a, 'filename', None)
+    if fn is not None:
+        b= np.load(fn, mmap_mode='c')
+        if b.shape == a.shape:
+            return b
+    return np.array(a)
+
+def copy_tim(tim):
+    """Returns a copy of tim that inject_simcat can modify without touching tim
+
+    Only the pixel arrays are copied (see copy_pixels), psf/sky/wcs etc.
+    are shared
+    """
+    newtim = copy.copy(tim)
+    for key in TIMS_CACHE_PIXELS:
+        setattr(newtim, key, copy_pixels(getattr(tim, key)))
+    return newtim
+
+# run_brick kwargs that change what stage_tims returns
+TIMS_CACHE_KEYS= ['zoom','width','height','pixscale','bands',
+                  'splinesky','subsky','gaussPsf','pixPsf','hybridPsf',
+                  'normalizePsf','apodize','constant_invvar',
+                  'read_image_pixels','min_mjd','max_mjd','gaia_stars']
+TIMS_CACHE_PIXELS= ['data','inverr','dq']
+# key of the input file versions in tims.pickle
+TIMS_CACHE_INPUTS= 'tims_cache_inputs'
+
+def file_versions(fns):
+    """(filename, mtime, size) of each of the files fns that exists"""
+    return [(fn, os.path.getmtime(fn), os.path.getsize(fn))
+            for fn in sorted(set(fns)) if os.path.exists(fn)]
+
+def tims_input_files(tims):
+    """image, weight, dq and calib files the tims were read from"""
+    fns= []
+    for tim in tims:
+        im= tim.imobj
+        for key in im.get_cacheable_filename_variables():
+            fn= getattr(im, key, None)
+            if fn is not None:
+                fns.append(fn)
+    return fns
+
+def get_tims_cache_dir(cache_dir, brickname, runbrick_kwargs, args, survey):
+    """Directory holding the pristine tims of a brick for these stage_tims options
+
+    Keyed by the brick, the stage_tims options and the versions (mtime,
+        size) of the survey-ccds tables of survey, not by the sims: the
+        cache holds whole CCDs, --sparse_margin is applied when it is read
+        (window_tims), so do_more and do_skipids runs of the brick use it
+        too. read_tims_cache checks the image and calib files
+    """
+    key= [(k, runbrick_kwargs.get(k)) for k in TIMS_CACHE_KEYS]
+    key += [('dataset',args.dataset), ('run',args.run),
+            ('survey_dir',args.survey_dir),
+            ('skip_ccd_cuts',args.skip_ccd_cuts)]
+    key += [('ccds', file_versions(
+                survey.filter_ccds_files(survey.find_file('ccds')) +
+                survey.filter_ccd_kd_files(survey.find_file('ccd-kds'))))]
+    h= hashlib.md5(repr(key).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, brickname[:3], brickname, 'tims-%s' % h)
+
+def get_tim_cache_name(tim):
+    # a CCD read in several windows (--sparse_margin) gives several tims
+    return '%s-%s-%s-x%iy%i' % (tim.imobj.expnum, tim.imobj.ccdname, tim.band,
+                                tim.x0, tim.y0)
+
+def write_tims_cache(dirnm, R):
+    """Write the output of stage_tims as .npy pixels plus a pickled sidecar
+
+    The pixels of each tim go to <expnum>-<ccdname>-<band>-{data,inverr,dq}.npy
+        so read_tims_cache can memory map them, everything else (sky, psf,
+        wcs, ccds table, targetwcs, ...) goes to tims.pickle, with the
+        versions of the image and calib files read (see file_versions). The
+        directory is written under a temporary name and renamed when
+        complete.
+    """
+    from astrometry.util.file import pickle_to_file
+    log = logging.getLogger('decals_sim')
+    tmpdir= dirnm + '.tmp-%d' % os.getpid()
+    if not os.path.exists(tmpdir):
+        os.makedirs(tmpdir)
+    stripped= []
+    for tim in R['tims']:
+        name= get_tim_cache_name(tim)
+        tim_nopix= copy.copy(tim)
+        for key in TIMS_CACHE_PIXELS:
+            np.save(os.path.join(tmpdir, '%s-%s.npy' % (name,key)),
+                    getattr(tim,key))
+            setattr(tim_nopix, key, None)
+        stripped.append((name,tim_nopix))
+    meta= dict(R)
+    meta.update(tims=stripped)
+    meta[TIMS_CACHE_INPUTS]= file_versions(tims_input_files(R['tims']))
+    pickle_to_file(meta, os.path.join(tmpdir,'tims.pickle'))
+    try:
+        os.rename(tmpdir, dirnm)
+        log.info('Wrote tims cache %s' % dirnm)
+    except OSError:
+        # another job wrote it first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def read_tims_cache(dirnm):
+    """Returns the stage_tims output written by write_tims_cache, or None
+
+    The tim pixels are copy-on-write memory maps, see copy_tim. A cache
+        whose image or calib files changed since it was written is removed
+        (the jobs that have it mapped keep their copy) and None returned
+    """
+    from astrometry.util.file import unpickle_from_file
+    log = logging.getLogger('decals_sim')
+    fn= os.path.join(dirnm,'tims.pickle')
+    if not os.path.exists(fn):
+        return None
+    R= unpickle_from_file(fn)
+    inputs= R.pop(TIMS_CACHE_INPUTS, [])
+    if file_versions([v[0] for v in inputs]) != inputs:
+        log.info('Inputs of tims cache %s changed, removing it' % dirnm)
+        shutil.rmtree(dirnm, ignore_errors=True)
+        return None
+    tims= []
+    for name,tim in R['tims']:
+        for key in TIMS_CACHE_PIXELS:
+            setattr(tim, key, np.load(os.path.join(dirnm, '%s-%s.npy' % (name,key)),
+                                      mmap_mode='c'))
+        tims.append(tim)
+    R.update(tims=tims)
+    log.info('Read %d tims from cache %s' % (len(tims),dirnm))
+    return R
+
+def get_source_rng(seed, objid, expnum, ccdname):
+    """Random number generator for one simulated source on one CCD
+
+    Counter-based (Philox) stream keyed by (seed, objid, expnum, ccdname),
+        so the noise of a source on a CCD is the same whichever process reads
+        the CCD, in whatever order, and when a single CCD is redone
+    """
+    ccdname= str(ccdname).strip()
+    key= np.random.SeedSequence([int(seed), int(objid), int(expnum),
+                                 zlib.crc32(ccdname.encode())])
+    return np.random.Generator(np.random.Philox(key))
+
+def noise_for_galaxy(gal,nano2e,rng=None):
+    """Returns numpy array of noise in Img count units for gal in image cnt units
+
+    rng: see get_source_rng, defaults to the global np.random
+    """
+    if rng is None:
+        rng= np.random
     # Noise model + no negative image vals when compute noise
     one_std_per_pix= gal.array.copy() # nanomaggies
     one_std_per_pix[one_std_per_pix < 0]=0
     # rescale
     one_std_per_pix *= nano2e # e-
     one_std_per_pix= np.sqrt(one_std_per_pix)
-    num_stds= np.random.randn(one_std_per_pix.shape[0],one_std_per_pix.shape[1])
+    num_stds= rng.standard_normal(one_std_per_pix.shape)
     #one_std_per_pix.shape, num_stds.shape
     noise= one_std_per_pix * num_stds
     # rescale
     noise /= nano2e #nanomaggies
     return noise
 
+def stamp_image(mod, x0, x1, y0, y1):
+    """galsim.Image of the model mod of a source drawn in the box [x0,x1) [y0,y1)
+
+    As BuildStamp has always done, the (1-indexed, inclusive) bounds end at
+        x1-1,y1-1, so the last row and column of mod are not added to the CCD
+    """
+    img = galsim.Image(mod)
+    img.bounds.xmin = x0+1
+    img.bounds.xmax = x1-1
+    img.bounds.ymin = y0+1
+    img.bounds.ymax = y1-1
+    return img
+
+def get_stamp_invvars(stamp, nano2e, dq, back_ivar):
+    """invvar of a sim stamp and of the image pixels it is added to
+
+    Args:
+        stamp: galsim.Image of the source (noise included), nanomaggies
+        nano2e: see ivar_for_galaxy
+        dq: numpy bad pixel mask of the image pixels under stamp
+        back_ivar: galsim.Image of their invvar
+
+    Returns:
+        ivarstamp: ivar_for_galaxy, zeroed where dq is flagged (> 0)
+        tot_ivar: invvar of image + stamp, see get_srcimg_invvar
+    """
+    ivarstamp= ivar_for_galaxy(stamp,nano2e)
+    # Zero out invvar where bad pixel mask is flagged (> 0)
+    keep = np.ones(dq.shape)
+    keep[ dq > 0 ] = 0.
+    ivarstamp *= keep
+    tot_ivar= get_srcimg_invvar(ivarstamp, back_ivar)
+    return ivarstamp, tot_ivar
+
 def ivar_for_galaxy(gal,nano2e):
     """Adds gaussian noise to perfect source
 
@@ -794,7 +1073,7 @@ class BuildStamp():
           tim: Tractor Image Object for a specific CCD
           gain: gain of the CCD
       """
-      def __init__(self,tim,seed=0,camera=None,gain=None,exptime=None): #I think tim is the only useful thing here
+      def __init__(self,tim,seed=0,camera=None,gain=None,exptime=None,targetwcs=None): #I think tim is the only useful thing here
           self.band = tim.band.strip()
           self.zpscale = tim.zpscale      # nanomaggies-->ADU (decam) or e-/sec (bass,mzls)
           assert(camera in ['decam','mosaic','90prime'])
@@ -804,15 +1083,9 @@ class BuildStamp():
                 self.nano2e = self.zpscale
           self.tim = tim
 
-
-          global BRICKNAME
-          global SURVEY_DIR
-          survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-          brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-          brickwcs = wcs_for_brick(brickinfo)
-          W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-          brick00 = survey.get_brick_by_name(BRICKNAME)
-          targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+          # brick WCS, cached per process (see get_brick_geometry)
+          if targetwcs is None:
+              _,targetwcs = get_brick_geometry()
           self.targetwcs = targetwcs
       def setlocal(self,obj):#get a sub_tim image as what's been done in fitblobs stage. see _blob_iter? code for details
               """Get the pixel positions, local wcs, local PSF."""
@@ -869,15 +1142,161 @@ class BuildStamp():
                raise
           new_tractor = Tractor([new_tim], [new_gal])
           mod0 = new_tractor.getModelImage(0)
-          galsim_img = galsim.Image(mod0)
-          galsim_img.bounds.xmin=self.sx0+1
-          galsim_img.bounds.xmax=self.sx1-1
-          galsim_img.bounds.ymin=self.sy0+1
-          galsim_img.bounds.ymax=self.sy1-1
-          return galsim_img
+          return stamp_image(mod0, self.sx0, self.sx1, self.sy0, self.sy1)
 
 
+class BatchStamp(object):
+    """Draws all the simulated sources of a single exposure in one pass
 
+    Same stamps as BuildStamp.elg (64x64 box around the source, constant
+        PSF at the box centre, galaxy rendered by tractor, then stamp_image,
+        noise_for_galaxy and get_stamp_invvars) but the WCS, PSFs and
+        photocal are shared by every source on the CCD, there is no
+        tractor.Image/Tractor per source and only the boxes of the CCD are
+        touched. BuildStamp (--stamp_engine buildstamp) is the reference
+        this one is tested against (TestStampEngines).
+
+    Args:
+        tim,camera,gain,targetwcs: see BuildStamp
+        seed: of the sim noise, see get_source_rng
+        psf_grid: None to evaluate the PSF at each box centre like BuildStamp,
+            otherwise once per psf_grid x psf_grid pixel cell of the CCD
+
+    Attributes:
+        band,nano2e,tim,targetwcs: see BuildStamp
+        imgs: PSF key -> full CCD tractor.Image with that constant PSF
+    """
+    # half size of the box, as in BuildStamp.setlocal
+    S= 32
+    # the others (star, qso) are drawn by BuildStamp
+    objtypes= ['elg','lrg']
+
+    def __init__(self,tim,seed=0,camera=None,gain=None,targetwcs=None,psf_grid=None):
+        self.band = tim.band.strip()
+        self.seed = seed
+        assert(self.band in ['g','r','z'])
+        self.zpscale = tim.zpscale
+        assert(camera in ['decam','mosaic','90prime'])
+        if camera == 'decam':
+            self.nano2e = self.zpscale*gain
+        else:
+            self.nano2e = self.zpscale
+        self.tim = tim
+        if targetwcs is None:
+            _,targetwcs = get_brick_geometry()
+        self.targetwcs = targetwcs
+        self.psf_grid = psf_grid
+        self.imgs = {}
+        self.wcs = tim.getWcs()
+        self.photocal = tim.getPhotoCal()
+        self.sky = tim.getSky()
+
+    def get_boxes(self,simcat):
+        """[x0,x1) [y0,y1) of each source's box on the CCD, see BuildStamp.setlocal"""
+        x= (simcat.x+0.5).astype(int)
+        y= (simcat.y+0.5).astype(int)
+        ra,dec= self.targetwcs.pixelxy2radec(x+1,y+1)[-2:]
+        _,xx,yy= self.tim.subwcs.radec2pixelxy(ra,dec)
+        x_cen= np.round(xx-1).astype(int)
+        y_cen= np.round(yy-1).astype(int)
+        h,w= self.tim.shape
+        x0= np.clip(x_cen-self.S, 0, w-1)
+        x1= np.clip(x_cen+self.S-1, 0, w-1) + 1
+        y0= np.clip(y_cen-self.S, 0, h-1)
+        y1= np.clip(y_cen+self.S-1, 0, h-1) + 1
+        return x0,x1,y0,y1
+
+    def get_image(self,x0,x1,y0,y1):
+        """tim with the PSF at the box centre, or the centre of its psf_grid cell"""
+        xc,yc= (x0+x1)/2., (y0+y1)/2.
+        if self.psf_grid is None:
+            key= (xc,yc)
+        else:
+            key= (int(xc // self.psf_grid), int(yc // self.psf_grid))
+            xc,yc= [(k+0.5)*self.psf_grid for k in key]
+        if not key in self.imgs:
+            # shares the tim's pixels, wcs, photocal and sky
+            self.imgs[key]= tractor.Image(data=self.tim.data,
+                                    inverr=self.tim.inverr, wcs=self.wcs,
+                                    psf=self.tim.psf.constantPsfAt(xc,yc),
+                                    photocal=self.photocal, sky=self.sky,
+                                    name=self.tim.name)
+        return self.imgs[key]
+
+    def galaxy(self,obj):
+        """tractor source for one simcat row, see BuildStamp.elg"""
+        n= int(obj.get('n'))
+        flux= float(obj.get(self.band+'flux'))
+        brightness= tractor.NanoMaggies(order=[self.band], **{self.band:flux})
+        shape= LegacyEllipseWithPriors(np.log(float(obj.get('rhalf'))),
+                                       float(obj.get('e1')),
+                                       float(obj.get('e2')))
+        pos= RaDecPos(float(obj.get('ra')),float(obj.get('dec')))
+        if n == 1:
+            return ExpGalaxy(pos,brightness,shape)
+        elif n == 4:
+            return DevGalaxy(pos,brightness,shape)
+        raise ValueError('n=%d, only exp (1) and dev (4) are supported' % n)
+
+    def render(self,obj,x0,x1,y0,y1):
+        """model of obj in its box, numpy array of shape (y1-y0,x1-x0)"""
+        img= self.get_image(x0,x1,y0,y1)
+        stamp= np.zeros((y1-y0,x1-x0), np.float32)
+        # the galaxy's own patch size clipped to the box, like
+        # Tractor.getModelImage of BuildStamp's box sized tim (a modelMask
+        # would render the whole box)
+        patch= self.galaxy(obj).getModelPatch(img)
+        if patch is None:
+            return stamp
+        ph,pw= patch.patch.shape
+        ax0,ax1= max(x0,patch.x0), min(x1,patch.x0+pw)
+        ay0,ay1= max(y0,patch.y0), min(y1,patch.y0+ph)
+        if ax0 < ax1 and ay0 < ay1:
+            stamp[ay0-y0:ay1-y0, ax0-x0:ax1-x0] += \
+                patch.patch[ay0-patch.y0:ay1-patch.y0, ax0-patch.x0:ax1-patch.x0]
+        return stamp
+
+    def inject(self,simcat,add_sim_noise=False):
+        """Adds every source in simcat to tim.data and tim.inverr, in place
+
+        Returns:
+            ids_added: ids of the sources with at least one pixel on the CCD
+            sims_image,sims_ivar: SparseImages of the sims only
+        """
+        log = logging.getLogger('decals_sim')
+        t0= Time()
+        ids_added= []
+        sims_image= SparseImage(self.tim.shape)
+        sims_ivar= SparseImage(self.tim.shape)
+        h,w= self.tim.shape
+        tim_bounds= galsim.BoundsI(1,w,1,h)
+        x0,x1,y0,y1= self.get_boxes(simcat)
+        for i,obj in enumerate(simcat):
+            stamp= stamp_image(self.render(obj,x0[i],x1[i],y0[i],y1[i]),
+                               x0[i],x1[i],y0[i],y1[i])
+            if add_sim_noise:
+                rng= get_source_rng(self.seed, obj.id,
+                                    self.tim.imobj.expnum, self.tim.imobj.ccdname)
+                stamp += noise_for_galaxy(stamp,self.nano2e,rng=rng)
+            overlap= stamp.bounds & tim_bounds
+            if overlap.area() <= 0:
+                continue
+            ids_added.append(obj.id)
+            stamp= stamp[overlap]
+            slc= (slice(overlap.ymin-1,overlap.ymax),
+                  slice(overlap.xmin-1,overlap.xmax))
+            ivarstamp, tot_ivar= get_stamp_invvars(stamp, self.nano2e,
+                                    self.tim.dq[slc],
+                                    galsim.Image(self.tim.inverr[slc]**2))
+            self.tim.data[slc] += stamp.array
+            self.tim.inverr[slc]= np.sqrt(tot_ivar.array)
+            sims_image.add(slc, stamp.array)
+            sims_ivar.add(slc, ivarstamp.array)
+        if sims_ivar.min() < 0:
+            log.warning('Negative invvar!')
+        ptime('Drew %d sims band=%s with %d psfs' %
+              (len(ids_added),self.band,len(self.imgs)), t0)
+        return ids_added,sims_image,sims_ivar
 
 
 class BuildStamp_old():
@@ -901,7 +1320,7 @@ class BuildStamp_old():
     """
 
     def __init__(self,tim, seed=0,
-                 camera=None,gain=None,exptime=None):
+                 camera=None,gain=None,exptime=None,targetwcs=None):
         #self.camera=camera
         self.band = tim.band.strip()
         # GSParams should be used when galsim object is initialized
@@ -922,16 +1341,9 @@ class BuildStamp_old():
             # correct for mzls, possibly not for bass
             self.nano2e = self.zpscale # nanomaggies -> e-/s -> e-
         self.tim=tim
-        
 
-        global BRICKNAME
-        global SURVEY_DIR
-        survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-        brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-        brickwcs = wcs_for_brick(brickinfo)
-        W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-        brick00 = survey.get_brick_by_name(BRICKNAME)
-        targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+        if targetwcs is None:
+            _,targetwcs = get_brick_geometry()
         self.targetwcs = targetwcs
         #from astrometry.util.miscutils import patch_image
         #from astrometry.util.resample import resample_with_wcs
@@ -1051,27 +1463,61 @@ class BuildStamp_old():
 
 
 
+def get_neighbors(Samp, radius_in_deg=5./3600):
+  """Pairs of Samp rows closer than radius_in_deg, from one self-match
+
+  Returns:
+    tuple: start,J: the neighbors of row i are J[start[i]:start[i+1]]
+  """
+  I,J,d = match_radec(Samp.ra,Samp.dec, Samp.ra,Samp.dec, radius_in_deg,
+                      notself=False,nearest=False)
+  I,J= np.array(I,dtype=int),np.array(J,dtype=int)
+  keep= I != J
+  I,J= I[keep],J[keep]
+  order= np.argsort(I, kind='stable')
+  I,J= I[order],J[order]
+  start= np.searchsorted(I, np.arange(len(Samp)+1))
+  return start,J
+
 def flag_nearest_neighbors(Samp, radius_in_deg=5./3600):
   """Returns Sample indices to keep (have > dist separations) and indices to skip
 
+  Greedy in Samp order: a row is kept unless a kept row before it is
+    within radius_in_deg, kept rows flag all their neighbors
+
   Returns:
     tuple: keep,skip: indices of Samp to keep and skip
   """
-  flag_set=set()
-  all_indices= range(len(Samp))
-  for cnt in all_indices:
-      if cnt in flag_set:
-          continue
-      else:
-          I,J,d = match_radec(Samp.ra[cnt],Samp.dec[cnt],
-                              Samp.ra,Samp.dec, 5./3600,
-                              notself=False,nearest=False)
-          # Remove all Samp matches (J), minus the reference ra,dec
-          flag_inds= set(J).difference(set( [cnt] ))
-          if len(flag_inds) > 0:
-              flag_set= flag_set.union(flag_inds)
-  keep= list( set(all_indices).difference(flag_set) )
-  return keep, list(flag_set)
+  start,J= get_neighbors(Samp, radius_in_deg=radius_in_deg)
+  flagged= np.zeros(len(Samp),bool)
+  for cnt in np.where(np.diff(start) > 0)[0]:
+      if not flagged[cnt]:
+          flagged[J[start[cnt]:start[cnt+1]]]= True
+  return list(np.where(flagged == False)[0]), list(np.where(flagged)[0])
+
+def plan_batches(Samp, nobj, radius_in_deg=5./3600):
+  """Splits Samp into batches of at most nobj rows, none within radius_in_deg
+
+  First fit in Samp order: each row goes in the first batch that has room
+    and none of its neighbors, so every row is injected in some batch and
+    build_simcat skips nothing
+
+  Returns:
+    int array: batch of each row of Samp, batch b is run as rowstart b*nobj
+  """
+  start,J= get_neighbors(Samp, radius_in_deg=radius_in_deg)
+  batch= np.zeros(len(Samp),int) - 1
+  counts= []
+  for i in range(len(Samp)):
+      taken= set(batch[J[start[i]:start[i+1]]])
+      b= 0
+      while (b in taken) or (b < len(counts) and counts[b] >= nobj):
+          b += 1
+      if b == len(counts):
+          counts.append(0)
+      batch[i]= b
+      counts[b] += 1
+  return batch
 
 def get_ellip(q):
     """Given minor to major axis ratio (q) Returns ellipticity"""
@@ -1125,19 +1571,14 @@ def build_simcat(Samp=None,brickwcs=None, meta=None):
     #cat['DEC'] = Column(Samp.dec, dtype='f8')
     #cat['X'] = Column(xxyy[1][:], dtype='f4')
     #cat['Y'] = Column(xxyy[2][:], dtype='f4')
-    global BRICKNAME
-    global SURVEY_DIR
-    survey = LegacySurveyData(survey_dir=SURVEY_DIR)
-    brickinfo= get_brickinfo_hack(survey,BRICKNAME)
-    brickwcs = wcs_for_brick(brickinfo)
-    W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
-    brick00 = survey.get_brick_by_name(BRICKNAME)
-    targetwcs = wcs_for_brick(brick00, W=W, H=H, pixscale=pixscale)
+    _,targetwcs = get_brick_geometry()
     flag, xx,yy = targetwcs.radec2pixelxy(Samp.ra,Samp.dec)
 
     cat = fits_table()
     for key in ['id','ra','dec']:
         cat.set(key, Samp.get(key))
+    if 'batch' in Samp.get_columns():
+        cat.set('batch', Samp.get('batch'))
     cat.set('x', xx-1)
     cat.set('y', yy-1)
 
@@ -1147,7 +1588,7 @@ def build_simcat(Samp=None,brickwcs=None, meta=None):
     for band in ['g','r','z']:
         nanomag= 1E9*10**(-0.4*Samp.get(band))
         # Add extinction (to stars too, b/c "decam-chatter 6517")
-        mw_transmission= SFDMap().extinction(['DES %s' % band],
+        mw_transmission= get_sfd_map().extinction(['DES %s' % band],
                                              Samp.ra, Samp.dec)
         mw_transmission= 10**(-mw_transmission[:,0].astype(np.float32)/2.5)
         cat.set('%sflux' % band, nanomag * mw_transmission)
@@ -1183,6 +1624,16 @@ def get_parser():
                         help='number of objects to simulate (required input)')
     parser.add_argument('-rs', '--rowstart', type=int, default=0, metavar='',
                         help='zero indexed, row of ra,dec,mags table, after it is cut to brick, to start on')
+    parser.add_argument('--tims_cache_dir', default=None,
+                        help='keep the tims read for a brick (before adding simulated sources) here and reuse them on later runs of that brick, e.g. do_more, do_skipids or a rerun. Runs the brick like --rowstarts does (do_realizations: stage_tims without the sims, then the sims added to copies of the tims), even for a single rowstart. The cache holds whole CCDs (with --sparse_margin, the first run of a brick reads them whole, later runs cut their windows from the cache) and is rewritten when the survey-ccds tables, images or calibs change')
+    parser.add_argument('--footprint_margin', type=int, default=None,
+                        help='only compute outliers, coadds and WISE photometry within this many pixels of the blobs containing simulated sources (ignored with --all_blobs). Outliers and image coadds run before the blobs exist and use this many pixels around the sources instead, an approximation: use a margin larger than the largest blob radius (a warning is logged when a fit blob reaches beyond it)')
+    parser.add_argument('--sparse_margin', type=float, default=None,
+                        help='only read windows of each CCD around the simulated sources: this many arcsec plus SPARSE_RHALF_GROWTH half-light radii around each source, overlapping windows merged. Approximate, the windows should cover the blobs fit around the sources (see --all_blobs), increase it for crowded fields')
+    parser.add_argument('--rowstarts', type=int, nargs='+', default=None, metavar='',
+                        help='several rowstarts to inject one after the other, reading the CCDs only once; overrides --rowstart (which still names the rsdir in --pickle, --checkpoint, --ps)')
+    parser.add_argument('--plan_batches', action='store_true', default=False,
+                        help='split the randoms of the brick into batches of at most --nobj sources 5 arcsec apart, rowstart N*nobj runs batch N, so no randoms are skipped and --do_skipids is not needed')
     parser.add_argument('--do_skipids', type=str, choices=['no','yes'],default='no', help='inject skipped ids for brick, otherwise run as usual')
     parser.add_argument('--do_more', type=str, choices=['no','yes'],default='no', help='yes if running more randoms b/c TS returns too few targets')
     parser.add_argument('--minid', type=int, default=None, help='set if do_more==yes, minimum id to consider, useful if adding more randoms mid-run')
@@ -1196,6 +1647,10 @@ def get_parser():
     parser.add_argument('-survey-dir', '--survey_dir', metavar='',
                         help='Location of survey-ccds*.fits.gz')
     parser.add_argument('--add_sim_noise', action="store_true", help="set to add noise to simulated sources")
+    parser.add_argument('--stamp_engine', type=str, choices=['batch','buildstamp'], default='buildstamp',
+                        help='buildstamp draws each sim on its own tractor.Image, batch draws all the elg/lrg sims on a CCD at once (star, qso: buildstamp)')
+    parser.add_argument('--psf_grid', type=int, default=None,
+                        help='with --stamp_engine batch, share one PSF per this many pixels square of each CCD instead of one per sim')
     parser.add_argument('-testA','--image_eq_model', action="store_true", help="set to set image,inverr by model only (ignore real image,invvar)")
     parser.add_argument('--all-blobs', action='store_true',
                         help='Process all the blobs, not just those that contain simulated sources.')
@@ -1222,9 +1677,22 @@ def get_parser():
     parser.add_argument('-v', '--verbose', action='store_true', help='toggle on verbose output')
     parser.add_argument('--ps',default=None,help = 'Not sure what it is now...#TODO')
     parser.add_argument('--pickle',dest='pickle_pat',default=None, help = 'intermediate savings')
-    parser.add_argument('--checkpoint',dest='checkpoint_filename',default = None, help = 'I dont know either...')
+    parser.add_argument('--checkpoint',dest='checkpoint_filename',default = None, help = 'fitblobs checkpoint file, a rerun of the brick resumes from it; also written on SIGUSR1')
+    parser.add_argument('--checkpoint_period', type=int, default=None, help='seconds between fitblobs checkpoints, 600 by default')
+    parser.add_argument('--write_matched', action='store_true', default=False,
+                        help='after writecat, write the sims matched to the tractor catalog and reference stars to obiwan/.../matched-BRICK.fits, for collect/collect_mpi.py --matcher prematched')
     parser.add_argument('--ps-t0', type=int, default=0, help='Unix-time start for "--ps"')
     parser.add_argument('--write-stage',default='writecat')
+    parser.add_argument('--in_memory', action='store_true', default=False,
+                        help='pass the runbrick stage results along in memory instead of pickling them, --write-stage is ignored')
+    parser.add_argument('--cache_dir', default=None,
+                        help='read the images and calibs from here when they were copied (at the same path relative to --survey_dir), see legacypipe/prefetch.py')
+    parser.add_argument('--ccd_rows_copy', action='store_true', default=False,
+                        help='read the CCDs of gzipped survey-ccds tables from uncompressed copies in outdir/ccd-index (or next to the tables), which take as much disk as the decompressed tables')
+    parser.add_argument('--shared_tims', action='store_true', default=False,
+                        help='pass the tim pixels between the runbrick workers in named shared memory instead of pickling them')
+    parser.add_argument('--checkpoint_stages', nargs='+', default=None,
+                        help='with --in_memory, stages to write a gzipped --pickle checkpoint for (e.g. fitblobs), none by default')
     parser.add_argument('--run',default=None, type=str, choices=['north','decam','90prime', 'mosaic'],required=True)
     parser.add_argument('--less-masking', action='store_true',default=False,help='reduce masked star radius')
     parser.add_argument('--no-galaxy-forcepsf', action='store_true',default=False,help='fit_back function??')
@@ -1369,6 +1837,8 @@ def get_runbrick_setup(**kwargs):
         checkpoint_fn = kwargs['checkpoint_filename']
         #get_checkpoint_fn(kwargs['outdir'],kwargs['brick'], kwargs['rowstart'])
         cmd_line += ['--checkpoint',checkpoint_fn]
+        if kwargs['checkpoint_period'] is not None:
+            cmd_line += ['--checkpoint-period','%d' % kwargs['checkpoint_period']]
     if kwargs['stage']:
         cmd_line += ['--stage', kwargs['stage']]
     if kwargs['early_coadds']:
@@ -1380,8 +1850,20 @@ def get_runbrick_setup(**kwargs):
         cmd_line += ['--no-galaxy-forcepsf']
     if kwargs['less_masking']:
         cmd_line += ['--less-masking']
-    if kwargs['write_stage']:
+    if kwargs['in_memory']:
+        # stages only write (gzipped) pickles for --checkpoint_stages
+        cmd_line += ['--in-memory']
+        if kwargs['checkpoint_stages']:
+            for stage in kwargs['checkpoint_stages']:
+                cmd_line += ['--write-stage',stage]
+        else:
+            cmd_line += ['--no-write']
+    elif kwargs['write_stage']:
         cmd_line += ['--write-stage',kwargs['write_stage']]
+    if kwargs['shared_tims']:
+        cmd_line += ['--shared-tims']
+    if kwargs['footprint_margin'] is not None:
+        cmd_line += ['--footprint-margin','%d' % kwargs['footprint_margin']]
 
 
     rb_parser= get_runbrick_parser()
@@ -1393,6 +1875,38 @@ def get_runbrick_setup(**kwargs):
     _, rb_kwargs= get_runbrick_kwargs(**rb_optdict)
     return rb_kwargs
 
+def get_simdecals(d, pristine=False, sparse_radec=None, whole_ccds=False):
+    """Returns the SimDecals object for the simulated sources in d
+
+    Args:
+        d: see do_one_chunk
+        pristine: True for a SimDecals object that reads the CCDs without
+            adding the simulated sources to them
+        sparse_radec: (ra,dec,rhalf) to read the CCDs around if --sparse_margin,
+            defaults to d['simcat']
+        whole_ccds: True to read whole CCDs even with --sparse_margin
+    """
+    kw= dict(dataset=d['args'].dataset,\
+             survey_dir=d['survey_dir'], \
+             metacat=d['metacat'], \
+             simcat=None if pristine else d['simcat'], \
+             output_dir=d['simcat_dir'], \
+             add_sim_noise=d['args'].add_sim_noise, seed=d['seed'],\
+             image_eq_model=d['args'].image_eq_model,\
+             sparse_margin=None if whole_ccds else d['args'].sparse_margin,\
+             sparse_radec=sparse_radec,\
+             targetwcs=get_brick_geometry(d['brickname'],d['survey_dir'])[1],\
+             stamp_engine=d['args'].stamp_engine,\
+             psf_grid=d['args'].psf_grid,\
+             cache_dir=d['args'].cache_dir,\
+             ccd_index_dir=os.path.join(d['args'].outdir,'ccd-index'),\
+             ccd_rows_copy=d['args'].ccd_rows_copy)
+
+    if d['args'].dataset == 'cosmos':
+        kw.update(subset=d['args'].subset)
+        return SimDecalsCosmos(**kw)
+    return SimDecals(**kw)
+
 def do_one_chunk(d=None):
     """Runs the legacypipe/Tractor pipeline on images with simulated sources
 
@@ -1410,23 +1924,12 @@ def do_one_chunk(d=None):
     """
     log = logging.getLogger('decals_sim')
     assert(d is not None)
-    kw= dict(dataset=d['args'].dataset,\
-             survey_dir=d['survey_dir'], \
-             metacat=d['metacat'], simcat=d['simcat'], \
-             output_dir=d['simcat_dir'], \
-             add_sim_noise=d['args'].add_sim_noise, seed=d['seed'],\
-             image_eq_model=d['args'].image_eq_model)
-    
-    if d['args'].dataset == 'cosmos':
-        kw.update(subset=d['args'].subset)
-        simdecals= SimDecalsCosmos(**kw)
-    else:
-        simdecals = SimDecals(**kw)
+    simdecals = get_simdecals(d)
     # Use Tractor to just process the blobs containing the simulated sources.
     if d['args'].all_blobs:
         blobxy = None
     else:
-        blobxy = zip(d['simcat'].get('x'), d['simcat'].get('y'))
+        blobxy = list(zip(d['simcat'].get('x'), d['simcat'].get('y')))
     # Default runbrick call sequence
     obiwan_kwargs= vars(d['args'])
     runbrick_kwargs= get_runbrick_setup(**obiwan_kwargs)
@@ -1440,12 +1943,192 @@ def do_one_chunk(d=None):
     # Run it: run_brick(brick, survey obj, **kwargs)
     np.random.seed(d['seed'])
     log.info(runbrick_kwargs)
-    run_brick(d['brickname'], simdecals, **runbrick_kwargs)
+    R= run_brick(d['brickname'], simdecals, **runbrick_kwargs)
+    if d['args'].write_matched:
+        write_matched(d, simdecals)
+
+def write_matched(d, survey, angle=1.5/3600):
+    """Writes matched-BRICK.fits next to the simcat: the tractor source
+    nearest to each sim and the reference star nearest to that source, as
+    kd_brick_match in collect/collect.py (which then only has to stack them)
+
+    The reference stars are those of the ref-sources file run_brick
+        wrote (read_ref_stars), the file kd_brick_match reads once
+        do_ith_cleanup has moved it (ref_sources_fn)
+
+    Args:
+        d: dict of do_one_chunk
+        survey: that run_brick wrote the tractor and reference catalogs with
+        angle: sims within this many degrees of their source are detected
+    """
+    from brick_match import match_pixels, match_stars, read_ref_stars
+    from brick_match import STAR_COLUMNS
+    log = logging.getLogger('decals_sim')
+    brick= d['brickname']
+    sim= d['simcat']
+    tractor= fits_table(survey.find_file('tractor', brick=brick, output=True))
+    if len(tractor) == 0 or len(sim) == 0:
+        log.info('No matched table, %d tractor sources and %d sims' %
+                 (len(tractor),len(sim)))
+        return
+    idx,distance= match_pixels(sim.x, sim.y, tractor.bx, tractor.by)
+    tc= tractor[idx]
+    # the sims keep the ids of the randoms they were drawn from
+    Samp= d['Samp']
+    order= np.argsort(Samp.id)
+    iors= order[np.searchsorted(Samp.id, sim.id, sorter=order)]
+    for key in ['ra','dec','gflux','rflux','zflux']:
+        tc.set('sim_%s' % key, sim.get(key))
+    if 'redshift' in Samp.get_columns():
+        tc.set('sim_redshift', Samp.redshift[iors])
+    else:
+        tc.set('sim_redshift', np.zeros(len(sim)) + np.nan)
+    for key in ['rhalf','e1','e2']:
+        tc.set('sim_%s' % key, sim.get(key))
+    tc.set('sim_bx', sim.x)
+    tc.set('sim_by', sim.y)
+    tc.set('angle', distance*3600.)
+    tc.set('detected', distance <= angle)
+    tc.set('sim_sersic_n', sim.n)
+    ref_ra,ref_dec,ref_radius= read_ref_stars(
+                    survey.find_file('ref-sources', brick=brick, output=True))
+    stars= match_stars(brick, tc.ra, tc.dec, ref_ra, ref_dec, ref_radius)
+    for key in STAR_COLUMNS:
+        tc.set(key, stars[key])
+    fn= os.path.join(d['simcat_dir'], 'matched-%s.fits' % brick)
+    tc.writeto(fn)
+    log.info('Wrote %s' % fn)
+
+def get_realization_kwargs(d):
+    """obiwan.kenobi.py cmd line options for the rowstart in d
+
+    The --pickle, --checkpoint and --ps paths are given for the rsdir of
+        --rowstart, they are moved to the rsdir of d['rowst']
+    """
+    args = d['args']
+    rsdir0 = os.path.basename(get_outdir_runbrick('',
+                        args.brick,args.rowstart,
+                        do_skipids=args.do_skipids,do_more=args.do_more))
+    rsdir = os.path.basename(d['simcat_dir'])
+    obiwan_kwargs = dict(vars(args))
+    for key in ['pickle_pat','checkpoint_filename','ps']:
+        if obiwan_kwargs[key] is not None:
+            obiwan_kwargs[key] = obiwan_kwargs[key].replace(
+                            '/%s/' % rsdir0, '/%s/' % rsdir)
+    return obiwan_kwargs
+
+def do_realizations(ds=None):
+    """Runs legacypipe/Tractor on several sets of simulated sources in a brick
+
+    The CCDs are read once (stage_tims without any simulated sources), or
+        taken from --tims_cache_dir if an earlier run of the brick put them
+        there (the cache holds whole CCDs, cut to the --sparse_margin
+        windows of the sims here), then for each set of simulated sources a
+        copy of these tims has
+        the sources added and is handed to run_brick in place of its
+        stage_tims. Everything after stage_tims is run as in do_one_chunk,
+        writing to the rsdir of that set
+
+    Args:
+        ds: list of dicts, one per rowstart, see do_one_chunk
+
+    Returns:
+        Nothing, but runs do_ith_cleanup for each of ds unless --no_cleanup
+    """
+    from astrometry.util.stages import CallGlobalTime
+    import legacypipe.runbrick
+    log = logging.getLogger('decals_sim')
+    assert(ds is not None)
+    stagefunc = CallGlobalTime('stage_%s', vars(legacypipe.runbrick))
+
+    # Pristine tims
+    d = ds[0]
+    runbrick_kwargs= get_runbrick_setup(**get_realization_kwargs(d))
+    runbrick_kwargs.update(stages=['tims'], force=['tims'],
+                           write_pickles=False, blobxy=None)
+    pristine = {}
+    sparse_radec = (np.hstack([di['simcat'].ra for di in ds]),
+                    np.hstack([di['simcat'].dec for di in ds]),
+                    np.hstack([di['simcat'].rhalf for di in ds]))
+    survey = get_simdecals(d, pristine=True, sparse_radec=sparse_radec)
+    cache_dir = None
+    if d['args'].tims_cache_dir is not None:
+        cache_dir = get_tims_cache_dir(d['args'].tims_cache_dir,
+                                       d['brickname'], runbrick_kwargs, d['args'],
+                                       survey)
+        pristine = read_tims_cache(cache_dir) or {}
+    if len(pristine) == 0:
+        def keep_tims(stage, **kwargs):
+            R = stagefunc(stage, **kwargs)
+            if stage == 'tims':
+                pristine.update(R)
+            return R
+        log.info('Reading tims for %d rowstarts' % len(ds))
+        run_brick(d['brickname'],
+                  get_simdecals(d, pristine=True, sparse_radec=sparse_radec,
+                                whole_ccds=cache_dir is not None),
+                  stagefunc=keep_tims, **runbrick_kwargs)
+        if cache_dir is not None:
+            write_tims_cache(cache_dir, pristine)
+            # memory maps of the cache instead of the whole CCDs read
+            pristine = read_tims_cache(cache_dir) or pristine
+    if cache_dir is not None and survey.sparse_margin is not None:
+        pristine = window_tims(pristine, survey)
+
+    for d in ds:
+        t0= Time()
+        simdecals = get_simdecals(d)
+        np.random.seed(d['seed'])
+        tims = [inject_simcat(copy_tim(tim), simdecals,
+                              camera=tim.imobj.camera,
+                              exptime=tim.imobj.exptime)
+                for tim in pristine['tims']]
+        # stage_srcs, stage_writecat modify ccds and version_header
+        R = dict(pristine)
+        R.update(tims=tims, survey=simdecals,
+                 ccds=copy.deepcopy(pristine['ccds']),
+                 version_header=copy.deepcopy(pristine['version_header']))
+        t0= ptime('Injected rowstart=%d' % d['rowst'],t0)
+
+        def sim_stagefunc(stage, R=R, **kwargs):
+            if stage == 'tims':
+                return R
+            return stagefunc(stage, **kwargs)
+        if d['args'].all_blobs:
+            blobxy = None
+        else:
+            blobxy = list(zip(d['simcat'].get('x'), d['simcat'].get('y')))
+        runbrick_kwargs= get_runbrick_setup(**get_realization_kwargs(d))
+        runbrick_kwargs.update(blobxy=blobxy, force=['tims'])
+        log.info('Calling run_brick with: ')
+        log.info('brickname= %s rowstart= %d' % (d['brickname'],d['rowst']))
+        log.info(runbrick_kwargs)
+        R= run_brick(d['brickname'], simdecals, stagefunc=sim_stagefunc,
+                     **runbrick_kwargs)
+        if d['args'].write_matched:
+            write_matched(d, simdecals)
+        t0= ptime('do_one_chunk rowstart=%d' % d['rowst'],t0)
+        if d['args'].no_cleanup == False:
+            do_ith_cleanup(d=d)
+        t0= ptime('do_ith_cleanup rowstart=%d' % d['rowst'],t0)
+        record_done(d)
 
 def dobash(cmd):
     print('UNIX cmd: %s' % cmd)
     if os.system(cmd): raise ValueError
 
+# rsdirs of this run of kenobi not done yet, main records them as failed
+# if it does not finish
+RUNNING = []
+
+def record_done(d):
+    """Records the rsdir of d as done in the run state manifest (run_state.py)"""
+    rsdir= os.path.basename(d['simcat_dir'])
+    record_state(d['args'].outdir, d['brickname'], rsdir, 'done',
+                 rowstart=d['rowst'])
+    if rsdir in RUNNING:
+        RUNNING.remove(rsdir)
+
 def do_ith_cleanup(d=None):
     """Moves all obiwan+legacypipe outputs to a new directory stucture
 
@@ -1507,13 +2190,18 @@ def do_ith_cleanup(d=None):
             dobash('rm %s/coadd/%s/%s/%s/*.%s' %
                         (base,bri,brick,rsdir,name))
     #remove the pickles, I don't know the argument to remmove them, so I do it manually...
-    dobash("rm %s/pickles/%s/%s/%s/runbrick-%s*"%(base,bri,brick,rsdir,brick))
+    # no pickles with --in_memory and no --checkpoint_stages
+    dobash("rm -f %s/pickles/%s/%s/%s/runbrick-%s*"%(base,bri,brick,rsdir,brick))
+    # the fitblobs checkpoint is only needed to resume an unfinished run
+    checkpoint_fn = get_realization_kwargs(d)['checkpoint_filename']
+    if checkpoint_fn is not None:
+        dobash("rm -f %s"%checkpoint_fn)
 
 
 def get_sample(objtype,brick,randoms_db,
                minid=None,randoms_from_fits='',
                do_skipids='no',outdir=None,
-               dont_sort_sampleid=False):
+               dont_sort_sampleid=False,rows=None):
     """Gets all simulated randoms for a brick from PSQl db, and applies all relevant cuts
 
     Args:
@@ -1521,10 +2209,14 @@ def get_sample(objtype,brick,randoms_db,
         brick:
         randoms_db: name of PSQL db for randoms, e.g. obiwan_elg_ra175
         minid: None, unless do_more == yes then it is an integer for the randoms id to start from
-        randoms_from_fits: None or filename of fits_table to use for randoms
+        randoms_from_fits: None or filename of fits_table to use for randoms,
+            or the directory of a randoms store (see randoms_store.py), of
+            which only the rows asked for are read
         do_skipids: yes or no, rerunning on all skipped randoms?
         outdir: None if do_skipids='no'; otherwise path like $CSCRATCH/obiwan_out/elg_9deg2_ra175
-        dont_sort_sampleid: False to sort sample by id
+        dont_sort_sampleid: False to sort sample by id (a randoms store is
+            always sorted by id)
+        rows: (start, stop) to only return these rows of the sorted, cut sample
 
 
     Returns:
@@ -1533,6 +2225,11 @@ def get_sample(objtype,brick,randoms_db,
     assert(do_skipids in ['yes','no'])
     if do_skipids == 'yes':
         assert(not outdir is None)
+    if randoms_from_fits and os.path.isdir(randoms_from_fits):
+        # sorted by id, minid cut and rows sliced while reading
+        from randoms_store import read_brick
+        Samp= read_brick(randoms_from_fits, brick, rows=rows, minid=minid)
+        return Samp,1
     if randoms_from_fits:
         Samp,seed= fits_table(randoms_from_fits),1
     else:
@@ -1553,13 +2250,18 @@ def get_sample(objtype,brick,randoms_db,
     if dont_sort_sampleid == False:
         # breaks clustering but robus to adding more ids
         Samp= Samp[np.argsort(Samp.id) ]
+    if rows is not None:
+        Samp= Samp[rows[0]:rows[1]]
     return Samp,seed
 
 
 
 def main(args=None):
-    """Main routine which parses the optional inputs."""
-    t0= Time()
+    """Main routine which parses the optional inputs.
+
+    The state of each rsdir of the brick (running, done, failed with the
+        reason) goes to the run state manifest, see run_state.py
+    """
     # Command line options
     if args is None:
         # Read from cmd line
@@ -1568,6 +2270,19 @@ def main(args=None):
     else:
         # args is already a argparse.Namespace obj
         pass
+    del RUNNING[:]
+    try:
+        return run_main(args)
+    except BaseException as e:
+        if RUNNING:
+            record_states(args.outdir,
+                          [dict(brick=args.brick, rsdir=rsdir, state='failed',
+                                reason=repr(e)) for rsdir in RUNNING])
+        raise
+
+def run_main(args):
+    """Injects and runs legacypipe for each rowstart of args, see main"""
+    t0= Time()
     # Print calling sequence
     print('Args:', args)
     if args.do_more == 'yes':
@@ -1579,6 +2294,16 @@ def main(args=None):
         lvl = logging.INFO
     logging.basicConfig(level=lvl, stream=sys.stdout) #,format='%(message)s')
     log = logging.getLogger('decals_sim')
+    if args.checkpoint_filename is not None:
+        # a USR1 before fitblobs starts makes it checkpoint at its first
+        # results, instead of killing the run (run_brick sets it again)
+        import signal
+        from legacypipe.runbrick import request_checkpoint
+        try:
+            signal.signal(signal.SIGUSR1, request_checkpoint)
+        except ValueError:
+            # not the main thread
+            pass
     # Sort through args
     #log.info('decals_sim.py args={}'.format(args))
     #max_nobj=500
@@ -1589,23 +2314,38 @@ def main(args=None):
     #if args.ith_chunk is not None:
     #    assert(args.nchunk == 1) #if choose a chunk, only doing 1 chunk
     if args.nobj is None:
-        parser.print_help()
+        get_parser().print_help()
         sys.exit(1)
 
     # Exit if expected output already exists
-    rsdir= get_outdir_runbrick(args.outdir,
-                        args.brick,args.rowstart,
-                        do_skipids=args.do_skipids,
-                        do_more=args.do_more)
-    rsdir= os.path.basename(rsdir)
-    tractor_fn= os.path.join(args.outdir,
-                    'tractor',args.brick[:3],args.brick,
-                    rsdir,
-                    'tractor-%s.fits' % args.brick)
-    if (os.path.exists(tractor_fn) &
-        (not args.overwrite_if_exists)):
-       print('Exiting, already finished %s' % tractor_fn)
+    if args.rowstarts:
+        rowstarts= args.rowstarts
+    else:
+        rowstarts= [args.rowstart]
+    todo= []
+    for rowstart in rowstarts:
+        rsdir= get_outdir_runbrick(args.outdir,
+                            args.brick,rowstart,
+                            do_skipids=args.do_skipids,
+                            do_more=args.do_more)
+        rsdir= os.path.basename(rsdir)
+        tractor_fn= os.path.join(args.outdir,
+                        'tractor',args.brick[:3],args.brick,
+                        rsdir,
+                        'tractor-%s.fits' % args.brick)
+        if (os.path.exists(tractor_fn) &
+            (not args.overwrite_if_exists)):
+           print('Already finished %s' % tractor_fn)
+        else:
+           todo.append(rowstart)
+           RUNNING.append(rsdir)
+    if len(todo) == 0:
+       print('Exiting, already finished all rowstarts')
        return 0 #sys.exit(0)
+    record_states(args.outdir,
+                  [dict(brick=args.brick, rsdir=rsdir, state='running',
+                        rowstart=rowstart, threads=args.threads)
+                   for rsdir,rowstart in zip(RUNNING, todo)])
     #print(stamp_stat_fn)
     #f = open(stamp_stat_fn,'w')
     #f.close()
@@ -1627,11 +2367,9 @@ def main(args=None):
     #log.info('Number of objects = {}'.format(nobj))
     #log.info('Number of chunks = {}'.format(nchunk))
     # Optionally zoom into a portion of the brick
-    survey = LegacySurveyData(survey_dir=args.survey_dir)
-    brickinfo= get_brickinfo_hack(survey,brickname)
+    brickinfo,brickwcs= get_brick_geometry(brickname,args.survey_dir)
     #brickinfo = survey.get_brick_by_name(brickname)
     #print(brickname)
-    brickwcs = wcs_for_brick(brickinfo)
     W, H, pixscale = brickwcs.get_width(), brickwcs.get_height(), brickwcs.pixel_scale()
 
     log.info('Brick = {}'.format(brickname))
@@ -1658,63 +2396,99 @@ def main(args=None):
                     "do_skipids":args.do_skipids,
                     "randoms_from_fits":args.randoms_from_fits,
                     "dont_sort_sampleid":args.dont_sort_sampleid}
-    Samp,seed= get_sample(**sample_kwargs)
-    
-    #MS star compiling
-    try:
-       Samp= Samp[args.rowstart:args.rowstart + args.nobj]
-    except:
-       Samp= Samp
-    # Performance
-    #if objtype in ['elg','lrg']:
-    #    Samp=Samp[np.argsort( Samp.get('%s_n' % objtype) )]
-    print('Max sample size=%d, actual sample size=%d' % (args.nobj,len(Samp)))
-    assert(len(Samp) <= args.nobj)
-    t0= ptime('Got randoms sample',t0)
-
-    # Store args in dict for easy func passing
-    kwargs=dict(Samp=Samp,\
-                brickname=brickname, \
-                checkpoint_filename=args.checkpoint_filename, \
-                seed= seed,
-                decals_sim_dir= decals_sim_dir,\
-                brickwcs= brickwcs, \
-                objtype=objtype,\
-                nobj=len(Samp),\
-                maxobjs=args.nobj,\
-                rowst=args.rowstart,\
-                do_skipids=args.do_skipids,\
-                do_more=args.do_more,\
-                minid=args.minid,\
-                survey_dir=args.survey_dir,\
-                args=args)
-
-    # Stop if starting row exceeds length of radec,color table
-    if len(Samp) == 0:
-        fn= get_outdir_runbrick(kwargs['decals_sim_dir'],
-                        kwargs['brickname'],kwargs['rowst'],
-                        do_skipids=kwargs['do_skipids'],do_more=kwargs['do_more'])
-        fn+= '_exceeded.txt'
-        junk= os.system('touch %s' % fn)
-        print('Wrote %s' % fn)
-        raise ValueError('starting row=%d exceeds number of artificial sources, quit' % args.rowstart)
-
-    # Create simulated catalogues and run Tractor
-    create_metadata(kwargs=kwargs)
-    t0= ptime('create_metadata',t0)
-    # do chunks
-    #for ith_chunk in chunk_list:
-    #log.info('Working on chunk {:02d}/{:02d}'.format(ith_chunk,kwargs['nchunk']-1))
-    # Random ra,dec and source properties
-    create_ith_simcat(d=kwargs)
-    t0= ptime('create_ith_simcat',t0)
-    # Run tractor
-    do_one_chunk(d=kwargs)
-    t0= ptime('do_one_chunk',t0)
-    # Clean up output
-    if args.no_cleanup == False:
-        do_ith_cleanup(d=kwargs)
-    t0= ptime('do_ith_cleanup',t0)
+    # only the rows of the rowstarts to do, unless planning batches over all
+    row0= 0
+    if not args.plan_batches:
+        row0= min(todo)
+        sample_kwargs.update(rows=(row0, max(todo) + args.nobj))
+    Samp_all,seed= get_sample(**sample_kwargs)
+    if args.plan_batches and len(Samp_all) > 0:
+        Samp_all.set('batch', plan_batches(Samp_all, args.nobj))
+        log.info('%d randoms in %d batches, rowstarts 0 to %d' %
+                 (len(Samp_all), Samp_all.batch.max()+1,
+                  Samp_all.batch.max()*args.nobj))
+
+    ds= []
+    for rowstart in todo:
+        #MS star compiling
+        if args.plan_batches and len(Samp_all) > 0:
+           Samp= Samp_all[Samp_all.batch == rowstart // args.nobj]
+        else:
+          try:
+           Samp= Samp_all[rowstart - row0:rowstart - row0 + args.nobj]
+          except:
+           Samp= Samp_all
+        # Performance
+        #if objtype in ['elg','lrg']:
+        #    Samp=Samp[np.argsort( Samp.get('%s_n' % objtype) )]
+        print('Max sample size=%d, actual sample size=%d' % (args.nobj,len(Samp)))
+        assert(len(Samp) <= args.nobj)
+        t0= ptime('Got randoms sample',t0)
+
+        # Store args in dict for easy func passing
+        kwargs=dict(Samp=Samp,\
+                    brickname=brickname, \
+                    checkpoint_filename=args.checkpoint_filename, \
+                    seed= seed,
+                    decals_sim_dir= decals_sim_dir,\
+                    brickwcs= brickwcs, \
+                    objtype=objtype,\
+                    nobj=len(Samp),\
+                    maxobjs=args.nobj,\
+                    rowst=rowstart,\
+                    do_skipids=args.do_skipids,\
+                    do_more=args.do_more,\
+                    minid=args.minid,\
+                    survey_dir=args.survey_dir,\
+                    args=args)
+
+        # Stop if starting row exceeds length of radec,color table
+        if len(Samp) == 0:
+            fn= get_outdir_runbrick(kwargs['decals_sim_dir'],
+                            kwargs['brickname'],kwargs['rowst'],
+                            do_skipids=kwargs['do_skipids'],do_more=kwargs['do_more'])
+            fn+= '_exceeded.txt'
+            junk= os.system('touch %s' % fn)
+            print('Wrote %s' % fn)
+            # nothing to inject is not a failure
+            log.info('starting row=%d exceeds number of artificial sources, skipping' % rowstart)
+            rsdir= os.path.basename(get_outdir_runbrick('',brickname,rowstart,
+                            do_skipids=args.do_skipids,do_more=args.do_more))
+            record_state(args.outdir, brickname, rsdir, 'done',
+                         rowstart=rowstart, exceeded=True)
+            RUNNING.remove(rsdir)
+            continue
+
+        # Create simulated catalogues and run Tractor
+        create_metadata(kwargs=kwargs)
+        t0= ptime('create_metadata',t0)
+        # do chunks
+        #for ith_chunk in chunk_list:
+        #log.info('Working on chunk {:02d}/{:02d}'.format(ith_chunk,kwargs['nchunk']-1))
+        # Random ra,dec and source properties
+        create_ith_simcat(d=kwargs)
+        t0= ptime('create_ith_simcat',t0)
+        ds.append(kwargs)
+
+    if len(ds) == 0:
+        log.info('All starting rows exceed number of artificial sources, quit')
+        return 0
+    # the tims cache holds pristine tims, which only do_realizations reads
+    # and writes: --tims_cache_dir takes that path even for one rowstart
+    if args.rowstarts is None and args.tims_cache_dir is None:
+        kwargs= ds[0]
+        # Run tractor
+        do_one_chunk(d=kwargs)
+        t0= ptime('do_one_chunk',t0)
+        # Clean up output
+        if args.no_cleanup == False:
+            do_ith_cleanup(d=kwargs)
+        t0= ptime('do_ith_cleanup',t0)
+        record_done(kwargs)
+    else:
+        # Read the CCDs once (or not at all) for all rowstarts
+        do_realizations(ds=ds)
+        t0= ptime('do_realizations',t0)
     log.info('All done!')
     return 0
 
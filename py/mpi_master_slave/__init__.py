@@ -1,4 +1,5 @@
 from mpi_master_slave.master_slave import *
 from mpi_master_slave.work_queue import *
 from mpi_master_slave.multi_work_queue import *
+from mpi_master_slave.dispatcher import *
 import mpi_master_slave.exceptions
@@ -0,0 +1,357 @@
+from mpi4py import MPI
+from collections import deque
+import time
+from mpi_master_slave.master_slave import Tags
+
+__all__ = ['Dispatcher', 'SubMaster', 'run_tasks']
+
+
+class Dispatcher:
+    """
+    Event driven alternative to Master + WorkQueue: it blocks in a single
+    receive from MPI.ANY_SOURCE and answers each READY with the next task,
+    so there is no polling of every slave and no sleeping in between.
+
+    Works with plain Slave processes, which get one task at a time, and
+    with SubMasters, which ask for a list of tasks at a time.
+
+    With a deadline (unix time) and duration(task) in seconds, a task is
+    only handed out if it can finish before the deadline; the first one
+    of the queue that can goes first, and the others are left unstarted
+    (in skipped: the time left only shrinks, so they never will).
+    """
+
+    def __init__(self, comm=None, slaves=None, deadline=None, duration=None):
+        """
+        comm:     communicator the slaves are in, rank 0 of it runs this
+        slaves:   ranks to dispatch to, all the others by default
+        deadline, duration: see above
+        """
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        if slaves is None:
+            slaves = range(1, self.comm.Get_size())
+        self.slaves = set(slaves)
+        self.queue = deque()
+        self.skipped = deque()
+        self.slave_stats = {}
+        self.latencies = []
+        self.wait_time = 0.
+        self.wall_time = 0.
+        self.ntasks = 0
+        self.deadline = deadline
+        self.duration = duration
+
+    def add_work(self, data):
+        """
+        Add a task, tasks are handed out in the order they were added
+        """
+        self.queue.append(data)
+
+    def run(self, callback=None):
+        """
+        Hand out all the tasks, return when every slave has exited.
+        callback(result) is called with the return value of each task
+        """
+        status = MPI.Status()
+        active = set(self.slaves)
+        t_start = time.time()
+        while active:
+            t0 = time.time()
+            data = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                                  status=status)
+            t1 = time.time()
+            self.wait_time += t1 - t0
+            slave = status.Get_source()
+            tag = status.Get_tag()
+
+            if tag == Tags.DONE:
+                self.__collect([data], callback)
+
+            elif tag == Tags.READY:
+                # SubMasters send back the results of their last chunk
+                # and how many tasks they want next
+                chunk = None
+                if data is not None:
+                    self.__collect(data['results'], callback)
+                    chunk = data['chunk']
+                self.__dispatch(slave, chunk)
+                self.latencies.append(time.time() - t1)
+
+            elif tag == Tags.EXIT:
+                if data is not None:
+                    self.__collect(data.get('results', []), callback)
+                    self.slave_stats[slave] = data.get('stats')
+                active.remove(slave)
+
+        self.wall_time = time.time() - t_start
+
+    def __next_tasks(self, n):
+        # the first n tasks of the queue with time to finish, each task is
+        # popped once: those without go to skipped
+        if self.deadline is None or self.duration is None:
+            return [self.queue.popleft() for i in range(min(n, len(self.queue)))]
+        left = self.deadline - time.time()
+        tasks = []
+        while self.queue and len(tasks) < n:
+            task = self.queue.popleft()
+            if self.duration(task) <= left:
+                tasks.append(task)
+            else:
+                self.skipped.append(task)
+        return tasks
+
+    def __dispatch(self, slave, chunk):
+        tasks = self.__next_tasks(1 if chunk is None else chunk)
+        if not tasks:
+            self.comm.send(None, dest=slave, tag=Tags.EXIT)
+            return
+        self.ntasks += len(tasks)
+        data = tasks[0] if chunk is None else tasks
+        self.comm.send(data, dest=slave, tag=Tags.START)
+
+    def __collect(self, results, callback):
+        if callback is None:
+            return
+        for result in results:
+            callback(result)
+
+    def stats(self):
+        """
+        Dispatch metrics: how long the dispatcher took to answer a READY
+        (latency), which fraction of the run it was idle waiting for messages
+        (the higher the better), and how long the slaves waited for work
+        """
+        lat = sorted(self.latencies)
+        slaves = [s for s in self.slave_stats.values() if s is not None]
+        # SubMasters report the stats of their own slaves
+        flat = []
+        for s in slaves:
+            flat.extend(s.get('slaves', [s]))
+        busy = sum([s['busy'] for s in flat])
+        idle = sum([s['idle'] for s in flat])
+        return dict(ntasks=self.ntasks,
+                    unstarted=len(self.queue) + len(self.skipped),
+                    wall=self.wall_time,
+                    wait_fraction=self.wait_time / max(self.wall_time, 1e-9),
+                    latency_mean=sum(lat) / max(len(lat), 1),
+                    latency_max=lat[-1] if lat else 0.,
+                    latency_p99=lat[int(0.99 * (len(lat) - 1))] if lat else 0.,
+                    slaves=len(flat),
+                    slave_busy=busy,
+                    slave_idle=idle,
+                    slave_idle_fraction=idle / max(busy + idle, 1e-9))
+
+    def report(self):
+        s = self.stats()
+        print('Dispatcher: %(ntasks)d tasks (%(unstarted)d left unstarted) in %(wall).1f s, idle %(wait_fraction).3f '
+              'of the time; latency mean %(latency_mean).2e s, p99 %(latency_p99).2e s, '
+              'max %(latency_max).2e s; %(slaves)d slaves busy %(slave_busy).1f s, '
+              'waiting for work %(slave_idle).1f s (%(slave_idle_fraction).3f)' % s)
+        return s
+
+
+class SubMaster:
+    """
+    Runs on one rank per node: fetches `chunk` tasks at a time from the
+    Dispatcher on `top_comm` and hands them to the slaves of its node on
+    `comm`, so the top Dispatcher only hears from one rank per node.
+
+    With a capacity (e.g. cores, memory of the node) and cost(task) giving
+    the same quantities per task, a task only starts when what the running
+    tasks use plus its cost fits in the capacity. Ready slaves wait for a
+    task that fits, and the first task of the queue that fits goes first,
+    so the small tasks fill the node around the big ones (those wait, in
+    order, until a running task finishes).
+
+    deadline and duration(task) are as for the Dispatcher: the tasks that
+    can no longer finish in time are dropped instead of started.
+
+    on_queued(tasks) is called with each chunk of tasks the node gets,
+    before they start, e.g. to stage their inputs on the node. The next
+    chunk is fetched as soon as fewer than low_water tasks (default: one
+    chunk) are left waiting in the queue, so its inputs are staged while
+    the current tasks run.
+    """
+
+    def __init__(self, top_comm, comm, slaves, chunk=None, capacity=None,
+                 cost=None, deadline=None, duration=None, on_queued=None,
+                 low_water=None):
+        self.top_comm = top_comm
+        self.comm = comm
+        self.slaves = set(slaves)
+        self.chunk = max(len(self.slaves), 1) if chunk is None else chunk
+        self.capacity = capacity
+        self.cost = cost
+        self.deadline = deadline
+        self.duration = duration
+        self.on_queued = on_queued
+        self.low_water = self.chunk if low_water is None else low_water
+
+    def late(self, task):
+        if self.deadline is None or self.duration is None:
+            return False
+        return self.duration(task) > self.deadline - time.time()
+
+    def next_task(self, queue, waiting, running):
+        """
+        Pops the first task of queue that fits next to the running ones,
+        or returns None. Late tasks are dropped, the ones that do not fit
+        are moved to waiting.
+        """
+        while queue:
+            task = queue.popleft()
+            if self.late(task):
+                print('SubMaster: no time left for %s, not starting it' % (task,))
+                continue
+            if self.fits(task, running):
+                return task
+            waiting.append(task)
+        return None
+
+    def fetch(self, queue, results):
+        '''
+        Sends the results so far to the Dispatcher and queues the chunk of
+        tasks it answers with; returns False once it has no more tasks.
+        '''
+        status = MPI.Status()
+        self.top_comm.send(dict(results=results, chunk=self.chunk),
+                           dest=0, tag=Tags.READY)
+        tasks = self.top_comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == Tags.EXIT:
+            return False
+        queue.extend(tasks)
+        if self.on_queued is not None:
+            self.on_queued(tasks)
+        return True
+
+    def fits(self, task, running):
+        if self.capacity is None or self.cost is None or not running:
+            # an empty node takes any task, however big
+            return True
+        used = [sum(c) for c in zip(*running.values())]
+        return all([u + c <= cap for u,c,cap in
+                    zip(used, self.cost(task), self.capacity)])
+
+    def run(self):
+        status = MPI.Status()
+        queue = deque()
+        # tasks that did not fit, back in front of queue when a task ends
+        waiting = deque()
+        results = []
+        slave_stats = []
+        top_done = False
+        active = set(self.slaves)
+        # slave -> cost of its task, slaves waiting for a task
+        running = {}
+        ready = deque()
+        while active:
+            data = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                                  status=status)
+            slave = status.Get_source()
+            tag = status.Get_tag()
+
+            if tag == Tags.DONE:
+                results.append(data)
+                if running.pop(slave, None) is not None:
+                    queue.extendleft(reversed(waiting))
+                    waiting.clear()
+
+            elif tag == Tags.READY:
+                if running.pop(slave, None) is not None:
+                    queue.extendleft(reversed(waiting))
+                    waiting.clear()
+                ready.append(slave)
+
+            elif tag == Tags.EXIT:
+                if data is not None and data.get('stats') is not None:
+                    slave_stats.append(data['stats'])
+                active.remove(slave)
+                continue
+
+            while ready:
+                task = self.next_task(queue, waiting, running)
+                if task is None and waiting:
+                    # wait for a running task to free its share of the node
+                    break
+                if task is None and not top_done:
+                    top_done = not self.fetch(queue, results)
+                    results = []
+                    continue
+                if task is None:
+                    for s in ready:
+                        self.comm.send(None, dest=s, tag=Tags.EXIT)
+                    ready.clear()
+                    break
+                s = ready.popleft()
+                if self.cost is not None:
+                    running[s] = self.cost(task)
+                self.comm.send(task, dest=s, tag=Tags.START)
+
+            # keep the next chunk queued ahead of the running tasks
+            if len(queue) + len(waiting) < self.low_water and not top_done:
+                top_done = not self.fetch(queue, results)
+                results = []
+
+        self.top_comm.send(dict(results=results,
+                                stats=dict(slaves=slave_stats)),
+                           dest=0, tag=Tags.EXIT)
+
+
+def run_tasks(get_tasks, make_slave, comm=None, submasters=False, chunk=None,
+              callback=None, capacity=None, cost=None, deadline=None,
+              duration=None, on_queued=None, low_water=None):
+    """
+    Runs on every rank of comm: rank 0 dispatches get_tasks(), the others
+    run the Slave returned by make_slave(comm, master).
+
+    With submasters=True one rank per node (the first one, the second one
+    on the node of rank 0) relays chunks of tasks to the other ranks of its
+    node. capacity and cost(task) make the SubMasters pack tasks on their
+    node, see SubMaster. deadline and duration(task) keep the tasks that
+    cannot finish in time from starting, see Dispatcher. on_queued(tasks)
+    runs on the SubMasters, which keep low_water tasks queued ahead, see
+    SubMaster.
+
+    Returns the Dispatcher stats on rank 0, None elsewhere.
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    rank = comm.Get_rank()
+
+    if not submasters:
+        if rank == 0:
+            dispatcher = Dispatcher(comm=comm, deadline=deadline,
+                                    duration=duration)
+            for task in get_tasks():
+                dispatcher.add_work(task)
+            dispatcher.run(callback=callback)
+            return dispatcher.report()
+        make_slave(comm, 0).run()
+        return None
+
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    # world rank of each node rank, and which of them leads the node
+    node_ranks = node_comm.allgather(rank)
+    if node_ranks[0] == 0:
+        leader = 1 if len(node_ranks) > 1 else None
+    else:
+        leader = 0
+    is_leader = (leader is not None and node_comm.Get_rank() == leader)
+    top_comm = comm.Split(0 if (rank == 0 or is_leader) else MPI.UNDEFINED,
+                          key=rank)
+
+    if rank == 0:
+        dispatcher = Dispatcher(comm=top_comm, deadline=deadline,
+                                duration=duration)
+        for task in get_tasks():
+            dispatcher.add_work(task)
+        dispatcher.run(callback=callback)
+        return dispatcher.report()
+    if is_leader:
+        slaves = [i for i,r in enumerate(node_ranks)
+                  if i != leader and r != 0]
+        SubMaster(top_comm, node_comm, slaves, chunk=chunk, capacity=capacity,
+                  cost=cost, deadline=deadline, duration=duration,
+                  on_queued=on_queued, low_water=low_water).run()
+        return None
+    make_slave(node_comm, leader).run()
+    return None
@@ -1,5 +1,6 @@
 from mpi4py import MPI
 from enum import IntEnum
+import time
 from mpi_master_slave import exceptions
 from abc import ABC, abstractmethod
 
@@ -124,28 +125,40 @@ class Slave(ABC):
     A slave process extend this class, create an instance and invoke the run
     process
     """
-    def __init__(self):
-        self.comm = MPI.COMM_WORLD
+    def __init__(self, comm=None, master=0):
+        """
+        comm, master: communicator and rank of the Master (or Dispatcher,
+        SubMaster) to work for
+        """
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        self.master = master
         
     def run(self):
         """
         Invoke this method when ready to put this slave to work
         """
         status = MPI.Status()
+        # seconds spent waiting for work and working, see Dispatcher.stats
+        stats = dict(idle=0., busy=0., ntasks=0)
         
         while True:
-            self.comm.send(None, dest=0, tag=Tags.READY)
-            data = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            t0 = time.time()
+            self.comm.send(None, dest=self.master, tag=Tags.READY)
+            data = self.comm.recv(source=self.master, tag=MPI.ANY_TAG, status=status)
             tag = status.Get_tag()
+            t1 = time.time()
+            stats['idle'] += t1 - t0
     
             if tag == Tags.START:
                 # Do the work here
                 result = self.do_work(data)
-                self.comm.send(result, dest=0, tag=Tags.DONE)
+                self.comm.send(result, dest=self.master, tag=Tags.DONE)
+                stats['busy'] += time.time() - t1
+                stats['ntasks'] += 1
             elif tag == Tags.EXIT:
                 break
         
-        self.comm.send(None, dest=0, tag=Tags.EXIT)
+        self.comm.send(dict(stats=stats), dest=self.master, tag=Tags.EXIT)
         
     @abstractmethod
     def do_work(self, data):
@@ -1,3 +1,5 @@
+from collections import deque
+
 __all__=['WorkQueue']
 
 __author__='Luca Scarabello'
@@ -9,7 +11,7 @@ class WorkQueue:
    
     def __init__(self, master):
         self.master = master
-        self.work_queue           = []
+        self.work_queue           = deque()
         self.resources_work_queue = {}
         self.slave_resources      = {}
 
@@ -71,7 +73,7 @@ class WorkQueue:
             self.work_queue.append(data)
         else:
             # add a task in the work queue with specifc resource_id
-            work_queue = self.resources_work_queue.get(resource_id, list())
+            work_queue = self.resources_work_queue.get(resource_id, deque())
             work_queue.append(data)
             self.resources_work_queue[resource_id] = work_queue
 
@@ -83,11 +85,11 @@ class WorkQueue:
         if resource_id is None:
             # Anonymous work queue
             if self.work_queue:
-                data = self.work_queue.pop(0)
+                data = self.work_queue.popleft()
         elif resource_id in self.resources_work_queue:
             # work queue with resource id
             work_queue = self.resources_work_queue[resource_id]
-            data = work_queue.pop(0)
+            data = work_queue.popleft()
             if not work_queue:
                 del self.resources_work_queue[resource_id]
         return data
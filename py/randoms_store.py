@@ -0,0 +1,79 @@
+"""
+Brick sorted columnar store of the randoms
+
+One directory instead of a fits file per brick:
+    STORE/index_PART.npy: brickname, offset, count of the bricks of a part
+    STORE/part_PART/COLUMN.npy: one array per column, rows sorted by brick
+        then id
+Each node of random_division/GetBricksSrc.py writes one part. Reading a
+    brick memory maps its rows of each column, and only the rows asked for.
+"""
+import os
+import numpy as np
+from glob import glob
+
+INDEX_DTYPE = [('brickname', 'U8'), ('offset', 'i8'), ('count', 'i8')]
+
+# store directory -> brickname -> (part, offset, count)
+INDEX = {}
+
+def write_part(store_dir, part, data, bricknames, counts):
+    """Writes one part of the store
+
+    Args:
+        part: integer, e.g. the node number
+        data: structured array or fits record array, rows grouped by brick
+            in the order of bricknames (sorted by id within a brick)
+        bricknames, counts: bricks and their number of rows
+    """
+    partdir = os.path.join(store_dir, 'part_%d' % part)
+    if not os.path.exists(partdir):
+        os.makedirs(partdir, exist_ok=True)
+    for name in data.dtype.names:
+        col = np.asarray(data[name])
+        # native byte order, fits is big endian
+        col = col.astype(col.dtype.newbyteorder('='))
+        np.save(os.path.join(partdir, '%s.npy' % name.lower()), col)
+    index = np.zeros(len(bricknames), INDEX_DTYPE)
+    index['brickname'] = bricknames
+    index['count'] = counts
+    index['offset'] = np.cumsum(counts) - counts
+    # the index last: a part without its index is not used
+    np.save(os.path.join(store_dir, 'index_%d.npy' % part), index)
+
+def get_index(store_dir):
+    if store_dir not in INDEX:
+        index = {}
+        for fn in glob(os.path.join(store_dir, 'index_*.npy')):
+            part = int(os.path.basename(fn)[len('index_'):-len('.npy')])
+            for b in np.load(fn):
+                index[str(b['brickname'])] = (part, b['offset'], b['count'])
+        INDEX[store_dir] = index
+    return INDEX[store_dir]
+
+def read_brick(store_dir, brick, rows=None, minid=None):
+    """Randoms of a brick, sorted by id
+
+    Args:
+        rows: (start, stop) to only read these rows, after the minid cut
+        minid: only the randoms with id >= minid
+
+    Returns:
+        fits_table, empty if the brick has no randoms
+    """
+    from astrometry.util.fits import fits_table
+    T = fits_table()
+    if brick not in get_index(store_dir):
+        return T
+    part, offset, count = get_index(store_dir)[brick]
+    partdir = os.path.join(store_dir, 'part_%d' % part)
+    start, stop = offset, offset + count
+    if minid is not None:
+        ids = np.load(os.path.join(partdir, 'id.npy'), mmap_mode='r')
+        start += np.searchsorted(ids[start:stop], minid)
+    if rows is not None:
+        start, stop = min(start + rows[0], stop), min(start + rows[1], stop)
+    for fn in sorted(glob(os.path.join(partdir, '*.npy'))):
+        col = np.load(fn, mmap_mode='r')
+        T.set(os.path.basename(fn)[:-len('.npy')], np.array(col[start:stop]))
+    return T
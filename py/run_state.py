@@ -0,0 +1,76 @@
+"""
+Run state of each brick and rsdir, in append-only manifests
+
+Every process appends json lines to its own manifest,
+    OUTDIR/state/manifest-JOBID-RANK.jsonl (one line per state change),
+    so there are no concurrent writers to a file. The latest record of a
+    (brick, rsdir) over all manifests is its state; reading them all once
+    replaces looking at the log of every brick (see brickstat.py)
+"""
+import os
+import json
+import socket
+import time
+from glob import glob
+
+STATES = ['queued', 'running', 'done', 'failed']
+
+def get_manifest_fn(outdir):
+    """This process' manifest in outdir/state/"""
+    env = os.environ
+    jobid = env.get('SLURM_JOB_ID', 'nojob')
+    if 'SLURM_PROCID' in env:
+        writer = env['SLURM_PROCID']
+    else:
+        writer = '%s-%d' % (socket.gethostname(), os.getpid())
+    return os.path.join(outdir, 'state', 'manifest-%s-%s.jsonl' % (jobid, writer))
+
+def record_states(outdir, records):
+    """Appends records, dicts with brick, rsdir, state (see STATES) and any
+    other info, stamped with the time, host, pid and job id"""
+    fn = get_manifest_fn(outdir)
+    dirnm = os.path.dirname(fn)
+    if not os.path.exists(dirnm):
+        os.makedirs(dirnm, exist_ok=True)
+    stamp = dict(time=time.time(), host=socket.gethostname(), pid=os.getpid(),
+                 jobid=os.environ.get('SLURM_JOB_ID'))
+    lines = []
+    for r in records:
+        assert(r['state'] in STATES)
+        rec = dict(stamp)
+        rec.update(r)
+        lines.append(json.dumps(rec) + '\n')
+    # one write, so a killed process leaves at most a partial last line
+    with open(fn, 'a') as f:
+        f.write(''.join(lines))
+
+def record_state(outdir, brick, rsdir, state, **info):
+    """Appends one record, e.g. record_state(outdir, brick, 'rs0', 'failed',
+    reason='...')"""
+    info.update(brick=brick, rsdir=rsdir, state=state)
+    record_states(outdir, [info])
+
+def read_states(outdir, rsdir=None):
+    """Latest record of each brick and rsdir
+
+    Args:
+        rsdir: only read the records of this rsdir, e.g. rs0
+
+    Returns:
+        dict (brick, rsdir) -> record
+    """
+    states = {}
+    for fn in glob(os.path.join(outdir, 'state', 'manifest-*.jsonl')):
+        with open(fn) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # partial line of a killed writer
+                    continue
+                if rsdir is not None and rec['rsdir'] != rsdir:
+                    continue
+                key = (rec['brick'], rec['rsdir'])
+                if key not in states or rec['time'] >= states[key]['time']:
+                    states[key] = rec
+    return states
@@ -0,0 +1,600 @@
+# Tests of kenobi.py and the modules next to it, run from py/ (on
+# PYTHONPATH, see example1.sh): python -m unittest unit_tests
+import os
+import sys
+import unittest
+
+# the scripts of collect/ (and brickstat/, random_division/) import each
+# other as they do when run from their own directory, see collect.sh
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for dirnm in ['collect', 'brickstat', 'random_division']:
+    sys.path.append(os.path.join(TOP, dirnm))
+
+class FakeImage(object):
+    # the image object of a tim, as far as the tims cache uses it
+    def __init__(self, imgfn):
+        self.imgfn = imgfn
+        self.expnum = 1234
+        self.ccdname = 'N4'
+
+    def get_cacheable_filename_variables(self):
+        return ['imgfn', 'psffn']
+
+class FakeTim(object):
+    pass
+
+class TestTimsCache(unittest.TestCase):
+
+    def test_cache_dir_key(self):
+        import argparse
+        import tempfile
+        from kenobi import get_tims_cache_dir
+
+        ccdfn = os.path.join(tempfile.mkdtemp(), 'survey-ccds-test.fits.gz')
+        open(ccdfn, 'wb').close()
+        class FakeSurvey(object):
+            def find_file(self, filetype):
+                return dict(ccds=[ccdfn], **{'ccd-kds': []})[filetype]
+            def filter_ccds_files(self, fns):
+                return fns
+            def filter_ccd_kd_files(self, fns):
+                return fns
+        args = argparse.Namespace(dataset='dr9', run='south', survey_dir=None,
+                                  skip_ccd_cuts=False, sparse_margin=None)
+        kw = dict(pixPsf=True, splinesky=True)
+        def cache_dir(kw=kw):
+            return get_tims_cache_dir('/cache', '1000p100', kw, args, FakeSurvey())
+        d0 = cache_dir()
+        self.assertTrue(d0.startswith('/cache/100/1000p100/tims-'))
+        # the same for any --sparse_margin (and sims)
+        args.sparse_margin = 5.
+        self.assertEqual(cache_dir(), d0)
+        # not for other stage_tims options or survey-ccds tables
+        self.assertNotEqual(cache_dir(dict(kw, pixPsf=False)), d0)
+        st = os.stat(ccdfn)
+        os.utime(ccdfn, (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(cache_dir(), d0)
+
+    def test_round_trip(self):
+        import tempfile
+        import numpy as np
+        from kenobi import write_tims_cache, read_tims_cache, copy_tim
+
+        tmpdir = tempfile.mkdtemp()
+        imgfn = os.path.join(tmpdir, 'image.fits.fz')
+        open(imgfn, 'wb').close()
+        tim = FakeTim()
+        tim.imobj = FakeImage(imgfn)
+        tim.band = 'g'
+        tim.x0,tim.y0 = 0,0
+        tim.data = np.arange(12, dtype=np.float32).reshape(3,4)
+        tim.inverr = np.ones((3,4), np.float32)
+        tim.dq = np.zeros((3,4), np.int16)
+        dirnm = os.path.join(tmpdir, 'cache', 'tims-abc')
+        write_tims_cache(dirnm, dict(tims=[tim], bands=['g']))
+
+        R = read_tims_cache(dirnm)
+        self.assertEqual(sorted(R.keys()), ['bands', 'tims'])
+        self.assertTrue(np.all(R['tims'][0].data == tim.data))
+        self.assertTrue(np.all(R['tims'][0].dq == tim.dq))
+        # copies are copy-on-write, the cache is not changed
+        c = copy_tim(R['tims'][0])
+        c.data += 1
+        self.assertTrue(np.all(read_tims_cache(dirnm)['tims'][0].data == tim.data))
+        # a changed image file makes it stale
+        st = os.stat(imgfn)
+        os.utime(imgfn, (st.st_atime, st.st_mtime + 10))
+        self.assertTrue(read_tims_cache(dirnm) is None)
+        self.assertFalse(os.path.exists(dirnm))
+
+class TestStampEngines(unittest.TestCase):
+
+    def test_batch_matches_buildstamp(self):
+        # the same simcat injected by BatchStamp and by BuildStamp
+        import numpy as np
+        from astrometry.util.util import Tan
+        from astrometry.util.fits import fits_table
+        from tractor import (Image, ConstantFitsWcs, LinearPhotoCal,
+                             ConstantSky, GaussianMixturePSF)
+        from legacypipe.utils import SparseImage
+        from kenobi import inject_simcat
+
+        # wide enough that the stamps only touch a few of its tiles
+        H,W = 80,300
+        wcs = Tan(40., 10., 50.5, 40.5, -0.262/3600., 0., 0., 0.262/3600.,
+                  float(W), float(H))
+
+        class Obj(object):
+            pass
+        def make_tim():
+            rng = np.random.RandomState(42)
+            inverr = np.ones((H,W), np.float32)
+            inverr[10,:] = 0.
+            tim = Image(data=rng.normal(size=(H,W)).astype(np.float32),
+                        inverr=inverr, wcs=ConstantFitsWcs(wcs),
+                        psf=GaussianMixturePSF(1., 0., 0., 4., 4., 0.),
+                        photocal=LinearPhotoCal(1., band='g'),
+                        sky=ConstantSky(0.), name='synthetic')
+            tim.band = 'g'
+            tim.zpscale = 1.
+            tim.gain = 4.
+            tim.subwcs = wcs
+            tim.dq = np.zeros((H,W), np.int16)
+            tim.dq[30,:] = 1
+            tim.imobj = Obj()
+            tim.imobj.expnum = 1234
+            tim.imobj.ccdname = 'N4'
+            return tim
+
+        simcat = fits_table()
+        # centre, across the dq and inverr rows, next to the edge, off the CCD
+        simcat.id = np.arange(4)
+        simcat.x = np.array([50., 40., 2., 400.])
+        simcat.y = np.array([40., 20., 60., 40.])
+        simcat.ra,simcat.dec = wcs.pixelxy2radec(simcat.x+1, simcat.y+1)
+        simcat.n = np.array([1, 4, 1, 1])
+        simcat.rhalf = np.array([1., 0.5, 2., 1.])
+        simcat.e1 = np.array([0., 0.2, -0.1, 0.])
+        simcat.e2 = np.array([0., 0.1, 0.3, 0.])
+        simcat.gflux = np.array([500., 200., 300., 100.])
+        metacat = fits_table()
+        metacat.objtype = np.array(['elg'])
+
+        survey = Obj()
+        survey.simcat = simcat
+        survey.metacat = metacat
+        survey.seed = 7
+        survey.image_eq_model = False
+        survey.targetwcs = wcs
+        survey.psf_grid = None
+        for add_sim_noise in [False, True]:
+            tims = []
+            for engine in ['buildstamp', 'batch']:
+                survey.stamp_engine = engine
+                survey.add_sim_noise = add_sim_noise
+                tims.append(inject_simcat(make_tim(), survey, camera='decam',
+                                          exptime=90.))
+            ref,tim = tims
+            self.assertEqual(list(ref.ids_added), [0, 1, 2])
+            self.assertEqual(list(tim.ids_added), list(ref.ids_added))
+            for key in ['data', 'inverr', 'sims_image', 'sims_inverr']:
+                self.assertTrue(np.allclose(np.asarray(getattr(tim, key)),
+                                            np.asarray(getattr(ref, key)),
+                                            rtol=1e-5, atol=1e-7), key)
+            # no full CCD sims planes, whichever the engine
+            for t in tims:
+                for key in ['sims_image', 'sims_inverr']:
+                    img = getattr(t, key)
+                    self.assertTrue(isinstance(img, SparseImage), key)
+                    self.assertTrue(img.nbytes < H*W*4, key)
+
+class TestMatched(unittest.TestCase):
+
+    def test_prematched_matches_kd(self):
+        # kenobi.py --write_matched and collect.py kd_brick_match give the
+        # same table
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from kenobi import write_matched
+        from collect import kd_brick_match
+
+        brick = '1000p100'
+        outdir = tempfile.mkdtemp()
+        def brick_fn(kind, fn):
+            dirnm = os.path.join(outdir, 'output', kind, brick[:3], brick, 'rs0')
+            if not os.path.exists(dirnm):
+                os.makedirs(dirnm)
+            return os.path.join(dirnm, fn % brick)
+        class FakeSurvey(object):
+            def find_file(self, filetype, brick=None, output=False):
+                return dict(tractor=brick_fn('tractor', 'tractor-%s.fits'),
+                            **{'ref-sources': brick_fn('metrics', 'reference-%s.fits')})[filetype]
+        pixscale = 0.262/3600.
+        rng = np.random.RandomState(3)
+
+        T = fits_table()
+        T.bx = rng.uniform(0, 3600, 30).astype(np.float32)
+        T.by = rng.uniform(0, 3600, 30).astype(np.float32)
+        T.ra = 100. + (T.bx - 1800) * pixscale / np.cos(np.radians(10.))
+        T.dec = 10. + (T.by - 1800) * pixscale
+        T.flux_g = rng.uniform(1, 10, 30).astype(np.float32)
+        T.writeto(brick_fn('tractor', 'tractor-%s.fits'))
+        # the refs file has the donotfit and cluster stars stage_refs cuts
+        R = fits_table()
+        R.ra = 100. + rng.uniform(-0.1, 0.1, 5)
+        R.dec = 10. + rng.uniform(-0.1, 0.1, 5)
+        R.radius = rng.uniform(0.001, 0.01, 5).astype(np.float32)
+        R.donotfit = np.array([True, False, False, False, False])
+        R.iscluster = np.array([False, True, False, False, False])
+        randoms = fits_table()
+        randoms.id = np.arange(10)
+        randoms.ra = 100. + rng.uniform(-0.1, 0.1, 10)
+        randoms.dec = 10. + rng.uniform(-0.1, 0.1, 10)
+        randoms.redshift = rng.uniform(0.5, 1.5, 10)
+        os.makedirs(os.path.join(outdir, 'divided_randoms'))
+        randoms.writeto(os.path.join(outdir, 'divided_randoms', 'brick_%s.fits' % brick))
+        sim = randoms[np.array([7, 2, 5, 0])]
+        sim.x = 1800 + (sim.ra - 100.) * np.cos(np.radians(10.)) / pixscale
+        sim.y = 1800 + (sim.dec - 10.) / pixscale
+        for key in ['gflux', 'rflux', 'zflux', 'rhalf', 'e1', 'e2']:
+            sim.set(key, rng.uniform(0.1, 1., len(sim)))
+        sim.n = np.array([1, 4, 1, 1])
+        simfn = brick_fn('obiwan', 'simcat-elg-%s.fits')
+        sim.writeto(simfn)
+
+        os.environ['obiwan_out'] = outdir
+        os.environ.pop('randoms_store', None)
+        # with the reference stars, then without any
+        for nrefs in [5, 0]:
+            R[:nrefs].writeto(brick_fn('metrics', 'reference-%s.fits'))
+            kd = kd_brick_match(brick, 'run', 'rs0', name_for_randoms='randoms',
+                                startid=0, nobj=10)
+            kdfn = os.path.join(outdir, 'kd.fits')
+            kd.write(kdfn, format='fits', overwrite=True)
+            kd = fits_table(kdfn)
+            write_matched(dict(brickname=brick, simcat=sim, Samp=randoms,
+                               simcat_dir=os.path.dirname(simfn)), FakeSurvey())
+            pm = fits_table(brick_fn('obiwan', 'matched-%s.fits'))
+            self.assertEqual(sorted(pm.get_columns()), sorted(kd.get_columns()))
+            for c in kd.get_columns():
+                self.assertTrue(np.allclose(pm.get(c), kd.get(c), equal_nan=True), c)
+            self.assertEqual(np.all(np.isfinite(kd.star_distance)), nrefs > 0)
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_next_tasks(self):
+        import time
+        from mpi_master_slave.dispatcher import Dispatcher
+
+        # (name, seconds), 100 seconds left
+        d = Dispatcher(comm=object(), slaves=[1], deadline=time.time() + 100,
+                       duration=lambda task: task[1])
+        for task in [('a',10), ('b',1000), ('c',20), ('d',30), ('e',2000), ('f',5)]:
+            d.add_work(task)
+        self.assertEqual(d._Dispatcher__next_tasks(2), [('a',10), ('c',20)])
+        self.assertEqual(list(d.skipped), [('b',1000)])
+        self.assertEqual(d._Dispatcher__next_tasks(5), [('d',30), ('f',5)])
+        self.assertEqual(d._Dispatcher__next_tasks(1), [])
+        self.assertEqual(d.stats()['unstarted'], 2)
+
+        d = Dispatcher(comm=object(), slaves=[1])
+        for task in range(5):
+            d.add_work(task)
+        self.assertEqual(d._Dispatcher__next_tasks(3), [0, 1, 2])
+        self.assertEqual(d._Dispatcher__next_tasks(3), [3, 4])
+
+    def test_submaster_packing(self):
+        import time
+        from collections import deque
+        from mpi_master_slave.dispatcher import SubMaster
+
+        # tasks are (threads, seconds) on a 16 thread node
+        sm = SubMaster(None, None, [1, 2, 3], capacity=(16,),
+                       cost=lambda task: task[:1],
+                       deadline=time.time() + 100, duration=lambda task: task[1])
+        queue = deque([(12,10), (8,10), (2,500), (4,10), (1,10)])
+        waiting = deque()
+        running = {1: (10,)}
+        # the big tasks wait, the late one is dropped
+        self.assertEqual(sm.next_task(queue, waiting, running), (4,10))
+        self.assertEqual(list(waiting), [(12,10), (8,10)])
+        self.assertEqual(list(queue), [(1,10)])
+        running[2] = (4,)
+        self.assertEqual(sm.next_task(queue, waiting, running), (1,10))
+        self.assertEqual(sm.next_task(queue, waiting, running), None)
+        # an empty node takes the first one, however big
+        self.assertEqual(sm.next_task(waiting, deque(), {}), (12,10))
+
+class TestBrickCost(unittest.TestCase):
+
+    def setUp(self):
+        # brick_cost.py reads $CSCRATCH on import
+        os.environ.setdefault('CSCRATCH', '')
+
+    def write_ps(self, fn, seconds, workers, finished):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        # main process 10 with `workers` pool workers and the ps command, 2 steps
+        P = fits_table()
+        pids = [10] + [11 + i for i in range(workers)] + [99]
+        P.pid = np.array(pids * 2, np.int32)
+        P.ppid = np.array(([1] + [10] * (workers + 1)) * 2, np.int32)
+        P.command = np.array((['python kenobi.py'] * (workers + 1) + ['ps ax']) * 2)
+        P.step = np.repeat([1, 2], len(pids))
+        P.unixtime = 1000. + np.repeat([0., seconds], len(pids))
+        P.rss = np.ones(len(P), np.float32) * 100
+        P.vsz = np.ones(len(P), np.float32) * 1000
+        P.mine = np.ones(len(P), bool)
+        P.main = (P.pid == 10)
+        P.writeto(fn)
+        if finished:
+            E = fits_table()
+            E.unixtime = np.array([1000., 1000. + seconds])
+            E.event = np.array(['stage_writecat: starting', 'stage_writecat: done'])
+            E.step = np.array([1, 2])
+            E.writeto(fn, append=True)
+
+    def test_read_history(self):
+        import tempfile
+        import brick_cost
+
+        outdir = tempfile.mkdtemp()
+        rsdir = os.path.join(outdir, 'metrics', '123', '1234p567', 'rs0')
+        os.makedirs(rsdir)
+        # a long successful run, a shorter later one and a killed one
+        self.write_ps(os.path.join(rsdir, 'ps-1234p567-1.fits'), 500., 4, True)
+        self.write_ps(os.path.join(rsdir, 'ps-1234p567-2.fits'), 300., 8, True)
+        self.write_ps(os.path.join(rsdir, 'ps-1234p567-3.fits'), 900., 8, False)
+        saved = brick_cost.obiwan_out_dir
+        brick_cost.obiwan_out_dir = os.path.join(outdir, '')
+        try:
+            history = brick_cost.read_history('run', 'rs0')
+        finally:
+            brick_cost.obiwan_out_dir = saved
+        t, m, v, threads = history['1234p567']
+        # ps is a child of the main process, but not a pool worker
+        self.assertEqual((t, threads), (300., 8))
+        self.assertEqual((m, v), (1000., 1000.))
+
+    def test_predict_plan(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from brick_cost import FEATURES, predict, plan
+
+        T = fits_table()
+        T.brickname = np.array(['a', 'b', 'c'])
+        for f in FEATURES:
+            T.set(f, np.zeros(3, np.int32))
+        T.n_decam = np.array([10, 40, 20], np.int32)
+        # 100 s with 4 threads and 17000 kB over the 5 processes
+        history = dict(b=(100., 17000., 5000., 4))
+        w, m, v, timed = predict(T, history, (None, None, None), 1000, 2000)
+        self.assertEqual(list(w), [10., 400., 20.])
+        self.assertEqual(list(m), [1000., 3400., 1000.])
+        self.assertEqual(list(timed), [False, True, False])
+        P = plan(T, w, m, v, timed, min_threads=1, max_threads=8, mem_margin=1.)
+        self.assertEqual([p[0] for p in P], ['b', 'c', 'a'])
+        # on 8 threads: half the time of 4, the memory of 9 processes
+        self.assertEqual(tuple(P[0][1:]), (8, 30600, 5000, 50., True))
+        self.assertEqual(tuple(P[2][1:]), (1, 2000, 2000, 10., False))
+
+class TestRunState(unittest.TestCase):
+
+    def test_latest_state(self):
+        import tempfile
+        from run_state import record_states, read_states
+
+        outdir = tempfile.mkdtemp()
+        saved = os.environ.get('SLURM_PROCID')
+        try:
+            # two writers, each with its own manifest
+            os.environ['SLURM_PROCID'] = '0'
+            record_states(outdir, [dict(brick='a', rsdir='rs0', state='queued', time=1.),
+                                   dict(brick='b', rsdir='rs0', state='queued', time=1.),
+                                   dict(brick='a', rsdir='rs200', state='queued', time=1.)])
+            os.environ['SLURM_PROCID'] = '1'
+            record_states(outdir, [dict(brick='a', rsdir='rs0', state='running', time=2.),
+                                   dict(brick='a', rsdir='rs0', state='done', time=3.)])
+        finally:
+            if saved is None:
+                del os.environ['SLURM_PROCID']
+            else:
+                os.environ['SLURM_PROCID'] = saved
+        # a killed writer's partial line
+        with open(os.path.join(outdir, 'state', 'manifest-nojob-0.jsonl'), 'a') as f:
+            f.write('{"brick": "b", "rsd')
+        states = read_states(outdir)
+        self.assertEqual(len(states), 3)
+        self.assertEqual(states[('a','rs0')]['state'], 'done')
+        self.assertEqual(states[('b','rs0')]['state'], 'queued')
+        self.assertEqual(sorted(read_states(outdir, rsdir='rs0')), [('a','rs0'), ('b','rs0')])
+
+    def test_brick_classify(self):
+        import tempfile
+        os.environ.setdefault('CSCRATCH', '')
+        import brickstat
+        from run_state import record_states
+
+        rundir = tempfile.mkdtemp()
+        brickstat.obiwan_out_dir = os.path.join(rundir, 'NAME4RUN', 'output', '')
+        record_states(os.path.join(rundir, 'run', 'output'),
+                      [dict(brick='a', rsdir='rs0', state='done'),
+                       dict(brick='b', rsdir='rs0', state='failed')])
+        cwd = os.getcwd()
+        os.chdir(rundir)
+        try:
+            os.makedirs('real_brick_lists')
+            os.makedirs('run')
+            with open('real_brick_lists/bricks.txt', 'w') as f:
+                f.write('a\nb\nc\n')
+            brickstat.NAME_FOR_RUN, brickstat.RS = 'run', 'rs0'
+            brickstat.REAL_BRICKS_FN, brickstat.MANIFEST_ONLY = 'bricks.txt', True
+            brickstat.BrickClassify()
+            # c has no record
+            self.assertEqual(open('run/FinishedBricks.txt').read().split(), ['a'])
+            self.assertEqual(open('run/UnfinishedBricks.txt').read().split(), ['b', 'c'])
+        finally:
+            os.chdir(cwd)
+
+class TestRandomDivision(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        # GetBricksSrc.py reads $obiwan_out on import
+        os.environ.setdefault('obiwan_out', tempfile.mkdtemp())
+
+    def test_split_bricks(self):
+        import numpy as np
+        import GetBricksSrc
+
+        saved = GetBricksSrc.node_tot
+        try:
+            GetBricksSrc.node_tot = 3
+            node = GetBricksSrc.SplitBricks(np.array([5, 5, 5, 5, 5, 5]))
+            self.assertEqual(list(node), [0, 0, 1, 1, 2, 2])
+            # a big brick gets a node to itself, no node past the last
+            GetBricksSrc.node_tot = 2
+            node = GetBricksSrc.SplitBricks(np.array([100, 1, 1, 1]))
+            self.assertEqual(list(node), [0, 1, 1, 1])
+            node = GetBricksSrc.SplitBricks(np.array([0, 0]))
+            self.assertEqual(list(node), [0, 0])
+        finally:
+            GetBricksSrc.node_tot = saved
+
+    def test_brick_index_rows(self):
+        import numpy as np
+        from GetBricksSrc import get_brick_index, GetRows
+
+        # two rows of 4 bricks 90 deg wide, the second starting at ra 45
+        B = dict(RA1=np.array([0., 90., 180., 270., 45., 135., 225., 315.]),
+                 DEC1=np.array([-1.]*4 + [0.]*4))
+        B['RA'] = (B['RA1'] + 45.) % 360.
+        B['DEC'] = B['DEC1'] + 0.5
+        brick_index = get_brick_index(B)
+        ids = brick_index(np.array([10., 100., 359., 10., 50.]),
+                          np.array([-0.5, -0.5, -0.5, 0.5, 0.5]))
+        self.assertEqual(list(ids), [0, 1, 3, 7, 4])
+
+        dat = np.zeros(5, [('id', 'i8'), ('ra', 'f8')])
+        dat['id'] = [4, 3, 2, 1, 0]
+        # the rows of bricks 0 and 3 and 7, grouped by brick, by id within it
+        ids = np.array([3, 0, 7, 0, 1])
+        data = GetRows(dat, ids, np.array([0, 3, 7]), 8)
+        self.assertEqual(list(data['id']), [1, 3, 4, 2])
+
+class TestRealizations(unittest.TestCase):
+
+    def test_copy_tim(self):
+        import numpy as np
+        from kenobi import copy_tim
+
+        tim = FakeTim()
+        tim.data = np.ones((4,5), np.float32)
+        tim.inverr = np.ones((4,5), np.float32)
+        tim.dq = np.zeros((4,5), np.int16)
+        tim.psf = object()
+        c = copy_tim(tim)
+        # the sims go in the copy only, the rest is shared
+        c.data += 1.
+        c.dq[0,0] = 1
+        self.assertTrue(np.all(tim.data == 1.))
+        self.assertEqual(tim.dq[0,0], 0)
+        self.assertTrue(c.psf is tim.psf)
+
+    def test_realization_kwargs(self):
+        import argparse
+        from kenobi import get_realization_kwargs
+
+        args = argparse.Namespace(brick='1234p567', rowstart=0,
+                                  do_skipids='no', do_more='no',
+                                  pickle_pat='/out/pickles/123/1234p567/rs0/runbrick-%(brick)s-%%(stage)s.pickle',
+                                  checkpoint_filename=None,
+                                  ps='/out/metrics/123/1234p567/rs0/ps-1234p567-1.fits')
+        d = dict(args=args, simcat_dir='/out/sim/123/1234p567/rs200')
+        kw = get_realization_kwargs(d)
+        self.assertEqual(kw['pickle_pat'], '/out/pickles/123/1234p567/rs200/runbrick-%(brick)s-%%(stage)s.pickle')
+        self.assertEqual(kw['ps'], '/out/metrics/123/1234p567/rs200/ps-1234p567-1.fits')
+        self.assertEqual(kw['checkpoint_filename'], None)
+        # the args themselves are those of --rowstart
+        self.assertTrue('/rs0/' in args.ps)
+
+class TestNeighbors(unittest.TestCase):
+
+    def sample(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        # 1 is 2" from 0, 3 is 4" from 1 and 6" from 0, 2 is far
+        T = fits_table()
+        T.ra = np.array([10., 10., 11., 10.])
+        T.dec = np.array([0., 2., 0., 6.]) / 3600.
+        return T
+
+    def test_flag_nearest_neighbors(self):
+        from kenobi import flag_nearest_neighbors
+
+        # 1 is skipped for 0, so it does not flag 3
+        keep, skip = flag_nearest_neighbors(self.sample(), radius_in_deg=5./3600)
+        self.assertEqual((keep, skip), ([0, 2, 3], [1]))
+
+    def test_plan_batches(self):
+        from kenobi import plan_batches
+
+        batch = plan_batches(self.sample(), 2, radius_in_deg=5./3600)
+        # 3 goes with neither 1 (too close) nor 0 and 2 (batch full)
+        self.assertEqual(list(batch), [0, 1, 0, 2])
+
+class TestRandomsStore(unittest.TestCase):
+
+    def test_read_brick(self):
+        import tempfile
+        import numpy as np
+        from randoms_store import write_part, get_index, read_brick
+
+        store = tempfile.mkdtemp()
+        # FITS columns, upper case and big endian
+        dtype = [('ID', '>i8'), ('RA', '>f8')]
+        data = np.zeros(5, dtype)
+        data['ID'] = [1, 5, 2, 3, 7]
+        data['RA'] = np.arange(5)
+        write_part(store, 0, data, ['a', 'b'], [2, 3])
+        data = np.zeros(1, dtype)
+        data['ID'] = [4]
+        write_part(store, 1, data, ['c'], [1])
+
+        self.assertEqual(get_index(store)['b'], (0, 2, 3))
+        self.assertEqual(get_index(store)['c'], (1, 0, 1))
+        T = read_brick(store, 'b')
+        self.assertEqual(list(T.id), [2, 3, 7])
+        self.assertEqual(list(T.ra), [2., 3., 4.])
+        self.assertEqual(list(read_brick(store, 'b', minid=3).id), [3, 7])
+        self.assertEqual(list(read_brick(store, 'b', rows=(1, 5), minid=3).id), [7])
+        self.assertEqual(list(read_brick(store, 'c').id), [4])
+        self.assertEqual(len(read_brick(store, 'd')), 0)
+
+class TestStreamTables(unittest.TestCase):
+
+    def test_unify_dtypes(self):
+        import numpy as np
+        from stream_tables import unify_dtypes, convert
+
+        dt1 = np.dtype([('a', 'i2'), ('s', 'S3')])
+        dt2 = np.dtype([('s', 'S5'), ('a', 'i4'), ('b', 'f4', (2,))])
+        dt = unify_dtypes([dt1, dt2])
+        self.assertEqual(dt, np.dtype([('a', 'i4'), ('s', 'S5'), ('b', 'f4', (2,))]))
+        # by name, the missing columns are zero
+        data = np.zeros(1, dt2)
+        data['s'], data['a'], data['b'] = b'abcde', 7, [1., 2.]
+        out = convert(np.zeros(2, dt1), dt)
+        self.assertEqual(list(out['b'].ravel()), [0.] * 4)
+        out = convert(data, dt)
+        self.assertEqual((out['a'][0], out['s'][0], list(out['b'][0])), (7, b'abcde', [1., 2.]))
+        with self.assertRaises(ValueError):
+            unify_dtypes([dt2, np.dtype([('b', 'f4', (3,))])])
+
+    def test_stream_concat(self):
+        import tempfile
+        import numpy as np
+        import fitsio
+        from stream_tables import stream_concat
+
+        dirnm = tempfile.mkdtemp()
+        fns = [os.path.join(dirnm, 'in%d.fits' % i) for i in range(2)]
+        d1 = np.zeros(2, [('id', 'i4'), ('name', 'S3')])
+        d1['id'], d1['name'] = [1, 2], [b'a', b'bb']
+        d2 = np.zeros(1, [('name', 'S6'), ('id', 'i8'), ('flux', 'f4')])
+        d2['id'], d2['name'], d2['flux'] = [3], [b'cccccc'], [1.5]
+        fitsio.write(fns[0], d1)
+        fitsio.write(fns[1], d2)
+        out_fn = os.path.join(dirnm, 'out.fits')
+        self.assertEqual(stream_concat(fns, out_fn, remove=True), 3)
+        out = fitsio.read(out_fn)
+        self.assertEqual(list(out['id']), [1, 2, 3])
+        self.assertEqual([n.strip() for n in out['name'].astype(str)], ['a', 'bb', 'cccccc'])
+        self.assertEqual(list(out['flux']), [0., 0., 1.5])
+        self.assertFalse(any(os.path.exists(fn) for fn in fns))
+        with self.assertRaises(ValueError):
+            stream_concat([], out_fn)
+
+if __name__ == '__main__':
+    unittest.main()
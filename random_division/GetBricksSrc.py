@@ -1,6 +1,17 @@
 '''
 generate a fits file for randoms of a brick (#TODO more bricks within one fits file)
+
+Run with one MPI rank per node (see slurm_submit.sh). Rank 0 reads the
+randoms once, in chunks of CHUNK rows: the brick of each point comes from
+the survey-bricks geometry (rows of constant dec, equal RA steps within a
+row). It splits the bricks among the ranks by number of randoms and sends
+each rank only the rows of its bricks, which the rank NUM writes.
+
+With $randoms_store set, the node writes its bricks as one part of the
+brick sorted columnar store there (see py/randoms_store.py), instead of a
+fits file per brick.
 '''
+from mpi4py import MPI
 import astropy.io.fits as fits
 import numpy as np
 import logging
@@ -8,119 +19,159 @@ import sys
 import multiprocessing
 import sys
 import os
-NUM=int(sys.argv[1])
-print(NUM)
-node_tot = int(os.environ['NODE_NUM'])
+comm = MPI.COMM_WORLD
+NUM = comm.Get_rank()
+node_tot = comm.Get_size()
 bricklist = os.environ['obiwan_out']+'/bricklist.txt'
-bricks = np.loadtxt(bricklist, dtype = np.str)
 randoms_chunk = os.environ['obiwan_out']+'/randoms_chunk/stacked_randoms.fits'
 outdir = os.environ['obiwan_out']+'/divided_randoms/'
-surveybricks = fits.getdata(os.environ['obiwan_data']+'/survey-bricks.fits.gz')
-sel = np.zeros(len(surveybricks),dtype=bool)
+randoms_store = os.environ.get('randoms_store')
+CHUNK = 10**7
+CPU_COUNT = 32 #multiprocessing.cpu_count()
+
+# set in GetBrickStats, shared with the writer processes by fork
+sub_surveybricks = None
+DAT = None
+STARTS = None
+
+def get_brick_index(surveybricks):
+    '''
+    Returns a function giving the index in surveybricks of the brick
+    containing each ra,dec, without looping over the bricks
+    '''
+    ra1 = surveybricks['RA1']
+    dec1 = surveybricks['DEC1']
+    # the bricks of a row share dec1; sort them by ra1 within the row
+    order = np.lexsort((ra1, dec1))
+    row_dec1, row_start, ncol = np.unique(dec1[order], return_index=True,
+                                          return_counts=True)
+    row_ra1 = ra1[order][row_start]
+    step = 360. / ncol
+
+    def brick_index(ra, dec):
+        row = np.clip(np.searchsorted(row_dec1, dec, side='right') - 1,
+                      0, len(row_dec1) - 1)
+        col = np.floor((ra - row_ra1[row]) / step[row]).astype(np.int64) % ncol[row]
+        return order[row_start[row] + col]
 
-for i in range(len(surveybricks)):
-    if surveybricks['BRICKNAME'][i] in bricks:
-        sel[i]=True
+    # the center of each brick must land in it
+    check = brick_index(surveybricks['RA'], surveybricks['DEC'])
+    if np.any(check != np.arange(len(surveybricks))):
+        raise ValueError('survey-bricks rows are not equally spaced in RA')
+    return brick_index
 
-sub_surveybricks = surveybricks[sel]
+def GetBrickIds(brick_index):
+    '''
+    index in survey-bricks of the brick of every random, reading the file
+    once, CHUNK rows at a time
 
-N_tot = len(sub_surveybricks)
-unit = int(N_tot/node_tot)
+    Returns:
+        tuple: the (memory mapped) table of randoms, the brick indices
+    '''
+    log = logging.getLogger('brick_stats')
+    hdu = fits.open(randoms_chunk, memmap=True)
+    dat = hdu[1].data
+    ids = np.empty(len(dat), np.int32)
+    for i in range(0, len(dat), CHUNK):
+        d = dat[i:i+CHUNK]
+        ids[i:i+CHUNK] = brick_index(d['ra'], d['dec'])
+        log.info('read %d of %d randoms' % (min(i+CHUNK, len(dat)), len(dat)))
+    return dat, ids
 
+def SplitBricks(counts):
+    '''
+    node of each brick: contiguous runs of bricks with about the same
+    number of randoms per node
+    '''
+    total = max(counts.sum(), 1)
+    before = np.cumsum(counts) - counts
+    return np.minimum(before * node_tot // total, node_tot - 1)
 
+def GetRows(dat, ids, bricks, nbricks):
+    '''
+    rows of dat in bricks (increasing indices in survey-bricks, of which
+    there are nbricks), grouped by brick and sorted by id within a brick,
+    as a structured array
+    '''
+    lookup = np.zeros(nbricks, bool)
+    lookup[bricks] = True
+    rows = np.flatnonzero(lookup[ids])
+    data = np.array(dat[rows])
+    return data[np.lexsort((data['id'], ids[rows]))]
 
-if NUM<node_tot-1:
-    sub_surveybricks = sub_surveybricks[NUM*unit:(NUM+1)*unit]
-else:
-    sub_surveybricks = sub_surveybricks[NUM*unit:]
+def SendRows(data, dest):
+    '''sends data to rank dest, CHUNK rows per message and at least one,
+    for the dtype (see RecvRows)'''
+    comm.send(len(data), dest=dest)
+    for i in range(0, max(len(data), 1), CHUNK):
+        comm.send(data[i:i+CHUNK], dest=dest)
 
+def RecvRows(source=0):
+    n = comm.recv(source=source)
+    return np.concatenate([comm.recv(source=source) for i in range(0, max(n, 1), CHUNK)])
 
 def GetBrickSrcs(index, write=True):
-    from os.path import isfile
-    #if isfile(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][index])):
-    #    print('file exists for index %d' % index)
-    #    return True
     log = logging.getLogger('brick_stats')
-    log.info('sub_surveybricks[%d] brickname:%s ra1 %f ra2 %f dec1 %f dec2 %f' %(index, sub_surveybricks['BRICKNAME'][index], sub_surveybricks['RA1'][index], sub_surveybricks['RA2'][index], sub_surveybricks['DEC1'][index], sub_surveybricks['DEC2'][index]))
-    
-    ra1 = sub_surveybricks['RA1'][index]
-    ra2 = sub_surveybricks['RA2'][index]
-    dec1 = sub_surveybricks['DEC1'][index]
-    dec2 = sub_surveybricks['DEC2'][index]
-    flag = True
-    TOTAL_COUNT=0
-    if True:
-        hdu = fits.open(randoms_chunk)
-        dat_i = hdu[1].data
-        hdu.close()
-        TOTAL_COUNT+=len(dat_i)
-        dat_ra = dat_i['ra']
-        dat_dec = dat_i['dec']
-        dat_sel = (dat_ra>ra1)&(dat_ra<ra2)&(dat_dec>dec1)&(dat_dec<dec2)
-        dat_i_brick = dat_i[dat_sel]
-        if flag:
-           dat_brick = dat_i_brick
-           if len(dat_brick)>0:
-               flag=False
-               log.debug(len(dat_brick))
-        else:
-           dat_brick = np.hstack((dat_brick, dat_i_brick))
-           log.debug(len(dat_i_brick))
-           log.debug(len(dat_brick))
-    #log.info('Total points here are: %d total number of bricks: %d' % (TOTAL_COUNT, len(sub_surveybricks)))
-    if write is True and len(np.array(dat_brick))>0:
+    dat_brick = DAT[STARTS[index]:STARTS[index+1]]
+    if write is True and len(dat_brick)>0:
         log.info('brick %s length %d' %(sub_surveybricks['BRICKNAME'][index], len(dat_brick)))
-        cols = fits.ColDefs(np.array(dat_brick))
-        HDU = fits.BinTableHDU.from_columns(cols)
+        HDU = fits.BinTableHDU(data=dat_brick)
         HDU.writeto(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][index]), overwrite = True)
-    return np.array(dat_brick)
+    return dat_brick
 
 #main
 def GetBrickStats():
+    global sub_surveybricks, DAT, STARTS
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     log = logging.getLogger('brick_stats')
     log.info('entering GetBrickStats...')
-    CPU_COUNT = 32 #multiprocessing.cpu_count()
     log.info('CPU_COUNT %d' %(CPU_COUNT))
-    
-    p = multiprocessing.Pool(CPU_COUNT)
-    tasks=range(len(sub_surveybricks))
-    outputs = p.map(GetBrickSrcs, tasks)
-    
-    #output_len = [len(outputs[i]) for i in range(len(outputs))]
-    #bricknames = sub_surveybricks['BRICKNAME']
-    #bricks_len_list = np.array(zip(bricknames, output_len))
-    #FAILED: #np.savetxt(outdir+'brick_list.out',bricks_len_list)
+
+    surveybricks = fits.getdata(os.environ['obiwan_data']+'/survey-bricks.fits.gz')
+    if NUM == 0:
+        bricks = np.loadtxt(bricklist, dtype=str)
+        brick_index = get_brick_index(surveybricks)
+        dat, ids = GetBrickIds(brick_index)
+        counts = np.bincount(ids, minlength=len(surveybricks))
+        # bricks of the run with randoms, split by number of randoms
+        sel = np.flatnonzero(np.isin(surveybricks['BRICKNAME'], bricks) & (counts > 0))
+        node = SplitBricks(counts[sel])
+        log.info('%d randoms in %d bricks over %d nodes' % (counts[sel].sum(), len(sel), node_tot))
+        # the rows of the other ranks' bricks, then mine
+        for rank in list(range(1, node_tot)) + [0]:
+            mine = sel[node == rank]
+            DAT = GetRows(dat, ids, mine, len(surveybricks))
+            if rank > 0:
+                comm.send((mine, counts[mine]), dest=rank)
+                SendRows(DAT, rank)
+                del DAT
+        mine_counts = counts[mine]
+        del dat, ids
+    else:
+        mine, mine_counts = comm.recv(source=0)
+        DAT = RecvRows(source=0)
+    log.info('node %d of %d gets %d bricks with %d randoms' %
+             (NUM, node_tot, len(mine), mine_counts.sum()))
+    sub_surveybricks = surveybricks[mine]
+    STARTS = np.append(0, np.cumsum(mine_counts))
+
+    if randoms_store:
+        from randoms_store import write_part
+        write_part(randoms_store, NUM, DAT, sub_surveybricks['BRICKNAME'], mine_counts)
+        log.info('wrote part %d of %s' % (NUM, randoms_store))
+    else:
+        p = multiprocessing.Pool(CPU_COUNT)
+        tasks=range(len(sub_surveybricks))
+        p.map(GetBrickSrcs, tasks)
     GetBrickInfoFile()
     log.info('exiting GetBrickStats...')
 
 def GetBrickInfoFile():
-    f = open(outdir+'brick_list.out',"w")
-    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    log = logging.getLogger('bgrick_stats')
-    for brick_i in sub_surveybricks['BRICKNAME']:
-        log.info("writing %s" % brick_i)
-        try:
-        	hdu = fits.open(outdir+'brick_%s.fits' % brick_i)
-        	dat = hdu[1].data
-        	hdu.close()
-        	f.write("%s %d\n" % (brick_i, len(dat)))
-        except:
-               pass
+    # one list per node, the nodes used to overwrite each other's brick_list.out
+    f = open((randoms_store or outdir)+'/brick_list_%d.out' % NUM,"w")
+    for i,brick_i in enumerate(sub_surveybricks['BRICKNAME']):
+        f.write("%s %d\n" % (brick_i, STARTS[i+1]-STARTS[i]))
     f.close()
 
-def run_one_brick():
-    print('test run')
-    for i in range(1):
-        final_array = GetBrickSrcs(i)
-        print('brick:%s length:%d' % (sub_surveybricks['BRICKNAME'][i], len(final_array)))
-    #    brickname_array = np.array([sub_surveybricks['BRICKNAME'][i] for k in range(len(final_array))])
-    #    brickname_cols = fits.Column(name='brickname',array=brickname_array,format='20A')
-        cols = fits.ColDefs(final_array)
-        print(type(cols))
-    #    cols.add_col(brickname_cols)
-        HDU = fits.BinTableHDU.from_columns(cols)
-        HDU.writeto(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][i]), overwrite=True)
-
 if __name__ == '__main__':
     GetBrickStats()
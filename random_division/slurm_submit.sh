@@ -16,6 +16,9 @@ export obiwan_data=$CSCRATCH/Obiwan/dr9m/obiwan_data/
 export NODE_NUM=10 #this should be consistent with the number of nodes you request
 export obiwan_code=$CSCRATCH/Obiwan/dr9m/obiwan_code/
 export real_brick_fn=bricks_dr9f_south.txt #bricklist to be processed, which should be stored in brickstat folder
+# brick sorted columnar store of the randoms (py/randoms_store.py); unset for divided_randoms/brick_*.fits
+export randoms_store=$obiwan_out/randoms_store
+export PYTHONPATH=$obiwan_code/py:$PYTHONPATH
 cp $CSCRATCH/Obiwan/dr9m/obiwan_code/brickstat/real_brick_lists/$real_brick_fn $obiwan_out/bricklist.txt
 
 #NERSC things
@@ -27,18 +30,9 @@ export OMP_NUM_THREADS=1
 export XDG_CONFIG_HOME=/dev/shm
 #srun -n $SLURM_JOB_NUM_NODES mkdir -p $XDG_CONFIG_HOME/astropy
 
-upper_lim=$(( NODE_NUM - 1 ))
-
-
 mkdir $obiwan_out/divided_randoms/
 
-for (( i=0; i<upper_lim; i++ ))
-do
-	srun -n 1 -c 64 python GetBricksSrc.py $i &
-done
-
-srun -n 1 -c 64 python GetBricksSrc.py $upper_lim 
-
-wait
+# one rank per node: rank 0 reads the randoms and sends each rank its bricks' rows
+srun -N $NODE_NUM -n $NODE_NUM -c 64 python GetBricksSrc.py
 
 